@@ -0,0 +1,141 @@
+import json
+import os
+import numpy as np
+import pyarrow
+from .similarity import VideoEmbeddings
+
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+def concatenated_embeddings(video_embeddings, batch_size=65536):
+    # One VideoEmbeddings of L2-normalized embeddings of several types (dict of type to VideoEmbeddings) concatenated and
+    # scaled so that their inner product is the mean cosine similarity over types. Missing embeddings of a type are zeros.
+    embeddings = list(video_embeddings.values())
+    video_ids = embeddings[0].index.append(
+        [e.index for e in embeddings[1:]]).unique()
+    dims = [e.dim for e in embeddings]
+    vectors = np.zeros((len(video_ids), sum(dims)), dtype=np.float32)
+    valid = np.zeros(len(video_ids), dtype=bool)
+    offset = 0
+    for e, dim in zip(embeddings, dims):
+        rows = e.rows(video_ids)
+        for start in range(0, len(video_ids), batch_size):
+            chunk = rows[start:start + batch_size]
+            found = chunk >= 0
+            chunk_vectors = np.zeros((len(chunk), dim), dtype=np.float32)
+            chunk_vectors[found] = normalize(
+                np.asarray(e.vectors[chunk[found]], dtype=np.float32))
+            vectors[start:start + batch_size, offset:offset + dim] = chunk_vectors
+            valid[start:start + batch_size] |= found
+        offset += dim
+    return VideoEmbeddings(video_ids, vectors / np.sqrt(len(embeddings)), valid)
+
+
+class IVFIndex():
+    # Inverted file index for approximate cosine nearest neighbour search on CPU.
+    # Vectors are L2-normalized and clustered with spherical k-means into n_lists lists, and a query only scans the
+    # n_probe lists with the closest centroids. Vectors are stored grouped by list so each list is a contiguous slice
+    # of one array that is memory-mapped when the index is loaded.
+    def __init__(self, video_ids, centroids, list_offsets, vectors):
+        self.video_ids = np.asarray(video_ids, dtype=object)
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.vectors = vectors
+
+    def __len__(self):
+        return len(self.video_ids)
+
+    @classmethod
+    def build(cls, video_embeddings, n_lists=None, n_iter=20, sample_size=100000, seed=42, batch_size=65536):
+        # build from VideoEmbeddings, videos without valid embedding are left out
+        rows = np.flatnonzero(video_embeddings.valid)
+        video_ids = video_embeddings.index[rows]
+        vectors = np.empty((len(rows), video_embeddings.dim), dtype=np.float32)
+        for start in range(0, len(rows), batch_size):
+            vectors[start:start + batch_size] = normalize(np.asarray(
+                video_embeddings.vectors[rows[start:start + batch_size]], dtype=np.float32))
+        n_lists = min(n_lists or max(1, int(4 * np.sqrt(len(rows)))), max(len(rows), 1))
+        centroids = _spherical_kmeans(
+            vectors, n_lists, n_iter, sample_size, seed, batch_size)
+        assignments = _nearest_centroids(vectors, centroids, batch_size)
+        order = np.argsort(assignments, kind='stable')
+        list_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(assignments, minlength=n_lists))])
+        return cls(video_ids[order], centroids, list_offsets, vectors[order])
+
+    def search(self, queries, k=10, n_probe=8):
+        # (video ids, cosine similarities) of the k nearest indexed videos of each query vector, rows are sorted by
+        # similarity and padded with None and NaN when the probed lists have less than k videos
+        queries = normalize(np.atleast_2d(
+            np.asarray(queries, dtype=np.float32)))
+        n_probe = min(n_probe, len(self.centroids))
+        ids = np.full((len(queries), k), None, dtype=object)
+        scores = np.full((len(queries), k), np.nan, dtype=np.float32)
+        probes = np.argpartition(-(queries @ self.centroids.T),
+                                 n_probe - 1, axis=1)[:, :n_probe]
+        for i, (query, probe) in enumerate(zip(queries, probes)):
+            candidates = np.concatenate([np.arange(
+                self.list_offsets[l], self.list_offsets[l + 1]) for l in probe])
+            if not len(candidates):
+                continue
+            candidate_scores = np.asarray(self.vectors[candidates]) @ query
+            top = np.argpartition(-candidate_scores, min(k, len(candidates)) - 1)[:k]
+            top = top[np.argsort(-candidate_scores[top])]
+            ids[i, :len(top)] = self.video_ids[candidates[top]]
+            scores[i, :len(top)] = candidate_scores[top]
+        return ids, scores
+
+    def candidate_pairs(self, query_embeddings, query_video_ids, k=10, n_probe=8):
+        # pyarrow Table of (regret_id, recommendation_id, similarity) pairs of each query video and its k nearest
+        # indexed videos, e.g. candidate pairs for the cross-encoder without a quadratic scan
+        rows = query_embeddings.rows(query_video_ids)
+        query_video_ids = np.asarray(query_video_ids, dtype=object)[rows >= 0]
+        ids, scores = self.search(
+            query_embeddings.vectors[rows[rows >= 0]], k=k + 1, n_probe=n_probe)
+        keep = ids.astype(bool) & (ids != query_video_ids[:, None])
+        keep &= np.cumsum(keep, axis=1) <= k
+        return pyarrow.table({
+            'regret_id': np.repeat(query_video_ids, keep.sum(axis=1)).tolist(),
+            'recommendation_id': ids[keep].tolist(),
+            'similarity': scores[keep].astype(np.float64),
+        })
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'centroids.npy'), self.centroids)
+        np.save(os.path.join(path, 'list_offsets.npy'), self.list_offsets)
+        np.save(os.path.join(path, 'vectors.npy'), self.vectors)
+        with open(os.path.join(path, 'video_ids.json'), 'w') as handle:
+            json.dump(self.video_ids.tolist(), handle)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, 'video_ids.json'), 'r') as handle:
+            video_ids = json.load(handle)
+        return cls(video_ids, np.load(os.path.join(path, 'centroids.npy')), np.load(os.path.join(path, 'list_offsets.npy')),
+                   np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r' if mmap else None))
+
+
+def _nearest_centroids(vectors, centroids, batch_size):
+    return np.concatenate([np.argmax(vectors[start:start + batch_size] @ centroids.T, axis=1) for start in range(0, len(vectors), batch_size)] or [np.empty(0, dtype=np.int64)])
+
+
+def _spherical_kmeans(vectors, n_clusters, n_iter, sample_size, seed, batch_size):
+    # k-means on the unit sphere fitted on a sample of vectors, empty clusters are restarted from random sample vectors
+    rng = np.random.default_rng(seed)
+    if len(vectors) > sample_size:
+        vectors = vectors[np.sort(rng.choice(
+            len(vectors), sample_size, replace=False))]
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy(
+    ) if len(vectors) else np.zeros((n_clusters, vectors.shape[1]), dtype=np.float32)
+    for _ in range(n_iter):
+        assignments = _nearest_centroids(vectors, centroids, batch_size)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        empty = np.bincount(assignments, minlength=n_clusters) == 0
+        sums[empty] = vectors[rng.choice(len(vectors), empty.sum())]
+        centroids = normalize(sums)
+    return centroids
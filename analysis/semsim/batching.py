@@ -0,0 +1,137 @@
+import random
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+from torch.utils.data.dataloader import default_collate
+
+
+class DynamicPaddingCollator():
+    # Collates examples of RRUMDataset/RRUMDatasetV2 so that tokenized text types are padded only to the
+    # longest sequence of the batch instead of max_length. Examples padded to max_length are trimmed and
+    # examples of different lengths are padded with pad_token_id. Fixed shape transcript windows of RRUMDatasetV2 with
+    # transcript_chunking are collated as they are.
+    def __init__(self, text_types, pad_token_id=0, padding_side='right'):
+        self.text_types = text_types
+        self.pad_token_id = pad_token_id
+        self.padding_side = padding_side
+
+    def _text_type_keys(self, example, text_type):
+        return [key for key in example if key.startswith(f'{text_type}_')]
+
+    def __call__(self, examples):
+        batch = default_collate([{key: value for key, value in example.items() if not any(
+            key.startswith(f'{t}_') for t in self.text_types)} for example in examples])
+        for text_type in self.text_types:
+            mask_key = f'{text_type}_attention_mask'
+            if mask_key not in examples[0]:
+                continue
+            lengths = [int(torch.as_tensor(example[mask_key]).sum())
+                       for example in examples]
+            batch_length = max(lengths)
+            for key in self._text_type_keys(examples[0], text_type):
+                pad_value = self.pad_token_id if key.endswith('input_ids') else 0
+                padded = torch.full(
+                    (len(examples), batch_length), pad_value, dtype=torch.long)
+                for i, (example, length) in enumerate(zip(examples, lengths)):
+                    value = torch.as_tensor(example[key])
+                    if self.padding_side == 'right':
+                        padded[i, :length] = value[:length]
+                    else:
+                        padded[i, batch_length - length:] = value[len(value) - length:]
+                batch[key] = padded
+        return batch
+
+    def trim(self, batch):
+        # trim an already collated batch of max_length padded tensors, e.g. from RecordBatchStream, to its longest sequence
+        for text_type in self.text_types:
+            if f'{text_type}_attention_mask' not in batch:
+                continue
+            batch_length = int(
+                batch[f'{text_type}_attention_mask'].sum(dim=1).max())
+            for key in self._text_type_keys(batch, text_type):
+                value = batch[key]
+                batch[key] = value[:, :batch_length] if self.padding_side == 'right' else value[:,
+                                                                                                 value.shape[1] - batch_length:]
+        return batch
+
+
+def example_length(example, text_types):
+    # amount of tokens in all text types of an encoded example
+    return sum(int(torch.as_tensor(example[key]).sum()) for t in text_types for key in [f'{t}_attention_mask', f'regret_{t}_chunk_attention_mask', f'recommendation_{t}_chunk_attention_mask'] if key in example)
+
+
+def dataset_example_lengths(dataset, text_types, chunk_size=10000):
+    # lengths of all examples of a map-style dataset for LengthGroupedBatchSampler, the amount of tokens
+    # for encoded datasets and the amount of words for datasets encoded on the fly
+    mask_columns = [col for t in text_types for col in [f'{t}_attention_mask', f'regret_{t}_chunk_attention_mask',
+                                                          f'recommendation_{t}_chunk_attention_mask'] if col in dataset.column_names]
+    if mask_columns:
+        dataset = dataset.with_format('numpy', columns=mask_columns)
+        lengths = []
+        for start in range(0, len(dataset), chunk_size):
+            chunk = dataset[start:start + chunk_size]
+            lengths.extend(sum(np.asarray(chunk[col]).reshape(len(chunk[col]), -1).sum(axis=1)
+                           for col in mask_columns).tolist())
+        return lengths
+    text_columns = [f'{side}_{t}' for t in text_types for side in [
+        'regret', 'recommendation']]
+    dataset = dataset.with_format(None, columns=text_columns)
+    lengths = []
+    for start in range(0, len(dataset), chunk_size):
+        chunk = dataset[start:start + chunk_size]
+        lengths.extend(sum(len(text.split()) for text in texts)
+                       for texts in zip(*[chunk[col] for col in text_columns]))
+    return lengths
+
+
+def length_sorted_indices(lengths):
+    # dataset order for prediction, longest examples first so batches of a sequential DataLoader contain little padding
+    return sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+
+
+def restore_order(predictions_all_batches, indices, batch_size):
+    # predictions of a dataset in indices order back to the original order of the dataset, split into batches
+    predictions = torch.cat(predictions_all_batches)
+    inverse = torch.empty(len(indices), dtype=torch.long)
+    inverse[torch.as_tensor(indices)] = torch.arange(len(indices))
+    return list(predictions[inverse].split(batch_size))
+
+
+class LengthGroupedBatchSampler(Sampler):
+    # Batch sampler for map-style datasets that puts examples of similar length into the same batch.
+    # Indices are (optionally) shuffled, split into chunks of batch_size * bucket_batches examples and sorted by
+    # length inside a chunk, so batches stay random but contain little padding. Batch order is shuffled too.
+    def __init__(self, lengths, batch_size, shuffle=False, bucket_batches=50, seed=42, drop_last=False):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_batches = bucket_batches
+        self.seed = seed
+        self.drop_last = drop_last
+        self._epoch = 0
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        indices = list(range(len(self.lengths)))
+        rng = random.Random(self.seed + self._epoch)
+        self._epoch += 1
+        if self.shuffle:
+            rng.shuffle(indices)
+            bucket_size = self.batch_size * self.bucket_batches
+        else:
+            bucket_size = len(indices)  # without shuffling sort everything for the least padding
+        batches = []
+        for start in range(0, len(indices), bucket_size):
+            bucket = sorted(indices[start:start + bucket_size],
+                            key=lambda i: self.lengths[i], reverse=True)
+            batches.extend(bucket[i:i + self.batch_size]
+                           for i in range(0, len(bucket), self.batch_size))
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        if self.shuffle:
+            rng.shuffle(batches)
+        yield from batches
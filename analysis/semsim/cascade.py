@@ -0,0 +1,101 @@
+import json
+import numpy as np
+import pyarrow
+import pyarrow.compute as pc
+from .similarity import add_pair_similarities
+from .utils import arrow_processing
+
+
+class BiEncoderPrefilter():
+    # Cheap first stage of cascaded RRUM prediction. Pairs are scored with logistic regression over cosine similarities
+    # of per-video embeddings (<embedding_type>_sim columns, see similarity.py) and e.g. channel_sim. Every video is
+    # embedded once however many pairs it's in, so scoring a regret video against all its recommendations costs a few
+    # dot products instead of one cross-encoder forward per pair. Pairs with prefilter probability <= low or >= high are
+    # decided by the prefilter and only the ambiguous pairs in between (or with missing similarities) are sent to the cross-encoder.
+    def __init__(self, feature_columns, weights, bias, low=-1.0, high=2.0):
+        self.feature_columns = list(feature_columns)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.bias = float(bias)
+        self.low = low
+        self.high = high
+
+    @staticmethod
+    def _features(table, feature_columns):
+        # (rows, features) float64 matrix, nulls become NaN
+        return np.stack([arrow_processing.to_numpy(pc.cast(table.column(col), pyarrow.float64())) for col in feature_columns], axis=1) if table.num_rows else np.empty((0, len(feature_columns)))
+
+    def _proba(self, features):
+        return 1 / (1 + np.exp(-(features @ self.weights + self.bias)))
+
+    @classmethod
+    def fit(cls, table, feature_columns, label_col='label', max_error=0.02, l2=1e-3, max_iterations=50):
+        # Fit logistic regression on labeled pairs with Newton's method, then set low and high so that at most max_error
+        # of the labeled pairs decided by the prefilter on each side get the wrong label.
+        features = cls._features(table, feature_columns)
+        labels = arrow_processing.to_numpy(
+            pc.cast(table.column(label_col), pyarrow.float64()))
+        valid = ~np.isnan(features).any(axis=1) & ~np.isnan(labels)
+        features, labels = features[valid], labels[valid]
+        x = np.hstack([features, np.ones((len(features), 1))])
+        w = np.zeros(x.shape[1])
+        for _ in range(max_iterations):
+            p = 1 / (1 + np.exp(-(x @ w)))
+            gradient = x.T @ (p - labels) + l2 * w
+            hessian = (x.T * (p * (1 - p))) @ x + l2 * np.eye(x.shape[1])
+            step = np.linalg.solve(hessian, gradient)
+            w -= step
+            if np.abs(step).max() < 1e-8:
+                break
+        prefilter = cls(feature_columns, w[:-1], w[-1])
+        prefilter.low, prefilter.high = _decision_thresholds(
+            prefilter._proba(features), labels, max_error)
+        return prefilter
+
+    def predict_proba(self, table):
+        # NaN for pairs with missing features
+        return self._proba(self._features(table, self.feature_columns))
+
+    def split(self, table):
+        # (decided pairs with prefilter probability in "prediction" column, ambiguous pairs for the cross-encoder)
+        proba = self.predict_proba(table)
+        decided = (proba <= self.low) | (proba >= self.high)
+        return table.filter(pyarrow.array(decided)).append_column('prediction', pyarrow.array(proba[decided])), table.filter(pyarrow.array(~decided))
+
+    def save(self, path):
+        with open(path, 'w') as handle:
+            json.dump({'feature_columns': self.feature_columns, 'weights': self.weights.tolist(
+            ), 'bias': self.bias, 'low': self.low, 'high': self.high}, handle)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as handle:
+            return cls(**json.load(handle))
+
+
+def _decision_thresholds(proba, labels, max_error):
+    # largest low and smallest high whose decided pairs have an error rate of at most max_error, or thresholds deciding nothing
+    order = np.argsort(proba)
+    proba, labels = proba[order], labels[order]
+    counts = np.arange(1, len(proba) + 1)
+    low_ok = np.flatnonzero(np.cumsum(labels) / counts <= max_error)
+    high_ok = np.flatnonzero(
+        np.cumsum(1 - labels[::-1]) / counts <= max_error)
+    low = float(proba[low_ok[-1]]) if len(low_ok) else -1.0
+    high = float(proba[::-1][high_ok[-1]]) if len(high_ok) else 2.0
+    if low >= high:  # max_error is too loose to leave anything for the cross-encoder, keep the thresholds apart
+        low, high = -1.0, 2.0
+    return low, high
+
+
+def prefiltered_record_batches(record_batches, prefilter, video_embeddings, on_decided):
+    # Add embedding similarities to streamed pairs, pass pairs decided by prefilter to on_decided(table) and yield
+    # only the pairs the cross-encoder has to predict, with their original columns.
+    for batch in record_batches:
+        table = pyarrow.Table.from_batches([batch]) if isinstance(
+            batch, pyarrow.RecordBatch) else batch
+        decided, ambiguous = prefilter.split(
+            add_pair_similarities(table, video_embeddings))
+        if decided.num_rows:
+            on_decided(decided)
+        if ambiguous.num_rows:
+            yield from ambiguous.select(table.column_names).to_batches()
@@ -0,0 +1,103 @@
+import argparse
+import glob
+import json
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import pyarrow.parquet as pq
+from .utils.text_cleaning import clean_text_array, cleaned_text_columns, with_cleaned_text_columns
+
+# Cleans text columns of a Parquet file (or a directory of Parquet files) once into a cleaned copy, so that training and
+# prediction don't have to clean the texts again on every run. Row groups are cleaned in parallel worker processes,
+# each into its own part file of output_dir, and the parts have the same columns and schema as the input. The cleaned
+# columns are stored in the schema metadata, and RRUMDataset/RRUMDatasetV2 with clean_text=True skip cleaning them.
+# Part files are written atomically, so an interrupted run continues from the row groups that are not written yet.
+# Usage: python -m analysis.semsim.clean_parquet <input parquet file or directory> <output_dir> --num-proc 8
+# The output is read e.g. with pyarrow.parquet.read_table(output_dir) or as streamed RecordBatches with iter_cleaned_record_batches.
+
+text_columns = [f'{side}_{text_type}' for text_type in ['title', 'description', 'transcript']
+                for side in ['regret', 'recommendation']]
+_manifest_file = '_manifest.json'
+
+
+def _input_files(input_path):
+    return sorted(glob.glob(os.path.join(input_path, '*.parquet'))) if os.path.isdir(input_path) else [input_path]
+
+
+def _part_path(output_dir, file_index, row_group):
+    return os.path.join(output_dir, f'part-{file_index:05d}-{row_group:05d}.parquet')
+
+
+def _clean_row_group(input_file, row_group, columns, part_path):
+    # runs in a worker process, reads the row group itself so that only paths are sent between processes
+    table = pq.ParquetFile(input_file).read_row_group(row_group)
+    for col in columns:
+        table = table.set_column(table.column_names.index(
+            col), table.schema.field(col), clean_text_array(table.column(col)).cast(table.schema.field(col).type))
+    table = table.replace_schema_metadata(with_cleaned_text_columns(
+        table.schema, columns + sorted(cleaned_text_columns(table.schema))).metadata)
+    # the '_' prefix hides an unfinished part from pyarrow.parquet.read_table(output_dir) if the run is interrupted
+    tmp_path = os.path.join(os.path.dirname(part_path),
+                            f'_tmp-{os.path.basename(part_path)}')
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, part_path)
+    return table.num_rows
+
+
+def clean_parquet(input_path, output_dir, columns=None, num_proc=None):
+    # Clean columns (by default the text columns of the data that exist in it) of input_path into part files of output_dir,
+    # returns the amount of cleaned rows of this run. Row groups already cleaned by an earlier run are skipped.
+    input_files = _input_files(input_path)
+    schema = pq.read_schema(input_files[0])
+    columns = [col for col in (columns or text_columns) if col in schema.names]
+    manifest = {'input_files': [os.path.abspath(f) for f in input_files], 'columns': columns}
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, _manifest_file)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as handle:
+            previous = json.load(handle)
+        if {key: previous[key] for key in manifest} != manifest:
+            raise ValueError(
+                f'{output_dir} has cleaned parts of other input files or columns, use another output_dir')
+    with open(manifest_path, 'w') as handle:
+        json.dump({**manifest, 'done': False}, handle)
+
+    pending = [(input_file, row_group, _part_path(output_dir, file_index, row_group))
+               for file_index, input_file in enumerate(input_files)
+               for row_group in range(pq.ParquetFile(input_file).num_row_groups)]
+    total = len(pending)
+    pending = [unit for unit in pending if not os.path.exists(unit[2])]
+    print(f'Cleaning {len(pending)} of {total} row groups of columns {columns}')
+    cleaned_rows = 0
+    with ProcessPoolExecutor(max_workers=num_proc or multiprocessing.cpu_count()) as executor:
+        futures = [executor.submit(_clean_row_group, input_file, row_group, columns, part_path)
+                   for input_file, row_group, part_path in pending]
+        for done, future in enumerate(futures, start=1):
+            cleaned_rows += future.result()
+            print(f'Cleaned {done}/{len(pending)} row groups, {cleaned_rows} rows')
+    with open(manifest_path, 'w') as handle:
+        json.dump({**manifest, 'done': True}, handle)
+    return cleaned_rows
+
+
+def iter_cleaned_record_batches(output_dir, columns=None, batch_size=10000):
+    # generator of RecordBatches of a finished clean_parquet output in the original row order, e.g. as streaming data
+    # for RRUMDataset
+    with open(os.path.join(output_dir, _manifest_file), 'r') as handle:
+        if not json.load(handle)['done']:
+            raise ValueError(f'Cleaning of {output_dir} is not finished')
+    for part_path in sorted(glob.glob(os.path.join(output_dir, 'part-*.parquet'))):
+        yield from pq.ParquetFile(part_path).iter_batches(batch_size=batch_size, columns=columns)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Clean text columns of Parquet data for RRUM training and prediction')
+    parser.add_argument('input_path', help='Parquet file or directory of Parquet files')
+    parser.add_argument('output_dir')
+    parser.add_argument('--columns', nargs='+', default=None,
+                        help=f'Text columns to clean, by default {text_columns}')
+    parser.add_argument('--num-proc', type=int, default=None)
+    args = parser.parse_args()
+    clean_parquet(args.input_path, args.output_dir,
+                  columns=args.columns, num_proc=args.num_proc)
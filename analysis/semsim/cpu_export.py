@@ -0,0 +1,246 @@
+import argparse
+import copy
+import json
+import os
+import time
+import numpy as np
+import pyarrow.parquet
+import torch
+import pytorch_lightning as pl
+from torch import nn
+from torch.utils.data import DataLoader
+from analysis.semsim import unifiedmodel, unifiedmodel_v2, batching
+
+# Export of trained RRUM/RRUMV2 checkpoints into CPU inference artifacts:
+# - 'int8': dynamic INT8 quantization of the Linear layers of the transformers, saved as the quantized state dict that
+#   is loaded into a model rebuilt from the checkpoint hyperparameters in metadata.json
+# - 'onnx': ONNX graph run with ONNX Runtime graph optimizations
+# - 'onnx-int8': ONNX graph with dynamically INT8 quantized weights
+# RRUMV2 models with transcript_chunking only support 'int8', their windows are deduplicated with data dependent
+# shapes (torch.unique and boolean masks) that a traced ONNX graph can't follow.
+# Each export is checked against the logits of the original PyTorch model on a held-out sample before it's saved.
+# Usage: python -m analysis.semsim.cpu_export <checkpoint> <output_dir> --data <held-out pairs parquet> --format int8
+
+formats = ['int8', 'onnx', 'onnx-int8']
+_metadata_file = 'metadata.json'
+_model_attributes = ['text_types', 'scalar_features', 'channel_embeddings',
+                     'cross_encoder_model_name_or_path', 'model_name_or_path']
+
+
+def _model_class(model_version):
+    return unifiedmodel_v2.RRUMV2 if model_version == 'v2' else unifiedmodel.RRUM
+
+
+def load_checkpoint_model(checkpoint_path, model_version='v1'):
+    model_class = _model_class(model_version)
+    model = model_class.load_from_checkpoint(
+        checkpoint_path, optimizer_config=None)
+    return model.cpu().eval()
+
+
+def _transformer_modules_name(model):
+    return 'transformer_models' if isinstance(model, unifiedmodel_v2.RRUMV2) else 'cross_encoders'
+
+
+def _hyper_parameters(model):
+    # constructor arguments of model for rebuilding it at load, training only arguments are left out
+    return {name: value for name, value in model.hparams.items() if name not in ['optimizer_config', 'freeze_policy']}
+
+
+def quantize_int8(model, inplace=False):
+    # (copy of) model with dynamically INT8 quantized Linear layers of the transformers, the small head stays in float32
+    model = (model if inplace else copy.deepcopy(model)).cpu().eval()
+    name = _transformer_modules_name(model)
+    setattr(model, name, torch.quantization.quantize_dynamic(
+        getattr(model, name), {nn.Linear}, dtype=torch.qint8))
+    model.cpu_inference = True
+    return model
+
+
+def is_v2_model(model):
+    # RRUMV2 or an ONNX export of one, their datasets are built with RRUMDatasetV2
+    return isinstance(model, unifiedmodel_v2.RRUMV2) or getattr(model, 'model_version', None) == 'v2'
+
+
+def prediction_dataset(model, data, batch_size=64, clean_text=False):
+    # RRUMDataset or RRUMDatasetV2 of the pairs in data (any data the datasets take) for prediction with model
+    with_transcript = 'transcript' in model.text_types
+    if is_v2_model(model):
+        return unifiedmodel_v2.RRUMDatasetV2(data, with_transcript=with_transcript, model_name_or_path=model.model_name_or_path, label_col=None, keep_video_ids_for_predictions=True,
+                                             use_scalar_features=bool(model.scalar_features), use_channel_embeddings=bool(model.channel_embeddings), processing_batch_size=batch_size,
+                                             clean_text=clean_text, transcript_chunking=getattr(model, 'transcript_chunking', None))
+    return unifiedmodel.RRUMDataset(data, with_transcript=with_transcript, cross_encoder_model_name_or_path=model.cross_encoder_model_name_or_path,
+                                    label_col=None, keep_video_ids_for_predictions=True, processing_batch_size=batch_size, clean_text=clean_text)
+
+
+def prediction_loader(model, data, batch_size=64):
+    # DataLoader of dynamically padded prediction batches of pairs in data (Pandas DataFrame or PyArrow Table) for model
+    dataset = prediction_dataset(model, data, batch_size)
+    collate_fn = batching.DynamicPaddingCollator(
+        model.text_types, pad_token_id=dataset.tokenizer.pad_token_id, padding_side=dataset.tokenizer.padding_side)
+    return DataLoader(dataset.test_dataset, shuffle=False, batch_size=batch_size, collate_fn=collate_fn)
+
+
+@torch.no_grad()
+def predict_logits(model, loader):
+    # (logits of all batches as a numpy array, seconds spent in the model)
+    logits, seconds = [], 0.0
+    for batch in loader:
+        start = time.perf_counter()
+        logits.append(model(batch).float().reshape(-1).cpu().numpy())
+        seconds += time.perf_counter() - start
+    return np.concatenate(logits), seconds
+
+
+def parity_report(reference_logits, logits):
+    reference_proba, proba = 1 / \
+        (1 + np.exp(-reference_logits)), 1 / (1 + np.exp(-logits))
+    return {
+        'rows': len(logits),
+        'max_abs_logit_difference': float(np.abs(logits - reference_logits).max()),
+        'mean_abs_logit_difference': float(np.abs(logits - reference_logits).mean()),
+        'max_abs_probability_difference': float(np.abs(proba - reference_proba).max()),
+        'label_agreement': float(((proba >= 0.5) == (reference_proba >= 0.5)).mean()),
+    }
+
+
+def _input_names(model, batch):
+    # tensors of a batch the model consumes, video ids and other columns are left out
+    return [key for key, value in batch.items() if isinstance(value, torch.Tensor) and (any(key.startswith(f'{t}_') for t in model.text_types) or key in model.scalar_features or key in getattr(model, 'channel_embeddings', []))]
+
+
+class _PositionalInputs(nn.Module):
+    # ONNX export passes inputs as positional tensors, the models take a dict
+    def __init__(self, model, input_names):
+        super().__init__()
+        self.model = model
+        self.input_names = input_names
+
+    def forward(self, *inputs):
+        return self.model(dict(zip(self.input_names, inputs)))
+
+
+def export_onnx(model, batch, path, quantize=False, opset_version=14):
+    # Export model to ONNX at path with example batch, batch size and text lengths stay dynamic.
+    # With quantize, weights are quantized to INT8 with ONNX Runtime's dynamic quantization. Returns input specs for metadata.
+    input_names = _input_names(model, batch)
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} if any(name.startswith(
+        f'{t}_') for t in model.text_types) else {0: 'batch'} for name in input_names}
+    dynamic_axes['logits'] = {0: 'batch'}
+    export_path = f'{path}.fp32' if quantize else path
+    torch.onnx.export(_PositionalInputs(model, input_names).eval(), tuple(batch[name] for name in input_names), export_path,
+                      input_names=input_names, output_names=['logits'], dynamic_axes=dynamic_axes, opset_version=opset_version, do_constant_folding=True)
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(export_path, path, weight_type=QuantType.QInt8)
+        os.remove(export_path)
+    return [{'name': name, 'dtype': str(batch[name].numpy().dtype)} for name in input_names]
+
+
+class ONNXRuntimeModel(pl.LightningModule):
+    # Exported ONNX graph of RRUM/RRUMV2 run with ONNX Runtime on CPU, with the attributes prediction needs from the original
+    # model (text_types etc.) so it can be used in place of it, e.g. as model of prediction.run_prediction
+    def __init__(self, path, metadata, num_threads=None):
+        super().__init__()
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(
+            path, options, providers=['CPUExecutionProvider'])
+        self.inputs = metadata['inputs']
+        self.model_version = metadata['model_version']
+        for attribute, value in metadata['model'].items():
+            setattr(self, attribute, value)
+        self.channel_embeddings = metadata['model'].get('channel_embeddings', [])
+        self.cpu_inference = True
+
+    def input_columns(self, keep_video_ids=True):
+        return (['regret_id', 'recommendation_id'] if keep_video_ids else []) + [f'{side}_{text_type}' for text_type in self.text_types for side in ['regret', 'recommendation']] + self.scalar_features + self.channel_embeddings
+
+    def forward(self, x):
+        logits, = self.session.run(['logits'], {spec['name']: x[spec['name']].cpu().numpy().astype(
+            spec['dtype'], copy=False) for spec in self.inputs})
+        return torch.from_numpy(logits)
+
+
+def load_cpu_model(path, num_threads=None):
+    # model of an export_cpu_model artifact directory, ready for prediction on CPU
+    with open(os.path.join(path, _metadata_file), 'r') as handle:
+        metadata = json.load(handle)
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if metadata['format'] == 'int8':
+        # V1 cross-encoders are built from their config only, the state dict holds all weights
+        hyper_parameters = dict(metadata['hyper_parameters'], **(
+            {'pretrained': False} if metadata['model_version'] != 'v2' else {}))
+        model = quantize_int8(_model_class(metadata['model_version'])(
+            **hyper_parameters), inplace=True)
+        model.load_state_dict(torch.load(os.path.join(
+            path, 'model.pt'), map_location='cpu', weights_only=True))
+        return model
+    return ONNXRuntimeModel(os.path.join(path, 'model.onnx'), metadata, num_threads=num_threads)
+
+
+def export_cpu_model(checkpoint_path, output_dir, held_out_data, export_format='int8', model_version='v1', batch_size=64, max_probability_difference=0.05, num_threads=None):
+    # Export checkpoint into output_dir and check its logits against the PyTorch model on held_out_data pairs.
+    # The parity report and CPU speedup are stored in metadata.json, ValueError is raised if predicted probabilities
+    # differ more than max_probability_difference.
+    if export_format not in formats:
+        raise ValueError(
+            f'export_format is {export_format} when one of {formats} is allowed')
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    os.makedirs(output_dir, exist_ok=True)
+    model = load_checkpoint_model(checkpoint_path, model_version)
+    if export_format != 'int8' and getattr(model, 'transcript_chunking', None):
+        raise ValueError(
+            f'export_format {export_format} is not supported for models with transcript_chunking, use int8')
+    loader = prediction_loader(model, held_out_data, batch_size)
+    metadata = {'format': export_format, 'checkpoint': os.path.abspath(checkpoint_path), 'model_version': model_version, 'model': {
+        attribute: getattr(model, attribute) for attribute in _model_attributes if hasattr(model, attribute)}}
+    if export_format == 'int8':
+        exported = quantize_int8(model)
+        metadata['hyper_parameters'] = _hyper_parameters(model)
+        torch.save(exported.state_dict(), os.path.join(output_dir, 'model.pt'))
+    else:
+        metadata['inputs'] = export_onnx(model, next(iter(loader)), os.path.join(
+            output_dir, 'model.onnx'), quantize=export_format == 'onnx-int8')
+        exported = ONNXRuntimeModel(os.path.join(
+            output_dir, 'model.onnx'), metadata, num_threads=num_threads)
+
+    reference_logits, reference_seconds = predict_logits(model, loader)
+    logits, seconds = predict_logits(exported, loader)
+    metadata['parity'] = parity_report(reference_logits, logits)
+    metadata['parity']['speedup'] = reference_seconds / seconds
+    metadata['parity']['passed'] = metadata['parity']['max_abs_probability_difference'] <= max_probability_difference
+    with open(os.path.join(output_dir, _metadata_file), 'w') as handle:
+        json.dump(metadata, handle, indent=2)
+    print(f'Exported {export_format} model to {output_dir}: {metadata["parity"]}')
+    if not metadata['parity']['passed']:
+        raise ValueError(
+            f'Exported model predictions differ by {metadata["parity"]["max_abs_probability_difference"]} from the PyTorch model when at most {max_probability_difference} is allowed')
+    return metadata
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export RRUM/RRUMV2 checkpoint for CPU inference')
+    parser.add_argument('checkpoint_path')
+    parser.add_argument('output_dir')
+    parser.add_argument('--data', required=True,
+                        help='Parquet file of held-out video pairs for the parity check')
+    parser.add_argument('--sample-size', type=int, default=1000)
+    parser.add_argument('--format', choices=formats, default='int8')
+    parser.add_argument('--model-version', choices=['v1', 'v2'], default='v1')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--max-probability-difference', type=float, default=0.05)
+    parser.add_argument('--num-threads', type=int, default=None)
+    args = parser.parse_args()
+    held_out_data = pyarrow.parquet.read_table(args.data)
+    if held_out_data.num_rows > args.sample_size:
+        held_out_data = held_out_data.take(np.sort(np.random.default_rng(42).choice(
+            held_out_data.num_rows, args.sample_size, replace=False)))
+    export_cpu_model(args.checkpoint_path, args.output_dir, held_out_data, export_format=args.format, model_version=args.model_version,
+                     batch_size=args.batch_size, max_probability_difference=args.max_probability_difference, num_threads=args.num_threads)
@@ -1,18 +1,103 @@
+import concurrent.futures
 import pickle
+import queue
+import threading
+from google.cloud import bigquery
 from google.cloud.bigquery_storage import types
+import pyarrow
+import pyarrow.compute as pc
+from . import similarity
+from .streaming import RecordBatchSources
 
 labeled_data_table_id = 'regrets-reporter-dev.ra_can_write.labelled_ra'
 embeddings_table_id = 'regrets-reporter-dev.regrets_reporter_analysis.derived_fields_v1'
 yt_data_table_id = 'regrets-reporter-dev.regrets_reporter_analysis.yt_api_data_can'
 language_table_id = 'regrets-reporter-dev.ra_can_read.langs'
 pairs_table_id = 'regrets-reporter-dev.regrets_reporter_analysis.pairs'
+embedding_types = ['title', 'thumbnail', 'description', 'transcript']
+
+
+# Run query and return its result as pandas DataFrame, pyarrow Table or generator of pyarrow RecordBatches.
+# If context has a query_cache.QueryCache in "query_cache", results are read from and written to the local cache
+# so running the same query again doesn't touch BigQuery until its source tables are modified.
+def _run_query(context, _query, return_data_type, job_config=None):
+    if return_data_type not in ['dataframe', 'arrow', 'arrow_table', 'arrow_streaming']:
+        raise ValueError(
+            f'return_data_type={return_data_type} is not allowed. Only "dataframe", "arrow" and "arrow_streaming" is allowed.')
+    cache = context.get('query_cache')
+    key = None
+    if cache is not None:
+        key = cache.key(context['bq_client'], _query,
+                        job_config.query_parameters if job_config else None)
+        if key in cache:
+            if return_data_type == 'arrow_streaming':
+                return cache.read_batches(key)
+            data = cache.read_table(key)
+            return data.to_pandas() if return_data_type == 'dataframe' else data
+
+    data = context['bq_client'].query(
+        _query, job_config=job_config
+    ).result()
+    return _query_result(context, data, return_data_type, cache, key)
+
+
+# Rows of a finished query job in return_data_type, written to cache under key if cache isn't None
+def _query_result(context, data, return_data_type, cache=None, key=None):
+    if return_data_type == 'arrow_streaming':
+        data = data.to_arrow_iterable(
+            bqstorage_client=context['bq_storage_client']
+        )
+        return cache.write_batches(key, data) if cache is not None else data
+    if return_data_type == 'dataframe' and cache is None:
+        return data.to_dataframe(
+            bqstorage_client=context['bq_storage_client']
+        )
+    data = data.to_arrow(
+        bqstorage_client=context['bq_storage_client']
+    )
+    if cache is not None:
+        cache.write_table(key, data)
+    return data.to_pandas() if return_data_type == 'dataframe' else data
 
 
 # Get labelled pairs in format for training bi-encoder model.
-def get_be_labeled_pairs(context, get_only_non_english_data=True, return_data_type='dataframe'):
+def get_be_labeled_pairs(context, get_only_non_english_data=True, return_data_type='dataframe', local_similarity=False, embedding_store=None):
     if return_data_type not in ['dataframe', 'arrow', 'arrow_streaming']:
         raise ValueError(
             f'return_data_type={return_data_type} is not allowed. Only "dataframe", "arrow" and "arrow_streaming" is allowed.')
+    if local_similarity:
+        _query = f'''
+            SELECT
+                regret_id,
+                recommendation_id,
+                label,
+                IF(reg_c_t.channel = rec_c_t.channel, 1, 0) AS channel_sim
+            FROM
+                `{labeled_data_table_id}`
+            INNER JOIN
+                `{embeddings_table_id}` reg_f_t
+            ON regret_id=reg_f_t.video_id
+            INNER JOIN
+                `{embeddings_table_id}` rec_f_t
+            ON recommendation_id=rec_f_t.video_id
+            INNER JOIN
+                `{yt_data_table_id}` reg_c_t
+            ON regret_id=reg_c_t.video_id
+            INNER JOIN
+                `{yt_data_table_id}` rec_c_t
+            ON recommendation_id=rec_c_t.video_id
+            {f"INNER JOIN `{language_table_id}` reg_l_t ON regret_id=reg_l_t.video_id INNER JOIN `{language_table_id}` rec_l_t ON recommendation_id=rec_l_t.video_id" if get_only_non_english_data else ""}
+            {"WHERE (reg_l_t.description_lang != 'en' OR rec_l_t.description_lang != 'en')" if get_only_non_english_data else ""}
+        '''
+        data = _get_pairs_with_local_similarities(
+            context, _query, return_data_type, embedding_store=embedding_store)
+        if return_data_type == 'dataframe':
+            data = data.query("label != 'Unsure'")
+            data.loc[:, 'label'] = data['label'].map(
+                {"Acceptable Recommendation": 0, "Bad recommendation": 1})
+            data.loc[:, 'channel_sim'] = data['channel_sim'].astype(int)
+        return data
+
     _query = f'''
         SELECT
             regret_id,
@@ -82,37 +167,50 @@ def get_be_labeled_pairs(context, get_only_non_english_data=True, return_data_ty
     
     '''
 
-    data = context['bq_client'].query(
-        _query
-    ).result()
+    data = _run_query(context, _query, return_data_type)
     if return_data_type == 'dataframe':
-        data = data.to_dataframe(
-            bqstorage_client=context['bq_storage_client']
-        )
         data = data.query("label != 'Unsure'")
         data.loc[:, 'label'] = data['label'].map(
             {"Acceptable Recommendation": 0, "Bad recommendation": 1})
         data.loc[:, 'channel_sim'] = data['channel_sim'].astype(int)
-    elif return_data_type == 'arrow_table':
-        data = data.to_arrow(
-            bqstorage_client=context['bq_storage_client']
-        )
-    elif return_data_type == 'arrow_streaming':
-        data = data.to_arrow_iterable(
-            bqstorage_client=context['bq_storage_client']
-        )
-    else:
-        raise ValueError(
-            f'return_data_type={return_data_type} is not allowed. Only "dataframe", "arrow" and "arrow_streaming" is allowed.')
 
     return data
 
 
 # Get video pairs in format for predicting with the bi-encoder model.
-def get_be_predict_data(context, with_transcript, get_only_non_english_data=True, return_data_type='dataframe', sample_rate=None):
+def get_be_predict_data(context, with_transcript, get_only_non_english_data=True, return_data_type='dataframe', sample_rate=None, local_similarity=False, embedding_store=None):
     if return_data_type not in ['dataframe', 'arrow', 'arrow_streaming']:
         raise ValueError(
             f'return_data_type={return_data_type} is not allowed. Only "dataframe", "arrow" and "arrow_streaming" is allowed.')
+    if local_similarity:
+        _query = f'''
+            SELECT
+                regret_id,
+                recommendation_id,
+                IF(reg_c_t.channel = rec_c_t.channel, 1, 0) AS channel_sim
+            FROM
+                `{pairs_table_id}`
+            INNER JOIN
+                `{embeddings_table_id}` reg_e_t
+            ON
+                regret_id = reg_e_t.video_id
+            INNER JOIN
+                `{embeddings_table_id}` rec_e_t
+            ON
+                recommendation_id = rec_e_t.video_id
+            INNER JOIN
+                `{yt_data_table_id}` reg_c_t
+            ON regret_id=reg_c_t.video_id
+            INNER JOIN
+                `{yt_data_table_id}` rec_c_t
+            ON recommendation_id=rec_c_t.video_id
+            {f"LEFT JOIN `{language_table_id}` reg_l_t ON regret_id = reg_l_t.video_id LEFT JOIN `{language_table_id}` rec_l_t ON recommendation_id = rec_l_t.video_id" if get_only_non_english_data else ""}
+            WHERE
+            {"(reg_l_t.description_lang != 'en' OR rec_l_t.description_lang != 'en')" if get_only_non_english_data else "TRUE"}
+            {f"AND ABS(MOD(FARM_FINGERPRINT(regret_id), {sample_rate})) = 0" if sample_rate else ""}
+        '''
+        return _get_pairs_with_local_similarities(context, _query, return_data_type, with_transcript=with_transcript, embedding_store=embedding_store)
+
     _query = f'''
         WITH data_t AS (
         SELECT
@@ -191,24 +289,112 @@ def get_be_predict_data(context, with_transcript, get_only_non_english_data=True
         {f"AND ABS(MOD(FARM_FINGERPRINT(regret_id), {sample_rate})) = 0" if sample_rate else ""}
     '''
 
-    data = context['bq_client'].query(
-        _query
-    ).result()
-    if return_data_type == 'dataframe':
-        data = data.to_dataframe(
-            bqstorage_client=context['bq_storage_client']
-        )
-    elif return_data_type == 'arrow_table':
-        data = data.to_arrow(
-            bqstorage_client=context['bq_storage_client']
-        )
-    elif return_data_type == 'arrow_streaming':
-        data = data.to_arrow_iterable(
-            bqstorage_client=context['bq_storage_client']
-        )
-    else:
+    data = _run_query(context, _query, return_data_type)
+    return data
+
+
+# Get embeddings of all videos returned by video_ids_query (a query with video_id column) or of listed video_ids.
+def get_video_embeddings_table(context, video_ids_query=None, video_ids=None, embedding_types=embedding_types):
+    if (video_ids_query is None) == (video_ids is None):
         raise ValueError(
-            f'return_data_type={return_data_type} is not allowed. Only "dataframe", "arrow" and "arrow_streaming" is allowed.')
+            'Exactly one of video_ids_query and video_ids must be given')
+    _query = f'''
+        SELECT
+            video_id,
+            {", ".join(f"{embedding_type}_embedding" for embedding_type in embedding_types)}
+        FROM
+            `{embeddings_table_id}`
+        WHERE
+            {f"video_id IN ({video_ids_query})" if video_ids_query else "video_id IN UNNEST(@video_ids)"}
+    '''
+    job_config = bigquery.QueryJobConfig(query_parameters=[bigquery.ArrayQueryParameter(
+        'video_ids', 'STRING', list(video_ids))]) if video_ids is not None else None
+
+    return _run_query(context, _query, 'arrow', job_config=job_config)
+
+
+# Get embeddings of videos as similarity.VideoEmbeddings per embedding type.
+# With embedding_store, only videos not yet in the local store are fetched from BigQuery and the store is returned memory-mapped.
+# Videos are given as a query of video ids or as a list of video_ids.
+def get_video_embeddings(context, video_ids_query=None, embedding_types=embedding_types, embedding_store=None, fetch_chunk_size=10000, video_ids=None):
+    if embedding_store is None:
+        if video_ids is None:
+            table = get_video_embeddings_table(
+                context, video_ids_query=video_ids_query, embedding_types=embedding_types)
+        else:
+            video_ids = list(video_ids)
+            table = pyarrow.concat_tables([get_video_embeddings_table(context, video_ids=video_ids[start:start + fetch_chunk_size], embedding_types=embedding_types)
+                                           for start in range(0, len(video_ids), fetch_chunk_size)] or [get_video_embeddings_table(context, video_ids=[], embedding_types=embedding_types)])
+        return {embedding_type: similarity.VideoEmbeddings.from_arrow(table, f'{embedding_type}_embedding') for embedding_type in embedding_types}
+
+    if video_ids is None:
+        video_ids = _run_query(context, video_ids_query,
+                               'arrow').column(0).to_pylist()
+    missing_video_ids = embedding_store.missing(video_ids)
+    for start in range(0, len(missing_video_ids), fetch_chunk_size):
+        embedding_store.append_arrow(get_video_embeddings_table(
+            context, video_ids=missing_video_ids[start:start + fetch_chunk_size], embedding_types=embedding_store.embedding_types))
+    print(
+        f'Fetched embeddings of {len(missing_video_ids)} new videos, {len(video_ids) - len(missing_video_ids)} videos were already in the embedding store')
+    return {embedding_type: embedding_store.get(embedding_type) for embedding_type in embedding_types}
+
+
+# Get texts of all collected videos (or of listed video_ids) for encoding single videos, e.g. with tower_embeddings.VideoTowerEncoder.
+def get_video_texts(context, text_types=['title', 'description', 'transcript'], video_ids=None, return_data_type='arrow_streaming'):
+    _query = f'''
+        SELECT
+            video_id,
+            {", ".join(text_types)}
+        FROM
+            `{yt_data_table_id}`
+        {"WHERE video_id IN UNNEST(@video_ids)" if video_ids is not None else ""}
+    '''
+    job_config = bigquery.QueryJobConfig(query_parameters=[bigquery.ArrayQueryParameter(
+        'video_ids', 'STRING', list(video_ids))]) if video_ids is not None else None
+    return _run_query(context, _query, return_data_type, job_config=job_config)
+
+
+# Fetch pairs of pairs_query and compute their embedding similarities locally instead of UNNEST joins in BigQuery.
+# Each video's embeddings are fetched once and pairs are processed batch by batch so memory stays bounded.
+# pairs_query runs at most once: its video ids are read from the locally cached pairs (query_cache) or from the
+# temporary result table of its query job, and the pairs are read from that same job.
+def _get_pairs_with_local_similarities(context, pairs_query, return_data_type, with_transcript=None, embedding_store=None):
+    cache = context.get('query_cache')
+    key = cache.key(context['bq_client'], pairs_query) if cache is not None else None
+    if cache is not None and key in cache:
+        video_ids = cache.read_table(key, columns=['regret_id', 'recommendation_id'])
+        video_ids = pc.unique(pyarrow.concat_arrays([video_ids.column('regret_id').combine_chunks(
+        ), video_ids.column('recommendation_id').combine_chunks()])).to_pylist()
+        video_embeddings = get_video_embeddings(
+            context, video_ids=video_ids, embedding_store=embedding_store)
+        pairs = _run_query(context, pairs_query, 'arrow_streaming' if return_data_type == 'arrow_streaming' else 'arrow')
+    else:
+        job = context['bq_client'].query(pairs_query)
+        rows = job.result()
+        result_table_id = f'{job.destination.project}.{job.destination.dataset_id}.{job.destination.table_id}'
+        # the temporary result table is never queried again, so its queries are not cached
+        video_embeddings = get_video_embeddings(
+            {**context, 'query_cache': None}, f'SELECT regret_id FROM `{result_table_id}` UNION DISTINCT SELECT recommendation_id FROM `{result_table_id}`', embedding_store=embedding_store)
+        pairs = _query_result(context, rows, 'arrow_streaming' if return_data_type == 'arrow_streaming' else 'arrow', cache, key)
+
+    def add_similarities(pairs):
+        pairs = similarity.add_pair_similarities(pairs, video_embeddings)
+        if with_transcript is None:
+            return pairs
+        transcript_sim = pairs.column('transcript_sim')
+        if with_transcript:
+            # NOT IS_NAN(transcript_sim)
+            return pairs.filter(pc.invert(pc.is_nan(pc.fill_null(transcript_sim, float('nan')))))
+        # transcript_sim IS NULL and transcript_sim column excluded
+        pairs = pairs.filter(pc.is_null(transcript_sim))
+        return pairs.drop(['transcript_sim']) if isinstance(pairs, pyarrow.Table) else pyarrow.RecordBatch.from_arrays(
+            [pairs.column(name) for name in pairs.schema.names if name != 'transcript_sim'], names=[name for name in pairs.schema.names if name != 'transcript_sim'])
+
+    if return_data_type == 'arrow_streaming':
+        return (add_similarities(batch) for batch in pairs)
+    data = add_similarities(pairs)
+    if return_data_type == 'dataframe':
+        data = data.to_pandas()
     return data
 
 
@@ -243,26 +429,10 @@ def get_xe_labeled_pairs(context, get_only_english_data=False, return_data_type=
         {"WHERE (reg_l_t.description_lang = 'en' AND rec_l_t.description_lang = 'en')" if get_only_english_data else ""}
     '''
 
-    data = context['bq_client'].query(
-        _query
-    ).result()
+    data = _run_query(context, _query, return_data_type)
     if return_data_type == 'dataframe':
-        data = data.to_dataframe(
-            bqstorage_client=context['bq_storage_client']
-        )
         data.loc[:, 'channel_sim'] = data['channel_sim'].astype(
             int)  # may not be needed anymore
-    elif return_data_type == 'arrow_table':
-        data = data.to_arrow(
-            bqstorage_client=context['bq_storage_client']
-        )
-    elif return_data_type == 'arrow_streaming':
-        data = data.to_arrow_iterable(
-            bqstorage_client=context['bq_storage_client']
-        )
-    else:
-        raise ValueError(
-            f'return_data_type={return_data_type} is not allowed. Only "dataframe", "arrow" and "arrow_streaming" is allowed.')
 
     return data
 
@@ -300,32 +470,27 @@ def get_xe_predict_data(context, with_transcript, get_only_english_data=False, r
         {f"AND ABS(MOD(FARM_FINGERPRINT(regret_id), {sample_rate})) = 0" if sample_rate else ""}
     '''
 
-    data = context['bq_client'].query(
-        _query
-    ).result()
+    data = _run_query(context, _query, return_data_type)
     if return_data_type == 'dataframe':
-        data = data.to_dataframe(
-            bqstorage_client=context['bq_storage_client']
-        )
         data.loc[:, 'channel_sim'] = data['channel_sim'].astype(
             int)  # may not be needed anymore
-    elif return_data_type == 'arrow_table':
-        data = data.to_arrow(
-            bqstorage_client=context['bq_storage_client']
-        )
-    elif return_data_type == 'arrow_streaming':
-        data = data.to_arrow_iterable(
-            bqstorage_client=context['bq_storage_client']
-        )
-    else:
-        raise ValueError(
-            f'return_data_type={return_data_type} is not allowed. Only "dataframe", "arrow" and "arrow_streaming" is allowed.')
 
     return data
 
 
 # Get video pairs in format for predicting with the unified cross-encoder model.
-def get_xe_predict_data_table_streaming(context, dataset_name, table_name, with_transcript, get_only_english_data=False):
+# With max_stream_count > 1 the table is read from several streams concurrently and a generator of pyarrow RecordBatches is returned.
+# selected_fields limits read columns, e.g. to RRUM.input_columns() so unused thumbnails are never downloaded.
+# regret_id_range (lower, upper) limits read rows to lower <= regret_id < upper, None meaning unbounded.
+# Returns None if there are no rows to read.
+# With return_stream_sources, the streams of the read session are returned as streaming.RecordBatchSources that
+# DataLoader worker processes read in parallel, otherwise a generator of RecordBatches or ReadRowsIterable.
+# The workers build their own clients with the keyword arguments (e.g. credentials and client_options) that
+# context['bq_storage_client'] was created with, given in context['bq_storage_client_kwargs'] ({} for defaults).
+def get_xe_predict_data_table_streaming(context, dataset_name, table_name, with_transcript, get_only_english_data=False, max_stream_count=1, max_queued_batches=8, selected_fields=None, regret_id_range=None, return_stream_sources=False):
+    if return_stream_sources and context.get('bq_storage_client_kwargs') is None:
+        raise ValueError(
+            'context["bq_storage_client_kwargs"] must hold the keyword arguments bq_storage_client was created with (e.g. credentials and client_options, {} for defaults) when return_stream_sources is set')
     table = f"projects/{context['project_id']}/datasets/{dataset_name}/tables/{table_name}"
 
     requested_session = types.ReadSession()
@@ -338,18 +503,101 @@ def get_xe_predict_data_table_streaming(context, dataset_name, table_name, with_
         row_restriction = '(recommendation_transcript IS NULL OR regret_transcript IS NULL)'
     if get_only_english_data:
         row_restriction += ' AND (recommendation_description_lang = "en" AND regret_description_lang = "en")'
+    if regret_id_range:
+        lower, upper = regret_id_range
+        if lower is not None:
+            row_restriction += f' AND regret_id >= "{lower}"'
+        if upper is not None:
+            row_restriction += f' AND regret_id < "{upper}"'
     requested_session.read_options.row_restriction = row_restriction
+    if selected_fields:
+        requested_session.read_options.selected_fields = selected_fields
 
     parent = f"projects/{context['project_id']}"
     session = context['bq_storage_client'].create_read_session(
         parent=parent,
         read_session=requested_session,
-        max_stream_count=1,
+        max_stream_count=max_stream_count,
     )
+    if not session.streams:
+        return None
+    if return_stream_sources:
+        return RecordBatchSources([ReadStreamSource(session, stream.name, **context['bq_storage_client_kwargs']) for stream in session.streams],
+                                  schema=pyarrow.ipc.read_schema(pyarrow.py_buffer(session.arrow_schema.serialized_schema)))
+    if max_stream_count > 1:
+        return _read_streams_in_parallel(context['bq_storage_client'], session, max_queued_batches=max_queued_batches)
     reader = context['bq_storage_client'].read_rows(session.streams[0].name)
     return reader.rows(session)
 
 
+class ReadStreamSource():
+    # Reads one stream of a read session as pyarrow RecordBatches with its own client, built with the credentials and
+    # client options of the client that created the session. The session is kept serialized so the source can be
+    # pickled to DataLoader worker processes.
+    def __init__(self, session, stream_name, credentials=None, client_options=None):
+        self.serialized_session = types.ReadSession.serialize(session)
+        self.stream_name = stream_name
+        self.credentials = credentials
+        self.client_options = client_options
+
+    def __call__(self):
+        from google.cloud import bigquery_storage
+        session = types.ReadSession.deserialize(self.serialized_session)
+        client = bigquery_storage.BigQueryReadClient(
+            credentials=self.credentials, client_options=self.client_options)
+        for page in client.read_rows(self.stream_name).rows(session).pages:
+            yield page.to_arrow()
+
+
+# Read all streams of a read session in a thread pool and merge their pyarrow RecordBatches into one generator.
+# Readers block when max_queued_batches batches are waiting so memory stays flat when the consumer is slower.
+# Exceptions of the readers (e.g. expired session) are raised in the consumer.
+def _read_streams_in_parallel(bq_storage_client, session, max_queued_batches=8):
+    batches = queue.Queue(maxsize=max_queued_batches)
+    stop = threading.Event()
+    stream_done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read_stream(stream_name):
+        try:
+            for page in bq_storage_client.read_rows(stream_name).rows(session).pages:
+                if not put(page.to_arrow()):
+                    return
+        except Exception as e:
+            put(e)
+        finally:
+            put(stream_done)
+
+    streams = [stream.name for stream in session.streams]
+    if not streams:
+        return
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=len(streams))
+    try:
+        for stream_name in streams:
+            executor.submit(read_stream, stream_name)
+        streams_left = len(streams)
+        while streams_left:
+            item = batches.get()
+            if item is stream_done:
+                streams_left -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        stop.set()
+        executor.shutdown(wait=False)
+
+
 def save_data(data, pickle_file, context):
     with open(context['gdrive_path'] + pickle_file, 'wb') as handle:
         pickle.dump(data, handle,
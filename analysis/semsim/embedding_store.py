@@ -0,0 +1,99 @@
+import json
+import os
+import numpy as np
+from .similarity import VideoEmbeddings, list_column_to_matrix
+
+
+class EmbeddingStore():
+    # Persistent local store of video embeddings with one set of files per embedding type:
+    # - <type>.f32 fixed-dimension float32 vectors in row-major order, opened with np.memmap
+    # - <type>.valid one uint8 flag per row, 0 for videos without an embedding
+    # - <type>.ids video ids, one per line, the line number is the row of the video
+    # - <type>.json metadata such as the embedding dimension
+    # Appends write vectors and flags before ids so a crashed append is ignored and overwritten on the next append.
+    # Any amount of processes can read the store and share the memory-mapped pages but only one should append at a time.
+    def __init__(self, path, embedding_types):
+        self.path = path
+        self.embedding_types = embedding_types
+        os.makedirs(self.path, exist_ok=True)
+        self._video_ids = {t: self._read_video_ids(
+            t) for t in self.embedding_types}
+
+    def _file(self, embedding_type, extension):
+        return os.path.join(self.path, f'{embedding_type}.{extension}')
+
+    def _read_video_ids(self, embedding_type):
+        if not os.path.exists(self._file(embedding_type, 'ids')):
+            return {}
+        with open(self._file(embedding_type, 'ids'), 'r') as handle:
+            return {video_id: row for row, video_id in enumerate(handle.read().splitlines())}
+
+    def dim(self, embedding_type):
+        if not os.path.exists(self._file(embedding_type, 'json')):
+            return None
+        with open(self._file(embedding_type, 'json'), 'r') as handle:
+            return json.load(handle)['dim']
+
+    def __len__(self):
+        return min(len(ids) for ids in self._video_ids.values())
+
+    def __contains__(self, video_id):
+        return all(video_id in ids for ids in self._video_ids.values())
+
+    def missing(self, video_ids):
+        # video ids that are not yet stored for every embedding type
+        return [video_id for video_id in dict.fromkeys(video_ids) if video_id not in self]
+
+    def append(self, embedding_type, video_ids, vectors, valid):
+        video_ids = list(video_ids)
+        stored_ids = self._video_ids[embedding_type]
+        # first row of each new video id, a video repeated in video_ids is stored once
+        first_rows = {}
+        for i, video_id in enumerate(video_ids):
+            if video_id not in stored_ids:
+                first_rows.setdefault(video_id, i)
+        new_rows = list(first_rows.values())
+        if not new_rows:
+            return 0
+        dim = self.dim(embedding_type)
+        if vectors.shape[1] == 0:
+            if dim is None:
+                # dimension isn't known before the first real embedding, these videos will be fetched again later
+                return 0
+            vectors = np.full((len(video_ids), dim), np.nan, dtype=np.float32)
+        elif dim is None:
+            dim = vectors.shape[1]
+            with open(self._file(embedding_type, 'json'), 'w') as handle:
+                json.dump({'dim': dim}, handle)
+        elif vectors.shape[1] != dim:
+            raise ValueError(
+                f'Embedding dimension of {embedding_type} is {vectors.shape[1]} when {dim} is stored')
+
+        n_rows = len(stored_ids)
+        for extension, data, row_bytes in [('f32', np.ascontiguousarray(vectors[new_rows], dtype=np.float32), dim * 4), ('valid', np.asarray(valid, dtype=np.uint8)[new_rows], 1)]:
+            with open(self._file(embedding_type, extension), 'ab') as handle:
+                handle.truncate(n_rows * row_bytes)  # drop leftovers of a crashed append
+                handle.write(data.tobytes())
+        with open(self._file(embedding_type, 'ids'), 'a') as handle:
+            handle.write(''.join(f'{video_ids[i]}\n' for i in new_rows))
+        for i in new_rows:
+            stored_ids[video_ids[i]] = len(stored_ids)
+        return len(new_rows)
+
+    def append_arrow(self, table, video_id_col='video_id'):
+        # append a pyarrow Table with video_id and <type>_embedding list columns
+        video_ids = table[video_id_col].to_pylist()
+        return {t: self.append(t, video_ids, *list_column_to_matrix(table[f'{t}_embedding'])) for t in self.embedding_types}
+
+    def get(self, embedding_type):
+        # memory-mapped embeddings of all stored videos, rows are read from disk only when accessed
+        stored_ids = self._video_ids[embedding_type]
+        dim = self.dim(embedding_type)
+        if not stored_ids or dim is None:
+            return VideoEmbeddings([], np.empty((0, 0), dtype=np.float32), np.empty(0, dtype=bool))
+        n_rows = len(stored_ids)
+        vectors = np.memmap(self._file(embedding_type, 'f32'),
+                            dtype=np.float32, mode='r', shape=(n_rows, dim))
+        valid = np.memmap(self._file(embedding_type, 'valid'),
+                          dtype=np.uint8, mode='r', shape=(n_rows,))
+        return VideoEmbeddings(list(stored_ids), vectors, np.asarray(valid, dtype=bool))
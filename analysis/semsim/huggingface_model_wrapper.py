@@ -1,17 +1,29 @@
 from huggingface_hub import PyTorchModelHubMixin
 from huggingface_hub.constants import PYTORCH_WEIGHTS_NAME
 from huggingface_hub.file_download import hf_hub_download
-from unifiedmodel import RRUM
+from huggingface_hub.utils import EntryNotFoundError
+from .unifiedmodel import RRUM
+from .utils.mmap_weights import load_safetensors_mmap, save_safetensors, meta_device_parameters, assign_state_dict
 import os
 import torch
 
+SAFETENSORS_WEIGHTS_NAME = "model.safetensors"
+
 
 class YoutubeVideoSimilarityModel(RRUM, PyTorchModelHubMixin):
     """
         Hugging Face `PyTorchModelHubMixin` wrapper for RegretsReporter `RRUM` model.
         This allows loading, using, and saving the model from Hugging Face model hub
         with default Hugging Face methods `from_pretrained` and `save_pretrained`.
+        Weights are saved also as safetensors, which are loaded memory-mapped into a model
+        constructed on meta device so that the weights are in memory only once and shared
+        by all processes loading the same file.
     """
+    def _save_pretrained(self, save_directory):
+        super()._save_pretrained(save_directory)
+        save_safetensors(self.state_dict(), os.path.join(
+            save_directory, SAFETENSORS_WEIGHTS_NAME), metadata={"format": "pt"})
+
     @classmethod
     def _from_pretrained(
         cls,
@@ -29,29 +41,46 @@ class YoutubeVideoSimilarityModel(RRUM, PyTorchModelHubMixin):
     ):
         map_location = torch.device(map_location)
 
+        def model_file(filename):
+            if os.path.isdir(model_id):
+                path = os.path.join(model_id, filename)
+                return path if os.path.exists(path) else None
+            try:
+                return hf_hub_download(
+                    repo_id=model_id,
+                    filename=filename,
+                    revision=revision,
+                    cache_dir=cache_dir,
+                    force_download=force_download,
+                    proxies=proxies,
+                    resume_download=resume_download,
+                    use_auth_token=use_auth_token,
+                    local_files_only=local_files_only,
+                )
+            except EntryNotFoundError:
+                return None
+
         if os.path.isdir(model_id):
             print("Loading weights from local directory")
-            model_file = os.path.join(model_id, PYTORCH_WEIGHTS_NAME)
-        else:
-            model_file = hf_hub_download(
-                repo_id=model_id,
-                filename=PYTORCH_WEIGHTS_NAME,
-                revision=revision,
-                cache_dir=cache_dir,
-                force_download=force_download,
-                proxies=proxies,
-                resume_download=resume_download,
-                use_auth_token=use_auth_token,
-                local_files_only=local_files_only,
-            )
         # convert Huggingface config to RRUM acceptable input parameters
         if "config" in model_kwargs:
             model_kwargs = {**model_kwargs["config"], **model_kwargs}
             del model_kwargs["config"]
-        model = cls(**model_kwargs)
 
-        state_dict = torch.load(model_file, map_location=map_location)
-        model.load_state_dict(state_dict, strict=strict)
+        safetensors_file = model_file(SAFETENSORS_WEIGHTS_NAME)
+        if safetensors_file is not None and map_location.type == "cpu":
+            # weights are not initialized or downloaded as pretrained since they are replaced by the memory-mapped ones
+            with meta_device_parameters():
+                model = cls(**{**model_kwargs, "pretrained": False})
+            state_dict, _ = load_safetensors_mmap(safetensors_file)
+            if not strict:
+                expected = model.state_dict().keys()
+                state_dict = {key: value for key, value in state_dict.items() if key in expected}
+            assign_state_dict(model, state_dict)
+        else:
+            model = cls(**model_kwargs)
+            state_dict = torch.load(model_file(PYTORCH_WEIGHTS_NAME), map_location=map_location)
+            model.load_state_dict(state_dict, strict=strict)
         model.eval()
 
         return model
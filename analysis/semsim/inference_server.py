@@ -0,0 +1,306 @@
+import argparse
+import collections
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import torch
+from transformers import AutoTokenizer
+from .utils.text_cleaning import clean_text_funcs
+from .utils.text_truncation import TokenBudgetTruncator
+
+# Long-running HTTP service that scores video pairs with a loaded RRUM model (e.g. YoutubeVideoSimilarityModel from the
+# Hugging Face hub or a cpu_export.py export) without RRUMDataset and Lightning Trainer. Concurrent requests are coalesced
+# into micro-batches: a batch is predicted when it has max_batch_size pairs or max_latency_ms after its first request.
+# Usage: python -m analysis.semsim.inference_server --model <hub model id or directory> --port 8080
+# POST /predict with a pair {"regret_title": ..., "recommendation_title": ..., ..., "channel_sim": ...} returns
+# {"prediction": p}, and with {"pairs": [pair, ...]} returns {"predictions": [p, ...]}. GET /metrics returns
+# throughput and latency metrics and GET /health returns 200 when the model is loaded.
+
+
+class PairScorer():
+    # Tokenizes pairs like RRUMDataset (texts truncated to the token budget and optionally cleaned) and predicts their
+    # similarity probabilities with model, batches are padded only to their longest text
+    def __init__(self, model, tokenizer=None, max_length=128, clean_text=False, device=None):
+        self.model = model
+        self.tokenizer = tokenizer or AutoTokenizer.from_pretrained(
+            model.cross_encoder_model_name_or_path)
+        self.max_length = max_length
+        self.truncator = TokenBudgetTruncator(self.tokenizer, max_length)
+        self.clean_text = clean_text
+        self.device = device or (
+            'cuda' if torch.cuda.is_available() and not getattr(model, 'cpu_inference', False) else 'cpu')
+        self.model.to(self.device)
+        self.model.eval()
+
+    def _texts(self, pairs, column):
+        texts = [pair.get(column) or '' for pair in pairs]
+        if self.clean_text:
+            texts = clean_text_funcs(texts)
+        return self.truncator(texts)
+
+    def validate(self, pairs):
+        # raise ValueError for pairs that encode() can't encode, run per request before it's batched with other requests
+        missing = [col for col in self.model.scalar_features if any(
+            pair.get(col) is None for pair in pairs)]
+        if missing:
+            raise ValueError(f'Pairs are missing scalar features {missing}')
+        for pair in pairs:
+            for col in self.model.scalar_features:
+                try:
+                    float(pair[col])
+                except (TypeError, ValueError):
+                    raise ValueError(
+                        f'Scalar feature {col} is {pair[col]!r} when a number is allowed')
+            for text_type in self.model.text_types:
+                for side in ['regret', 'recommendation']:
+                    if not isinstance(pair.get(f'{side}_{text_type}'), (str, type(None))):
+                        raise ValueError(
+                            f'{side}_{text_type} is {type(pair[f"{side}_{text_type}"]).__name__} when a string or null is allowed')
+
+    def encode(self, pairs):
+        self.validate(pairs)
+        batch = {}
+        for text_type in self.model.text_types:
+            encoded = self.tokenizer(self._texts(pairs, f'regret_{text_type}'), self._texts(pairs, f'recommendation_{text_type}'),
+                                     padding=True, truncation=True, max_length=self.max_length, return_tensors='pt')
+            batch.update({f'{text_type}_{key}': value.to(self.device)
+                         for key, value in encoded.items()})
+        for col in self.model.scalar_features:
+            batch[col] = torch.tensor([float(pair[col]) for pair in pairs],
+                                      dtype=torch.float32, device=self.device)
+        return batch
+
+    @torch.no_grad()
+    def __call__(self, pairs):
+        return torch.special.expit(self.model(self.encode(pairs)).float()).reshape(-1).cpu().tolist()
+
+
+class ServerMetrics():
+    # Thread-safe request counters and latencies of the last window_size requests
+    def __init__(self, window_size=10000):
+        self.started = time.monotonic()
+        self.requests = 0
+        self.failed_requests = 0
+        self.pairs = 0
+        self.batches = 0
+        self.batched_pairs = 0
+        self._latencies = collections.deque(maxlen=window_size)
+        self._batch_latencies = collections.deque(maxlen=window_size)
+        self._lock = threading.Lock()
+
+    def record_request(self, num_pairs, seconds, failed=False):
+        with self._lock:
+            self.requests += 1
+            self.failed_requests += int(failed)
+            self.pairs += 0 if failed else num_pairs
+            self._latencies.append(seconds)
+
+    def record_batch(self, num_pairs, seconds):
+        with self._lock:
+            self.batches += 1
+            self.batched_pairs += num_pairs
+            self._batch_latencies.append(seconds)
+
+    @staticmethod
+    def _percentiles_ms(latencies):
+        if not latencies:
+            return {'p50': None, 'p95': None, 'p99': None}
+        p50, p95, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 95, 99])
+        return {'p50': float(p50), 'p95': float(p95), 'p99': float(p99)}
+
+    def snapshot(self):
+        with self._lock:
+            uptime = time.monotonic() - self.started
+            return {
+                'uptime_seconds': uptime,
+                'requests': self.requests,
+                'failed_requests': self.failed_requests,
+                'pairs': self.pairs,
+                'pairs_per_second': self.pairs / uptime if uptime else 0.0,
+                'batches': self.batches,
+                'mean_batch_size': self.batched_pairs / self.batches if self.batches else 0.0,
+                'request_latency_ms': self._percentiles_ms(self._latencies),
+                'batch_latency_ms': self._percentiles_ms(self._batch_latencies),
+            }
+
+
+class MicroBatcher():
+    # Coalesces pairs of concurrent submit() calls into batches for predict_fn, run by one background thread so the
+    # model is used by a single thread at a time. A batch is predicted when it has max_batch_size pairs or
+    # max_latency_ms has passed since its first request, larger requests are predicted in max_batch_size chunks.
+    # validate_fn is called with the pairs of each request in submit(), so an invalid request fails alone instead of
+    # failing the whole batch it would be predicted in.
+    def __init__(self, predict_fn, max_batch_size=64, max_latency_ms=10, metrics=None, validate_fn=None):
+        self.predict_fn = predict_fn
+        self.validate_fn = validate_fn
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.metrics = metrics
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, pairs):
+        # Future of the predictions of pairs
+        if self._closed:
+            raise RuntimeError('MicroBatcher is closed')
+        if self.validate_fn is not None:
+            self.validate_fn(pairs)
+        future = Future()
+        if not pairs:
+            future.set_result([])
+        else:
+            self._queue.put((pairs, future))
+        return future
+
+    def _next_requests(self):
+        requests = [self._queue.get()]
+        if requests[0] is None:
+            return None
+        num_pairs = len(requests[0][0])
+        deadline = time.monotonic() + self.max_latency
+        while num_pairs < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                self._queue.put(None)  # stop after this batch
+                break
+            requests.append(request)
+            num_pairs += len(request[0])
+        return requests
+
+    def _run(self):
+        while True:
+            requests = self._next_requests()
+            if requests is None:
+                return
+            pairs = [pair for request_pairs, _ in requests for pair in request_pairs]
+            start = time.monotonic()
+            try:
+                predictions = []
+                for chunk_start in range(0, len(pairs), self.max_batch_size):
+                    predictions.extend(self.predict_fn(
+                        pairs[chunk_start:chunk_start + self.max_batch_size]))
+            except Exception as e:
+                for _, future in requests:
+                    future.set_exception(e)
+                continue
+            if self.metrics is not None:
+                self.metrics.record_batch(len(pairs), time.monotonic() - start)
+            offset = 0
+            for request_pairs, future in requests:
+                future.set_result(predictions[offset:offset + len(request_pairs)])
+                offset += len(request_pairs)
+
+    def close(self):
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+
+def make_request_handler(batcher, metrics, request_timeout=30):
+    class PredictionRequestHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status, body):
+            content = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self._send_json(200, metrics.snapshot())
+            elif self.path == '/health':
+                self._send_json(200, {'status': 'ok'})
+            else:
+                self._send_json(404, {'error': f'Unknown path {self.path}'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._send_json(404, {'error': f'Unknown path {self.path}'})
+                return
+            start = time.monotonic()
+            num_pairs = 0
+            try:
+                body = json.loads(self.rfile.read(
+                    int(self.headers.get('Content-Length', 0))) or b'null')
+                single = isinstance(body, dict) and 'pairs' not in body
+                pairs = [body] if single else body.get(
+                    'pairs') if isinstance(body, dict) else body
+                if not isinstance(pairs, list) or not all(isinstance(pair, dict) for pair in pairs):
+                    raise ValueError(
+                        'Request body must be a pair object, a list of pair objects or {"pairs": [...]}')
+                num_pairs = len(pairs)
+                predictions = batcher.submit(pairs).result(timeout=request_timeout)
+            except (ValueError, KeyError, TypeError) as e:
+                metrics.record_request(num_pairs, time.monotonic() - start, failed=True)
+                self._send_json(400, {'error': str(e)})
+                return
+            except Exception as e:
+                metrics.record_request(num_pairs, time.monotonic() - start, failed=True)
+                self._send_json(500, {'error': str(e)})
+                return
+            metrics.record_request(num_pairs, time.monotonic() - start)
+            self._send_json(200, {'prediction': predictions[0]} if single else {
+                            'predictions': predictions})
+
+        def log_message(self, format, *args):
+            pass  # access logs of every request would slow down the server, see /metrics instead
+
+    return PredictionRequestHandler
+
+
+def serve(model, host='127.0.0.1', port=8080, max_batch_size=64, max_latency_ms=10, max_length=128, clean_text=False, request_timeout=30):
+    # serve model until interrupted
+    metrics = ServerMetrics()
+    scorer = PairScorer(model, max_length=max_length, clean_text=clean_text)
+    batcher = MicroBatcher(scorer, max_batch_size=max_batch_size,
+                           max_latency_ms=max_latency_ms, metrics=metrics, validate_fn=scorer.validate)
+    server = ThreadingHTTPServer(
+        (host, port), make_request_handler(batcher, metrics, request_timeout))
+    server.daemon_threads = True
+    print(f'Serving predictions at http://{host}:{port}/predict')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Serve YoutubeVideoSimilarityModel predictions over HTTP')
+    model_source = parser.add_mutually_exclusive_group(required=True)
+    model_source.add_argument('--model', help='Hugging Face hub model id or local directory of YoutubeVideoSimilarityModel')
+    model_source.add_argument('--cpu-model-path', help='Directory of a cpu_export.py export')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--max-latency-ms', type=float, default=10)
+    parser.add_argument('--max-length', type=int, default=128)
+    parser.add_argument('--clean-text', action='store_true')
+    parser.add_argument('--num-threads', type=int, default=None)
+    args = parser.parse_args()
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    if args.cpu_model_path:
+        from .cpu_export import load_cpu_model
+        model = load_cpu_model(args.cpu_model_path, num_threads=args.num_threads)
+    else:
+        from .huggingface_model_wrapper import YoutubeVideoSimilarityModel
+        model = YoutubeVideoSimilarityModel.from_pretrained(args.model)
+    serve(model, host=args.host, port=args.port, max_batch_size=args.max_batch_size, max_latency_ms=args.max_latency_ms,
+          max_length=args.max_length, clean_text=args.clean_text)
@@ -1,22 +1,112 @@
+import datetime
+import itertools
+import json
+import os
+import string
+import types
+import pandas as pd
+import pyarrow
 import torch
 import pytorch_lightning as pl
-from torch.utils.data import DataLoader
-from google.cloud import bigquery
-from google.api_core.exceptions import NotFound
-from analysis.semsim import unifiedmodel, data
+from torch.utils.data import DataLoader, Subset
+from torch.utils.data.dataloader import default_collate
+from analysis.semsim import unifiedmodel, prediction_sinks, batching, cascade, cpu_export
 
+_video_id_chars = sorted('-_' + string.digits + string.ascii_letters)
 
-class RRUMPredictionBQWriter(pl.callbacks.BasePredictionWriter):
-    def __init__(self, bq_client, bq_predictions_table, write_interval, model_timestamp, print_row_writes=False):
+
+class RRUMPredictionWriter(pl.callbacks.BasePredictionWriter):
+    # Writes predictions and their video ids to a prediction_sinks sink. Predictions are buffered as Arrow columns
+    # and flushed from a background thread so predicting isn't blocked by the writes.
+    # With write_ahead_log_path, written prediction keys and unwritten batches are logged locally so restarted
+    # predictions write every (regret_id, recommendation_id, model_timestamp) row exactly once.
+    def __init__(self, sink, model_timestamp, write_interval='batch', flush_rows=100000, flush_interval=300, print_row_writes=False, write_ahead_log_path=None):
         super().__init__(write_interval)
-        self.bq_client = bq_client
-        self.bq_predictions_table = bq_predictions_table
+        self.sink = sink
+        self.write_ahead_log_path = write_ahead_log_path
         self.model_timestamp = str(model_timestamp).split('.')[0]
+        self._model_timestamp_scalar = pyarrow.scalar(datetime.datetime.fromisoformat(
+            self.model_timestamp), type=prediction_sinks.prediction_schema.field('model_timestamp').type)
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
         self.print_row_writes = print_row_writes
         self.total_rows_written = 0
+        self._writer = None
+        self._decided_batches = []
+
+    def on_predict_start(self, trainer, pl_module):
+        write_ahead_log = prediction_sinks.PredictionWriteAheadLog(
+            self.write_ahead_log_path) if self.write_ahead_log_path else None
+        self._writer = prediction_sinks.AsyncPredictionWriter(
+            self.sink, flush_rows=self.flush_rows, flush_interval=self.flush_interval, write_ahead_log=write_ahead_log)
+        for batch in self._decided_batches:
+            self._writer.append(batch)
+        self._decided_batches = []
+
+    def _close_writer(self):
+        if self._writer is not None:
+            writer, self._writer = self._writer, None
+            try:
+                writer.close()
+            finally:
+                self.total_rows_written += writer.total_rows_written
+                if writer.write_ahead_log is not None:
+                    writer.write_ahead_log.close()
+
+    def on_predict_end(self, trainer, pl_module):
+        self._close_writer()
+
+    def on_exception(self, trainer, pl_module, exception):
+        # keep predictions made before the exception
+        try:
+            self._close_writer()
+        except Exception as e:
+            print(f'Encountered errors while writing predictions: {e}')
+
+    def _record_batch(self, regret_ids, recommendation_ids, prediction):
+        return pyarrow.RecordBatch.from_arrays([
+            pyarrow.array(regret_ids, type=pyarrow.string()),
+            pyarrow.array(recommendation_ids, type=pyarrow.string()),
+            pyarrow.array(prediction, type=pyarrow.float64()),
+            pyarrow.repeat(self._model_timestamp_scalar, len(prediction)),
+        ], schema=prediction_sinks.prediction_schema)
+
+    def write_decided(self, table):
+        # write predictions made without the model, e.g. pairs decided by cascade.BiEncoderPrefilter,
+        # they are kept until prediction starts if the writer isn't open yet
+        batch = self._record_batch(table.column('regret_id'), table.column(
+            'recommendation_id'), table.column('prediction'))
+        if self._writer is None:
+            self._decided_batches.append(batch)
+        else:
+            self._writer.append(batch)
+
+    def write_on_batch_end(
+            self, trainer, pl_module, prediction, batch_indices, batch, batch_idx, dataloader_idx):
+        prediction = torch.special.expit(
+            prediction.float()).reshape(-1).cpu().numpy().astype('float64')
+        self._writer.append(self._record_batch(
+            batch['regret_id'], batch['recommendation_id'], prediction))
+        if self.print_row_writes:
+            print(f'{len(prediction)} prediction rows have been buffered for writing')
+
+    def write_on_epoch_end(
+            self, trainer, pl_module, predictions, batch_indices):
+        pass
+
+
+class RRUMPredictionBQWriter(RRUMPredictionWriter):
+    # Writes predictions to BigQuery table with load jobs
+    def __init__(self, bq_client, bq_predictions_table, write_interval, model_timestamp, print_row_writes=False, flush_rows=100000, flush_interval=300, write_ahead_log_path=None):
+        self.bq_client = bq_client
+        self.bq_predictions_table = bq_predictions_table
         self._prepare_bq_table()
+        super().__init__(prediction_sinks.BigQueryLoadJobSink(bq_client, bq_predictions_table), model_timestamp=model_timestamp, write_interval=write_interval,
+                         flush_rows=flush_rows, flush_interval=flush_interval, print_row_writes=print_row_writes, write_ahead_log_path=write_ahead_log_path)
 
     def _prepare_bq_table(self):
+        from google.cloud import bigquery
+        from google.api_core.exceptions import NotFound
         # Schema for model prediction results
         SCHEMA = [
             bigquery.SchemaField(
@@ -41,31 +131,6 @@ class RRUMPredictionBQWriter(pl.callbacks.BasePredictionWriter):
             table = self.bq_client.create_table(table)
             print(f'Creating BQ table {self.bq_predictions_table}')
 
-    def write_on_batch_end(
-            self, trainer, pl_module, prediction, batch_indices, batch, batch_idx, dataloader_idx):
-        prediction = torch.special.expit(prediction).squeeze().tolist()
-        prediction_dict = {
-            'regret_id': batch['regret_id'],
-            'recommendation_id': batch['recommendation_id'],
-            'prediction': prediction,
-            'model_timestamp': [self.model_timestamp] * len(prediction),
-        }
-        rows_to_insert = [dict(zip(prediction_dict, t))
-                          for t in zip(*prediction_dict.values())]
-        errors = self.bq_client.insert_rows_json(
-            self.bq_predictions_table, rows_to_insert)
-        if errors == []:
-            self.total_rows_written += len(prediction)
-            if self.print_row_writes:
-                print(
-                    f'{len(prediction)} rows have been added to BQ Table {self.bq_predictions_table}')
-        else:
-            print('Encountered errors while inserting rows to BQ: {}'.format(errors))
-
-    def write_on_epoch_end(
-            self, trainer, pl_module, predictions, batch_indices):
-        pass
-
 
 class RRUMPredictionStreamingProgressBar(pl.callbacks.TQDMProgressBar):
     # hack to make tqdm show number of predicted batches when we don't know the amount of total batches
@@ -73,34 +138,104 @@ class RRUMPredictionStreamingProgressBar(pl.callbacks.TQDMProgressBar):
         self.predict_progress_bar.update(1)
 
 
-def run_prediction(data, write_preds_to_bq, return_preds, batch_size, trained_model_checkpoint_path, bq_client=None, bq_predictions_table=None, bq_model_timestamp=None):
+# Predictions can be written to BigQuery with write_preds_to_bq or to any prediction_sinks sink with prediction_sink.
+# dynamic_padding pads batches only to their longest text and group_by_length batches examples of similar length together.
+# Returned predictions are in the original order of data except for streaming data grouped by length.
+# With num_workers, streaming data given as streaming.RecordBatchSources is read and tokenized in DataLoader worker
+# processes, one or more read streams per worker, while the model predicts. Each worker keeps prefetch_factor batches ready.
+# With prefilter (cascade.BiEncoderPrefilter) and video_embeddings (e.g. from data.get_video_embeddings), pairs are first
+# scored with per-video embedding similarities and only ambiguous pairs go through the cross-encoder. Predictions of
+# decided pairs are written with the others, returned predictions contain only pairs predicted by the cross-encoder.
+# With cpu_model_path (or a model from cpu_export.load_cpu_model), an INT8 quantized or ONNX Runtime export of the model
+# (see cpu_export.py) predicts on CPU in float32. Other models predict with 16-bit precision on GPU and float32 on CPU.
+def run_prediction(data, write_preds_to_bq, return_preds, batch_size, trained_model_checkpoint_path, bq_client=None, bq_predictions_table=None, bq_model_timestamp=None, model=None, prediction_sink=None, write_ahead_log_path=None, dynamic_padding=True, group_by_length=True, num_workers=0, prefetch_factor=2, pin_memory=None, prefilter=None, video_embeddings=None, cpu_model_path=None):
     pl_callbacks = []
-    if write_preds_to_bq:
+    prediction_writer = None
+    if prediction_sink is not None:
+        if not bq_model_timestamp:
+            raise ValueError(
+                f'bq_model_timestamp cannot be None as it is needed for writing preds.')
+        prediction_writer = RRUMPredictionWriter(
+            prediction_sink, model_timestamp=bq_model_timestamp, write_ahead_log_path=write_ahead_log_path)
+        pl_callbacks.append(prediction_writer)
+    elif write_preds_to_bq:
         if not bq_client or not bq_predictions_table or not bq_model_timestamp:
             raise ValueError(
                 f'bq_client, bq_predictions_table and bq_model_timestamp cannot be None as they are needed for writing preds to BigQuery.')
         prediction_writer = RRUMPredictionBQWriter(bq_client=bq_client, bq_predictions_table=bq_predictions_table,
-                                                   write_interval='batch', model_timestamp=bq_model_timestamp, print_row_writes=False)
+                                                   write_interval='batch', model_timestamp=bq_model_timestamp, print_row_writes=False, write_ahead_log_path=write_ahead_log_path)
         pl_callbacks.append(prediction_writer)
 
-    model = unifiedmodel.RRUM.load_from_checkpoint(
-        trained_model_checkpoint_path, optimizer_config=None)
+    if prefilter is not None:
+        if prediction_writer is None or video_embeddings is None:
+            raise ValueError(
+                f'prefilter needs video_embeddings and writing predictions to BigQuery or to prediction_sink')
+        if isinstance(data, pd.DataFrame):
+            data = pyarrow.Table.from_pandas(data, preserve_index=False)
+        if isinstance(data, pyarrow.Table):
+            data = pyarrow.Table.from_batches(list(cascade.prefiltered_record_batches(
+                data.to_batches(), prefilter, video_embeddings, prediction_writer.write_decided)), schema=data.schema)
+        elif isinstance(data, types.GeneratorType):
+            data = cascade.prefiltered_record_batches(
+                data, prefilter, video_embeddings, prediction_writer.write_decided)
+        else:
+            raise ValueError(
+                f'Type of data is {type(data)} when pd.DataFrame, pyarrow.Table or generator of pyarrow.RecordBatch is allowed with prefilter')
+
+    if model is None and cpu_model_path:
+        model = cpu_export.load_cpu_model(cpu_model_path)
+    elif model is None:
+        model = unifiedmodel.RRUM.load_from_checkpoint(
+            trained_model_checkpoint_path, optimizer_config=None)
+    cpu_inference = getattr(model, 'cpu_inference', False)
 
-    pred_dataset = unifiedmodel.RRUMDataset(data, with_transcript='transcript' in model.text_types, keep_video_ids_for_predictions=True,
-                                            cross_encoder_model_name_or_path=model.cross_encoder_model_name_or_path, label_col=None, processing_batch_size=batch_size, clean_text=False)
+    if prefilter is not None and isinstance(data, pyarrow.Table) and not data.num_rows:
+        # every pair was decided by prefilter, only its predictions are written
+        prediction_writer.on_predict_start(None, model)
+        prediction_writer.on_predict_end(None, model)
+        print(
+            f'Wrote in total {prediction_writer.total_rows_written} prediction rows')
+        return []
+
+    # RRUMDatasetV2 for RRUMV2 models and their exports, RRUMDataset otherwise
+    pred_dataset = cpu_export.prediction_dataset(
+        model, data, batch_size=batch_size, clean_text=False)
     if pred_dataset.streaming_dataset:
         pl_callbacks.append(RRUMPredictionStreamingProgressBar())
 
-    pred_loader = DataLoader(pred_dataset.test_dataset, shuffle=False,
-                             batch_size=batch_size, num_workers=0, pin_memory=False)
+    collate_fn = batching.DynamicPaddingCollator(model.text_types, pad_token_id=pred_dataset.tokenizer.pad_token_id,
+                                                 padding_side=pred_dataset.tokenizer.padding_side) if dynamic_padding else default_collate
+    pin_memory = torch.cuda.is_available() and not cpu_inference if pin_memory is None else pin_memory
+    pred_order = None
+    if pred_dataset.streaming_dataset:
+        # streamed rows are already encoded into batches of batch_size rows
+        # workers are spawned instead of forked because gRPC channels of BigQuery clients don't survive forking
+        worker_options = {'prefetch_factor': prefetch_factor,
+                          'multiprocessing_context': 'spawn'} if num_workers else {}
+        pred_loader = DataLoader(pred_dataset.test_dataset.with_options(batch_size=batch_size, group_by_length=group_by_length), batch_size=None,
+                                 num_workers=num_workers, pin_memory=pin_memory, collate_fn=collate_fn.trim if dynamic_padding else None, **worker_options)
+    elif group_by_length:
+        # Lightning replaces batch samplers when predicting so the dataset is reordered instead
+        pred_order = batching.length_sorted_indices(batching.dataset_example_lengths(
+            pred_dataset.test_dataset, model.text_types))
+        pred_loader = DataLoader(Subset(pred_dataset.test_dataset, pred_order), shuffle=False,
+                                 batch_size=batch_size, num_workers=0, pin_memory=False, collate_fn=collate_fn)
+    else:
+        pred_loader = DataLoader(pred_dataset.test_dataset, shuffle=False,
+                                 batch_size=batch_size, num_workers=0, pin_memory=False, collate_fn=collate_fn)
 
-    predictor = pl.Trainer(devices="auto", accelerator="auto",
-                           precision=16, callbacks=pl_callbacks)
+    # 16-bit precision only speeds up GPUs, CPU exports are already optimized for float32 CPU inference
+    use_gpu = torch.cuda.is_available() and not cpu_inference
+    predictor = pl.Trainer(devices="auto", accelerator="gpu" if use_gpu else "cpu",
+                           precision=16 if use_gpu else 32, callbacks=pl_callbacks)
     predictions_all_batches = predictor.predict(
         model, dataloaders=pred_loader, return_predictions=return_preds)
-    if write_preds_to_bq:
+    if return_preds and pred_order is not None:
+        predictions_all_batches = batching.restore_order(
+            predictions_all_batches, pred_order, batch_size)
+    if prediction_writer is not None:
         print(
-            f'Wrote in total {prediction_writer.total_rows_written} prediction rows to BigQuery')
+            f'Wrote in total {prediction_writer.total_rows_written} prediction rows')
     print('Predictions done')
     return predictions_all_batches
 
@@ -119,34 +254,96 @@ def create_filtered_predict_table(read_predictions_filtered_table, read_predicti
     return res
 
 
-def run_streaming_prediction(read_predictions_table, read_predictions_filtered_table, save_predictions_table, with_transcript, batch_size, trained_model_checkpoint_path, project_id, bq_client, bq_storage_client, bq_model_timestamp):
+# Sorted boundaries splitting regret_id key space into num_key_ranges ranges.
+# YouTube video ids use base64url characters so their prefixes are spread evenly.
+def video_id_key_boundaries(num_key_ranges):
+    prefix_length = 1
+    while len(_video_id_chars) ** prefix_length < num_key_ranges:
+        prefix_length += 1
+    prefixes = [''.join(p) for p in itertools.product(
+        _video_id_chars, repeat=prefix_length)]
+    return [prefixes[i * len(prefixes) // num_key_ranges] for i in range(1, num_key_ranges)]
+
+
+class StreamingPredictionProgress():
+    # Durable progress of streaming prediction stored as a local JSON file.
+    # The watermark is the lower bound of the first regret_id range whose predictions are not yet all written,
+    # so after an expired session prediction continues from that range without scanning already predicted data.
+    def __init__(self, path, run_key):
+        self.path = path
+        self.run_key = run_key
+        self._progress = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as handle:
+                self._progress = json.load(handle)
+        self._run_progress = self._progress.setdefault(
+            self.run_key, {'watermark': None, 'done': False})
+
+    @property
+    def watermark(self):
+        return self._run_progress['watermark']
+
+    @property
+    def done(self):
+        return self._run_progress['done']
+
+    def advance(self, watermark):
+        # None watermark means the whole key space has been predicted
+        self._run_progress['watermark'] = watermark
+        self._run_progress['done'] = watermark is None
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as handle:
+            json.dump(self._progress, handle)
+        os.replace(tmp_path, self.path)
+
+
+# read_predictions_filtered_table is not used anymore since progress is tracked with regret_id ranges in progress_path
+# instead of creating a filtered table of not yet predicted rows, it's kept so that existing calls keep working.
+# With num_workers, each key range is read with max_stream_count streams (use at least num_workers) sharded across
+# DataLoader worker processes that tokenize while the model predicts, they build their own read clients with
+# bq_storage_client_kwargs, the keyword arguments bq_storage_client was created with ({} for defaults).
+# With cpu_model_path, a cpu_export.py export of the model is used.
+def run_streaming_prediction(read_predictions_table, read_predictions_filtered_table, save_predictions_table, with_transcript, batch_size, trained_model_checkpoint_path, project_id, bq_client, bq_storage_client, bq_model_timestamp, max_stream_count=1, progress_path=None, num_key_ranges=64, num_workers=0, cpu_model_path=None, bq_storage_client_kwargs=None):
+    from analysis.semsim import data
+    if num_workers and bq_storage_client_kwargs is None:
+        raise ValueError(
+            f'bq_storage_client_kwargs cannot be None with num_workers as worker processes create their own BigQuery Storage clients with it')
     context = {
         'project_id': project_id,
         'bq_client': bq_client,
         'bq_storage_client': bq_storage_client,
+        'bq_storage_client_kwargs': bq_storage_client_kwargs,
     }
-    stream_from_table = read_predictions_table
-    continue_predict = True
+    # model is loaded once so its input columns can be used for column projection of every read session
+    model = cpu_export.load_cpu_model(cpu_model_path) if cpu_model_path else unifiedmodel.RRUM.load_from_checkpoint(
+        trained_model_checkpoint_path, optimizer_config=None)
+    progress_path = progress_path or f'{save_predictions_table}.progress.json'
+    progress = StreamingPredictionProgress(
+        progress_path,
+        run_key=f'{read_predictions_table}/{"with" if with_transcript else "without"}_transcript/{bq_model_timestamp}')
+    key_boundaries = video_id_key_boundaries(num_key_ranges)
     prediction_run = 0
-    while continue_predict:
-        print(f'Start prediction run {prediction_run}')
+    while not progress.done:
+        lower = progress.watermark
+        upper = next((b for b in key_boundaries if lower is None or b > lower), None)
+        print(
+            f'Start prediction run {prediction_run} for regret_id range [{lower}, {upper})')
         pred_data = data.get_xe_predict_data_table_streaming(
-            context, dataset_name='regrets_reporter_analysis', table_name=stream_from_table, with_transcript=with_transcript, get_only_english_data=False)
+            context, dataset_name='regrets_reporter_analysis', table_name=read_predictions_table, with_transcript=with_transcript, get_only_english_data=False, max_stream_count=max_stream_count, selected_fields=model.input_columns(), regret_id_range=(lower, upper), return_stream_sources=num_workers > 0)
         try:
-            predictions_all_batches = run_prediction(pred_data, write_preds_to_bq=True, return_preds=False, batch_size=batch_size, trained_model_checkpoint_path=trained_model_checkpoint_path,
-                                                     bq_client=bq_client, bq_predictions_table=save_predictions_table, bq_model_timestamp=bq_model_timestamp)
-            continue_predict = False
-            print('Streaming prediction finished for all the data')
+            if pred_data is not None:
+                run_prediction(pred_data, write_preds_to_bq=True, return_preds=False, batch_size=batch_size, trained_model_checkpoint_path=trained_model_checkpoint_path,
+                               bq_client=bq_client, bq_predictions_table=save_predictions_table, bq_model_timestamp=bq_model_timestamp, model=model, write_ahead_log_path=f'{progress_path}.wal', num_workers=num_workers)
+            progress.advance(upper)
         except Exception as e:
             if 'session expired' in str(e):
                 print(str(e))
-                create_filtered_predict_table(
-                    read_predictions_filtered_table, read_predictions_table, save_predictions_table, bq_client)
-                stream_from_table = read_predictions_filtered_table
-                prediction_run += 1
-                print('Streaming prediction got session experired exception (BQ 6 hour stream session limit), created new filtered predict table to continue predicting with new session')
+                print(
+                    f'Streaming prediction got session experired exception (BQ 6 hour stream session limit), continuing with new session from regret_id range [{lower}, {upper})')
             else:
                 print(str(e))
                 print(
                     'Streaming prediction got unexpected exception, stopped predicting')
-                continue_predict = False
+                return
+        prediction_run += 1
+    print('Streaming prediction finished for all the data')
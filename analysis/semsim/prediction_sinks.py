@@ -0,0 +1,291 @@
+import hashlib
+import io
+import os
+import queue
+import sqlite3
+import threading
+import time
+import pyarrow
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# fields aren't nullable so Parquet loads match the REQUIRED columns of the BigQuery predictions table
+prediction_schema = pyarrow.schema([
+    pyarrow.field('regret_id', pyarrow.string(), nullable=False),
+    pyarrow.field('recommendation_id', pyarrow.string(), nullable=False),
+    pyarrow.field('prediction', pyarrow.float64(), nullable=False),
+    pyarrow.field('model_timestamp', pyarrow.timestamp(
+        'us', tz='UTC'), nullable=False),
+])
+
+
+def prediction_keys(table):
+    # deterministic (regret_id, recommendation_id, model_timestamp) key of each prediction row
+    return pc.binary_join_element_wise(table['regret_id'], table['recommendation_id'], pc.cast(table['model_timestamp'], pyarrow.string()), '/')
+
+
+def batch_id(table):
+    # deterministic id of a batch of predictions, the same rows give the same id
+    key = hashlib.sha256()
+    for prediction_key in sorted(prediction_keys(table).to_pylist()):
+        key.update(prediction_key.encode('utf-8'))
+        key.update(b'\n')
+    return key.hexdigest()[:32]
+
+
+# Sinks receive predictions as pyarrow Tables with prediction_schema. They can be used with AsyncPredictionWriter
+# and RRUMPredictionWriter, local sinks allow running prediction without BigQuery e.g. when testing.
+# Writing the same batch_id again must not duplicate rows so failed or interrupted writes can be retried.
+class BigQueryLoadJobSink():
+    # appends predictions to BigQuery table with Parquet load jobs, which unlike streaming inserts are free
+    # but limited to 1500 jobs per table per day so flush in large enough chunks
+    # load job ids are derived from batch_id, BigQuery refuses to run a job id twice so a batch is loaded at most once
+    # jobs are looked up and run in location, by default the location of bq_table, since BigQuery doesn't find jobs
+    # outside the US and EU multi-regions without it. After max_conflicts Conflicts of job ids that still can't be
+    # found, Conflict is raised so the write is retried with the backoff of AsyncPredictionWriter.
+    def __init__(self, bq_client, bq_table, job_id_prefix='rrum_predictions', location=None, max_conflicts=3):
+        self.bq_client = bq_client
+        self.bq_table = bq_table
+        self.job_id_prefix = job_id_prefix
+        self.location = location
+        self.max_conflicts = max_conflicts
+
+    def _location(self):
+        if self.location is None:
+            self.location = self.bq_client.get_table(self.bq_table).location
+        return self.location
+
+    def write(self, table, batch_id):
+        from google.cloud import bigquery
+        from google.api_core.exceptions import Conflict, NotFound
+        location = self._location()
+        attempt = 0
+        conflicts = 0
+        while True:
+            job_id = f'{self.job_id_prefix}_{batch_id}_{attempt}'
+            try:
+                job = self.bq_client.get_job(job_id, location=location)
+            except NotFound:
+                job = None
+            if job is not None:
+                if job.state != 'DONE':
+                    try:
+                        job.result()
+                    except Exception:
+                        pass  # error_result of the job is checked below
+                if job.error_result is None:
+                    return  # batch is already loaded
+                attempt += 1  # earlier load of the batch failed, load again with the next job id
+                continue
+            buffer = io.BytesIO()
+            pq.write_table(table, buffer)
+            buffer.seek(0)
+            job_config = bigquery.LoadJobConfig(
+                source_format=bigquery.SourceFormat.PARQUET,
+                write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+            )
+            try:
+                self.bq_client.load_table_from_file(
+                    buffer, self.bq_table, job_id=job_id, location=location, job_config=job_config).result()
+                return
+            except Conflict:
+                conflicts += 1
+                if conflicts >= self.max_conflicts:
+                    raise
+                # job was created by an earlier try, check its result
+
+    def close(self):
+        pass
+
+
+class ParquetSink():
+    # writes every flush into its own Parquet file in directory path
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    def write(self, table, batch_id):
+        # file name comes from batch_id so writing a batch again replaces the same file
+        tmp_file = os.path.join(self.path, f'.part-{batch_id}.tmp')
+        pq.write_table(table, tmp_file)
+        os.replace(tmp_file, os.path.join(
+            self.path, f'part-{batch_id}.parquet'))
+
+    def close(self):
+        pass
+
+
+class SQLiteSink():
+    def __init__(self, path, table_name='predictions'):
+        self.table_name = table_name
+        # writes happen in the writer thread
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            f'CREATE TABLE IF NOT EXISTS {self.table_name} (regret_id TEXT NOT NULL, recommendation_id TEXT NOT NULL, prediction REAL NOT NULL, model_timestamp TEXT NOT NULL, PRIMARY KEY (regret_id, recommendation_id, model_timestamp))')
+
+    def write(self, table, batch_id):
+        rows = zip(table['regret_id'].to_pylist(), table['recommendation_id'].to_pylist(), table['prediction'].to_pylist(),
+                   [ts.isoformat() for ts in table['model_timestamp'].to_pylist()])
+        with self.connection:
+            self.connection.executemany(
+                f'INSERT OR IGNORE INTO {self.table_name} VALUES (?, ?, ?, ?)', rows)
+
+    def close(self):
+        self.connection.close()
+
+
+class PredictionWriteAheadLog():
+    # Local SQLite log of prediction batches and keys of predictions written to a sink.
+    # Batches are logged as Parquet files before writing and marked committed after the sink has written them,
+    # so batches of a crashed or interrupted run can be written again and already written keys are never written twice.
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.join(self.path, 'batches'), exist_ok=True)
+        # used from the writer thread
+        self.connection = sqlite3.connect(os.path.join(
+            self.path, 'wal.sqlite'), check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS batches (batch_id TEXT PRIMARY KEY, committed INTEGER NOT NULL)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS prediction_keys (prediction_key TEXT PRIMARY KEY) WITHOUT ROWID')
+
+    def _batch_file(self, batch_id):
+        return os.path.join(self.path, 'batches', f'{batch_id}.parquet')
+
+    def filter_new(self, table):
+        # drop rows whose key has already been written or appears earlier in the same table
+        keys = prediction_keys(table).to_pylist()
+        written = set()
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            written.update(row[0] for row in self.connection.execute(
+                f'SELECT prediction_key FROM prediction_keys WHERE prediction_key IN ({",".join("?" * len(chunk))})', chunk))
+        seen = set()
+        mask = []
+        for key in keys:
+            mask.append(key not in written and key not in seen)
+            seen.add(key)
+        return table.filter(pyarrow.array(mask, type=pyarrow.bool_()))
+
+    def log(self, table):
+        id_ = batch_id(table)
+        tmp_file = f'{self._batch_file(id_)}.tmp'
+        pq.write_table(table, tmp_file)
+        os.replace(tmp_file, self._batch_file(id_))
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR IGNORE INTO batches VALUES (?, 0)', (id_,))
+        return id_
+
+    def commit(self, batch_id, table):
+        with self.connection:
+            self.connection.executemany('INSERT OR IGNORE INTO prediction_keys VALUES (?)', (
+                (key,) for key in prediction_keys(table).to_pylist()))
+            self.connection.execute(
+                'UPDATE batches SET committed = 1 WHERE batch_id = ?', (batch_id,))
+        os.remove(self._batch_file(batch_id))
+
+    def pending(self):
+        for (id_,) in self.connection.execute('SELECT batch_id FROM batches WHERE committed = 0').fetchall():
+            if os.path.exists(self._batch_file(id_)):
+                yield id_, pq.read_table(self._batch_file(id_), schema=prediction_schema)
+
+    def close(self):
+        self.connection.close()
+
+
+class AsyncPredictionWriter():
+    # Accumulates predictions in columnar buffers and writes them to sink from a background thread when
+    # flush_rows rows have been buffered or flush_interval seconds have passed since the last flush.
+    # At most max_pending_flushes flushes wait for the sink so memory stays bounded when the sink is slower.
+    # Failed writes are retried max_retries times with exponential backoff, after that the error is raised on the next append or close.
+    # With write_ahead_log, batches left unwritten by an earlier run are written first and rows already written are skipped.
+    def __init__(self, sink, flush_rows=100000, flush_interval=300, max_pending_flushes=2, write_ahead_log=None, max_retries=5, retry_backoff=1, max_retry_backoff=60):
+        self.sink = sink
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.write_ahead_log = write_ahead_log
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+        self.total_rows_written = 0
+        self._buffers = []
+        self._buffered_rows = 0
+        self._last_flush = time.monotonic()
+        self._error = None
+        self._pending = queue.Queue(maxsize=max_pending_flushes)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _write(self, table, id_):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.sink.write(table, id_)
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                backoff = min(self.retry_backoff * 2 ** attempt,
+                              self.max_retry_backoff)
+                print(
+                    f'Writing predictions failed ({e}), retrying in {backoff} seconds')
+                time.sleep(backoff)
+
+    def _write_logged(self, table, id_=None):
+        if self.write_ahead_log is None:
+            self._write(table, id_ or batch_id(table))
+        else:
+            if id_ is None:
+                table = self.write_ahead_log.filter_new(table)
+                if not table.num_rows:
+                    return
+                id_ = self.write_ahead_log.log(table)
+            self._write(table, id_)
+            self.write_ahead_log.commit(id_, table)
+        self.total_rows_written += table.num_rows
+
+    def _run(self):
+        try:
+            if self.write_ahead_log is not None:
+                for id_, table in self.write_ahead_log.pending():
+                    self._write_logged(table, id_)
+        except Exception as e:
+            self._error = e
+        while True:
+            table = self._pending.get()
+            if table is None:
+                return
+            try:
+                if self._error is None:
+                    self._write_logged(table)
+            except Exception as e:
+                self._error = e
+
+    def _raise_error(self):
+        # errors are kept so that nothing is written after a failed flush
+        if self._error is not None:
+            raise self._error
+
+    def append(self, batch):
+        # batch is a pyarrow RecordBatch with prediction_schema
+        self._raise_error()
+        self._buffers.append(batch)
+        self._buffered_rows += batch.num_rows
+        if self._buffered_rows >= self.flush_rows or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self._buffers:
+            self._pending.put(pyarrow.Table.from_batches(
+                self._buffers, schema=prediction_schema))
+        self._buffers = []
+        self._buffered_rows = 0
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        # flush remaining predictions and wait until the sink has written everything, the sink itself is left open
+        self.flush()
+        self._pending.put(None)
+        self._thread.join()
+        self._raise_error()
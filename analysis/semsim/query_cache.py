@@ -0,0 +1,102 @@
+import hashlib
+import os
+import re
+import time
+import pyarrow
+
+_table_id_regex = re.compile(r'`([\w\-]+\.[\w\-]+\.[\w\-]+)`')
+# tables a view query reads, with or without backticks and project
+_view_table_id_regex = re.compile(
+    r'\b(?:FROM|JOIN)\s+`?([\w\-]+(?:\.[\w\-]+){1,2})`?', re.IGNORECASE)
+
+
+class QueryCache():
+    # Local cache of BigQuery query results stored as uncompressed Arrow IPC (Feather v2) files.
+    # Results are keyed by the rendered SQL and the versions (last modified time and row count) of tables referenced
+    # in it, so the same query with the same flags hits the cache until one of its source tables changes. A view's
+    # modified time only changes with its definition, so views are versioned by the base tables their queries read.
+    # Computing a key takes a get_table metadata call per referenced table and base table of views, but no query.
+    # Versions are kept in memory for metadata_ttl seconds so repeated keys in a run don't call BigQuery again, a
+    # table changed within that time is noticed only after it.
+    # Cached files are memory-mapped so reading columns or batches doesn't load the whole result into RAM.
+    def __init__(self, path, metadata_ttl=60):
+        self.path = path
+        self.metadata_ttl = metadata_ttl
+        self._table_versions = {}
+        os.makedirs(self.path, exist_ok=True)
+
+    def _table_version(self, bq_client, table_id):
+        cached = self._table_versions.get(table_id)
+        if cached is not None and time.monotonic() - cached[0] < self.metadata_ttl:
+            return cached[1]
+        table = bq_client.get_table(table_id)
+        if table.table_type == 'VIEW':
+            project = table_id.split('.')[0]
+            base_table_ids = sorted(set(base_table_id if base_table_id.count('.') == 2 else f'{project}.{base_table_id}'
+                                        for base_table_id in _view_table_id_regex.findall(table.view_query or '')))
+            version = f'view@{table.modified.isoformat()}' + ''.join(
+                f'|{base_table_id}@{self._base_table_version(bq_client, base_table_id)}' for base_table_id in base_table_ids)
+        else:
+            version = f'{table.modified.isoformat()}/{table.num_rows}'
+        self._table_versions[table_id] = (time.monotonic(), version)
+        return version
+
+    def _base_table_version(self, bq_client, table_id):
+        # names matched in view queries can also be e.g. columns of EXTRACT(... FROM t.column), they aren't tables
+        from google.api_core.exceptions import NotFound
+        try:
+            return self._table_version(bq_client, table_id)
+        except NotFound:
+            return None
+
+    def key(self, bq_client, query, query_parameters=None):
+        key = hashlib.sha256(' '.join(query.split()).encode('utf-8'))
+        for table_id in sorted(set(_table_id_regex.findall(query))):
+            key.update(
+                f'{table_id}@{self._table_version(bq_client, table_id)}'.encode('utf-8'))
+        for param in (query_parameters or []):
+            key.update(repr(param.to_api_repr()).encode('utf-8'))
+        return key.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, f'{key}.arrow')
+
+    def __contains__(self, key):
+        return os.path.exists(self._file(key))
+
+    def reader(self, key):
+        return pyarrow.ipc.open_file(pyarrow.memory_map(self._file(key), 'r'))
+
+    def read_table(self, key, columns=None):
+        table = self.reader(key).read_all()
+        return table.select(columns) if columns else table
+
+    def read_batches(self, key):
+        reader = self.reader(key)
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i)
+
+    def write_batches(self, key, batches):
+        # write batches to the cache while passing them through, the cache file only appears when all batches were written
+        tmp_file = f'{self._file(key)}.{os.getpid()}.tmp'
+        writer = None
+        try:
+            for batch in batches:
+                if writer is None:
+                    writer = pyarrow.ipc.new_file(tmp_file, batch.schema)
+                writer.write_batch(batch)
+                yield batch
+            if writer is not None:
+                writer.close()
+                writer = None
+                os.replace(tmp_file, self._file(key))
+        finally:
+            if writer is not None:
+                writer.close()
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def write_table(self, key, table):
+        for _ in self.write_batches(key, table.to_batches()):
+            pass
+        return table
@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+import pyarrow
+import pyarrow.compute as pc
+
+
+class VideoEmbeddings():
+    # Embeddings of one embedding type (e.g. title) for a set of videos kept in one contiguous float32 matrix.
+    # Rows of videos without an embedding are filled with NaN and marked invalid so their similarities become null.
+    def __init__(self, video_ids, vectors, valid=None):
+        self.index = pd.Index(video_ids)
+        self.vectors = vectors
+        self.valid = np.asarray(valid, dtype=bool) if valid is not None else np.ones(
+            len(self.index), dtype=bool)
+        if len(self.index) != len(self.vectors) or len(self.index) != len(self.valid):
+            raise ValueError(
+                f'Got {len(self.index)} video ids, {len(self.vectors)} vectors and {len(self.valid)} valid flags when they should be equal')
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def dim(self):
+        return self.vectors.shape[1]
+
+    @classmethod
+    def from_arrow(cls, table, embedding_col, video_id_col='video_id'):
+        vectors, valid = list_column_to_matrix(table[embedding_col])
+        return cls(table[video_id_col].to_pylist(), vectors, valid)
+
+    def rows(self, video_ids):
+        # row index of each video id, -1 for videos without valid embedding
+        rows = self.index.get_indexer(video_ids)
+        found = rows >= 0
+        rows[found] = np.where(self.valid[rows[found]], rows[found], -1)
+        return rows
+
+
+def list_column_to_matrix(column):
+    # convert pyarrow list<float> column into a (rows, dim) float32 matrix without python loops
+    if isinstance(column, pyarrow.ChunkedArray):
+        column = column.combine_chunks() if column.num_chunks else pyarrow.array(
+            [], type=column.type)
+    lengths = pc.fill_null(pc.list_value_length(column), 0).to_numpy(
+        zero_copy_only=False)
+    dim = int(lengths.max()) if len(lengths) else 0
+    valid = (lengths == dim) & (dim > 0)
+    matrix = np.full((len(column), dim), np.nan, dtype=np.float32)
+    if valid.any():
+        values = pc.list_flatten(column.filter(pyarrow.array(valid)))
+        matrix[valid] = values.to_numpy(
+            zero_copy_only=False).astype(np.float32).reshape(-1, dim)
+    return matrix, valid
+
+
+def pair_cosine_similarity(embeddings, regret_ids, recommendation_ids, batch_size=65536):
+    # Cosine similarity of each (regret, recommendation) pair computed as a batched row-dot over gathered rows.
+    # Only batch_size pairs are materialized at once so memory stays bounded for millions of pairs.
+    regret_rows = embeddings.rows(regret_ids)
+    recommendation_rows = embeddings.rows(recommendation_ids)
+    missing = (regret_rows < 0) | (recommendation_rows < 0)
+    similarities = np.full(len(regret_rows), np.nan, dtype=np.float32)
+    present = np.flatnonzero(~missing)
+    for start in range(0, len(present), batch_size):
+        pairs = present[start:start + batch_size]
+        regret_vectors = np.asarray(
+            embeddings.vectors[regret_rows[pairs]], dtype=np.float32)
+        recommendation_vectors = np.asarray(
+            embeddings.vectors[recommendation_rows[pairs]], dtype=np.float32)
+        dots = np.einsum('ij,ij->i', regret_vectors, recommendation_vectors)
+        norms = np.linalg.norm(regret_vectors, axis=1) * \
+            np.linalg.norm(recommendation_vectors, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            similarities[pairs] = dots / norms  # zero vector gives NaN like in BigQuery
+    return similarities, missing
+
+
+def add_pair_similarities(pairs, video_embeddings, batch_size=65536):
+    # Append <embedding_type>_sim columns to pyarrow Table or RecordBatch of pairs, missing embeddings become null
+    regret_ids = pairs.column('regret_id').to_pylist()
+    recommendation_ids = pairs.column('recommendation_id').to_pylist()
+    arrays = {name: pairs.column(name) for name in pairs.schema.names}
+    for embedding_type, embeddings in video_embeddings.items():
+        similarities, missing = pair_cosine_similarity(
+            embeddings, regret_ids, recommendation_ids, batch_size=batch_size)
+        arrays[f'{embedding_type}_sim'] = pyarrow.array(
+            similarities.astype(np.float64), mask=missing)
+    if isinstance(pairs, pyarrow.RecordBatch):
+        return pyarrow.RecordBatch.from_pydict(arrays)
+    return pyarrow.Table.from_pydict(arrays)
@@ -0,0 +1,127 @@
+import time
+_import_started = time.perf_counter()
+import argparse
+import contextlib
+import json
+import sys
+import torch
+from torch import nn
+from .utils import mmap_weights
+import_seconds = time.perf_counter() - _import_started
+
+# Slim prediction entry point with a fast cold start for RRUM checkpoints. Only torch is imported with this module and
+# transformers when a model is loaded, Lightning, datasets, torchmetrics and BigQuery clients are never imported.
+# The model is built from the transformer config with parameters on meta device, and the checkpoint weights are assigned
+# straight into it from a Lightning checkpoint or a memory-mapped safetensors file (see save_safetensors).
+# Usage: python -m analysis.semsim.slim_prediction <checkpoint> --data <pairs parquet> --output <predictions parquet>
+
+_hyper_parameters = ['text_types', 'scalar_features',
+                     'cross_encoder_model_name_or_path']
+
+
+@contextlib.contextmanager
+def _timed(timings, key):
+    start = time.perf_counter()
+    yield
+    timings[key] = time.perf_counter() - start
+
+
+class SlimRRUM(nn.Module):
+    # Inference-only RRUM with the same modules and forward, so RRUM checkpoint weights load into it as is
+    def __init__(self, text_types, scalar_features, cross_encoder_model_name_or_path):
+        super().__init__()
+        from transformers import AutoConfig, AutoModelForSequenceClassification
+        from transformers.modeling_utils import no_init_weights
+        self.text_types = text_types
+        self.scalar_features = scalar_features
+        self.cross_encoder_model_name_or_path = cross_encoder_model_name_or_path
+        config = AutoConfig.from_pretrained(cross_encoder_model_name_or_path)
+        with no_init_weights():  # weights come from the checkpoint
+            self.cross_encoders = nn.ModuleDict({t: AutoModelForSequenceClassification.from_config(
+                config) for t in self.text_types})
+        self.lin1 = nn.Linear(len(self.text_types) * config.num_labels +
+                              len(self.scalar_features), 1)
+
+    def forward(self, x):
+        cross_logits = [self.cross_encoders[f](**{key.split(f'{f}_')[1]: x[key] for key in x if f in key}).logits
+                        for f in self.text_types]
+        return self.lin1(torch.cat(cross_logits + [x[scalar][:, None] for scalar in self.scalar_features], 1))
+
+
+def read_checkpoint(checkpoint_path):
+    # (state dict, hyperparameters) of a Lightning checkpoint or of a safetensors file written by save_safetensors,
+    # safetensors files are memory-mapped instead of unpickled
+    if checkpoint_path.endswith('.safetensors'):
+        state_dict, metadata = mmap_weights.load_safetensors_mmap(checkpoint_path)
+        return state_dict, json.loads(metadata['hyper_parameters'])
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    return checkpoint['state_dict'], checkpoint['hyper_parameters']
+
+
+def save_safetensors(checkpoint_path, output_path):
+    # weights and hyperparameters of a Lightning checkpoint as a safetensors file, without optimizer states
+    state_dict, hyper_parameters = read_checkpoint(checkpoint_path)
+    mmap_weights.save_safetensors({key: value for key, value in state_dict.items() if not key.startswith('loss.')}, output_path, metadata={
+                                  'hyper_parameters': json.dumps({key: hyper_parameters[key] for key in _hyper_parameters})})
+
+
+def load_slim_model(checkpoint_path, timings=None):
+    timings = {} if timings is None else timings
+    with _timed(timings, 'read_checkpoint_seconds'):
+        state_dict, hyper_parameters = read_checkpoint(checkpoint_path)
+    with _timed(timings, 'build_model_seconds'), mmap_weights.meta_device_parameters():
+        model = SlimRRUM(
+            **{key: hyper_parameters[key] for key in _hyper_parameters})
+    with _timed(timings, 'load_weights_seconds'):
+        # loss.pos_weight of trained RRUM is the only state not needed for predicting
+        mmap_weights.assign_state_dict(
+            model, state_dict, ignore_prefixes=['loss.'])
+    return model.eval()
+
+
+def load_slim_predictor(checkpoint_path, max_length=128, clean_text=False, device=None):
+    # (inference_server.PairScorer of the checkpoint, dict of import and load timings in seconds)
+    timings = {'import_seconds': import_seconds}
+    with _timed(timings, 'import_transformers_seconds'):
+        from .inference_server import PairScorer
+    model = load_slim_model(checkpoint_path, timings)
+    with _timed(timings, 'load_tokenizer_seconds'):
+        scorer = PairScorer(model, max_length=max_length,
+                            clean_text=clean_text, device=device)
+    return scorer, timings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Predict video pairs with a RRUM checkpoint without Lightning and BigQuery')
+    parser.add_argument('checkpoint_path')
+    parser.add_argument('--data', help='Parquet file of video pairs')
+    parser.add_argument('--output', help='Parquet file for predictions')
+    parser.add_argument('--save-safetensors',
+                        help='Convert the checkpoint into a safetensors file instead of predicting')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--max-length', type=int, default=128)
+    parser.add_argument('--clean-text', action='store_true')
+    args = parser.parse_args()
+    if args.save_safetensors:
+        save_safetensors(args.checkpoint_path, args.save_safetensors)
+        sys.exit(0)
+    if not args.data or not args.output:
+        parser.error('--data and --output are needed for predicting')
+    scorer, timings = load_slim_predictor(
+        args.checkpoint_path, max_length=args.max_length, clean_text=args.clean_text)
+    import pyarrow
+    import pyarrow.parquet
+    pairs = pyarrow.parquet.read_table(args.data, columns=['regret_id', 'recommendation_id'] + [
+                                       f'{side}_{t}' for t in scorer.model.text_types for side in ['regret', 'recommendation']] + scorer.model.scalar_features)
+    predictions = []
+    for batch in pairs.to_batches(max_chunksize=args.batch_size):
+        if predictions:
+            predictions.extend(scorer(batch.to_pylist()))
+            continue
+        with _timed(timings, 'first_prediction_seconds'):
+            predictions.extend(scorer(batch.to_pylist()))
+        timings['time_to_first_prediction_seconds'] = time.perf_counter() - _import_started
+    pyarrow.parquet.write_table(pyarrow.table({'regret_id': pairs.column('regret_id'), 'recommendation_id': pairs.column(
+        'recommendation_id'), 'prediction': pyarrow.array(predictions, type=pyarrow.float64())}), args.output)
+    print(json.dumps(timings, indent=2), file=sys.stderr)
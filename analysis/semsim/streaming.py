@@ -0,0 +1,97 @@
+import copy
+import itertools
+import pyarrow
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+
+def is_read_rows_iterable(data):
+    # BigQuery Storage client is imported only when data comes from it, so models can be loaded without it
+    if not type(data).__module__.startswith('google.cloud.bigquery_storage'):
+        return False
+    from google.cloud.bigquery_storage_v1.reader import ReadRowsIterable
+    return isinstance(data, ReadRowsIterable)
+
+
+def rebatch(tables, num_rows):
+    # regroup pyarrow Tables/RecordBatches of any size into Tables of num_rows rows, the last one can be smaller
+    pending = None
+    for table in tables:
+        if isinstance(table, pyarrow.RecordBatch):
+            table = pyarrow.Table.from_batches([table])
+        if not table.num_rows:
+            continue
+        pending = table if pending is None else pyarrow.concat_tables([
+            pending, table])
+        while pending.num_rows >= num_rows:
+            yield pending.slice(0, num_rows)
+            pending = pending.slice(num_rows)
+    if pending is not None and pending.num_rows:
+        yield pending
+
+
+class RecordBatchSources():
+    # Shardable streaming data: picklable callables that each return an iterable of RecordBatches, e.g. one per
+    # BigQuery Storage read stream, and the Arrow schema of their batches. RecordBatchStream splits the sources
+    # across DataLoader worker processes so reading and tokenization of the shards run in parallel.
+    def __init__(self, sources, schema):
+        self.sources = list(sources)
+        self.schema = schema
+
+    def __len__(self):
+        return len(self.sources)
+
+
+class RecordBatchStream(IterableDataset):
+    # Streaming dataset that keeps Arrow data as the unit of work from BigQuery to tensor batches.
+    # Incoming RecordBatches are filtered with filter_fn, regrouped into batch_size rows and encoded
+    # into dicts of tensors with encode_fn, so use it with DataLoader(..., batch_size=None).
+    # With group_by_length, batch_size * bucket_batches rows are encoded at once and split into batches of
+    # rows with similar token counts. A generator of RecordBatches can be iterated once and only without DataLoader
+    # workers, RecordBatchSources are read again on each iteration and sharded across workers.
+    def __init__(self, record_batches, filter_fn, encode_fn, batch_size=1000, text_types=None, group_by_length=False, bucket_batches=50):
+        self.record_batches = record_batches
+        self.filter_fn = filter_fn
+        self.encode_fn = encode_fn
+        self.batch_size = batch_size
+        self.text_types = text_types or []
+        self.group_by_length = group_by_length
+        self.bucket_batches = bucket_batches
+
+    def with_options(self, **options):
+        # copy of the stream with e.g. another batch_size
+        stream = copy.copy(self)
+        for key, value in options.items():
+            setattr(stream, key, value)
+        return stream
+
+    def _split(self, encoded, num_rows):
+        if not self.group_by_length:
+            for start in range(0, num_rows, self.batch_size):
+                yield {key: value[start:start + self.batch_size] for key, value in encoded.items()}
+            return
+        lengths = sum(encoded[f'{t}_attention_mask'].sum(dim=1)
+                      for t in self.text_types)
+        order = torch.argsort(lengths, descending=True)
+        for start in range(0, num_rows, self.batch_size):
+            rows = order[start:start + self.batch_size]
+            yield {key: value[rows] if isinstance(value, torch.Tensor) else [value[i] for i in rows.tolist()] for key, value in encoded.items()}
+
+    def _worker_record_batches(self):
+        worker_info = get_worker_info()
+        if isinstance(self.record_batches, RecordBatchSources):
+            sources = self.record_batches.sources
+            if worker_info is not None:
+                sources = sources[worker_info.id::worker_info.num_workers]
+            return itertools.chain.from_iterable(source() for source in sources)
+        if worker_info is not None and worker_info.num_workers > 1:
+            raise ValueError(
+                'A generator of RecordBatches cannot be shared by DataLoader workers, use RecordBatchSources to shard the data')
+        return self.record_batches
+
+    def __iter__(self):
+        bucket_rows = self.batch_size * \
+            (self.bucket_batches if self.group_by_length else 1)
+        filtered = (self.filter_fn(batch) for batch in self._worker_record_batches())
+        for table in rebatch(filtered, bucket_rows):
+            yield from self._split(self.encode_fn(table), table.num_rows)
@@ -0,0 +1,72 @@
+import random
+import pytest
+from analysis.semsim.utils.text_cleaning import clean_text, clean_texts, compare_with_reference, reference_clean_text_funcs
+
+# clean_text must clean texts exactly like the original composition of the cleaning functions
+
+edge_cases = [
+    '',
+    ' ',
+    'plain text',
+    # HTML entities and fix_html replacements
+    'Tom &amp; Jerry &quot;cartoon&quot; &#39;classic&#39; &#146;s &nbsp;x &#36;5',
+    'amp; quot; #39; nbsp; &lt;b&gt;bold&lt;/b&gt; &eacute;t&eacute; &#x1F600;',
+    'line\\nbreak <br /> <unk> 3 @.@ 5 and well @-@ known... wait...',
+    'escaped \\"quote\\" and &amp;amp; double',
+    # user handles
+    'hello @<user> and @user_1 and @@x and x@y and mail@example.com',
+    '@a@b@c @<user>@<user> @ lone @_ @123456789012345678 end@',
+    '(@handle) [@other] @handle.@next',
+    # URLs
+    'see https://example.com/path?a=1&b=2#frag and www.test.org/x&y and foo.bar',
+    'http://a.b.co.uk/~x?y=z&amp;w=1 ftp://host.io a.b c.de',
+    'dots... e.g. i.e. U.S.A. 3.14 v1.2.3 file.tar.gz',
+    # tags
+    '<A href="x">link</A> </A> <Tag>News</Tag> <ref name=x>cite</ref> <a href=y>z</a>',
+    '<B> </B> <lower> < A> <A <a>>',
+    # control, zero-width and other characters
+    'tab\there\r\nnew\nline\x00null\x07bell\x1besc',
+    'zero\u200bwidth\u200cnon\u200djoiner\ufeffbom\u2060word \u00adsoft',
+    'private \U0001f600 emoji \u2028line\u2029para \x85nel',
+    # punctuation standardisation
+    '‘quoted’ “double” ´acute´ en–dash em\u2014dash -hyphen',
+    # repeated words and punctuation
+    'the the the cat sat sat on on the mat mat',
+    'wow!!! really??? ok... ,,, ;; -- ** ## $$ ((()))',
+    'Hello hello Hello HELLO word word. word word',
+    'a a a a b b c c c d',
+    '   multiple    spaces \n\n and \t\t tabs   ',
+]
+
+_pieces = ['a', 'b', 'the', ' ', '  ', '\n', '\t', '\r', '.', '...', '!', '?', ',', '@', '@<user>', '@user', 'x@y', '#',
+           '&', '&amp;', 'amp;', '&quot;', '#39;', 'nbsp;', '<', '>', '</', '<A>', '</A>', '<a href=x>', '</a>', '<ref x>',
+           '<br />', '<unk>', ' @.@ ', ' @-@ ', 'http://', 'https://', 'www.', '.com', 'example.org/p?q=1&r=2', '/',
+           ':', '-', '_', '=', '‘', '’', '“', '”', '–', '´', '\u200b', '\ufeff', '\x00', '\x1b', '\u00ad', 'é', '日本',
+           '\U0001f600', '\\n', '\\"', 'word word', 'A', 'Z9']
+
+
+def random_corpus(n, seed=42):
+    rng = random.Random(seed)
+    return [''.join(rng.choice(_pieces) for _ in range(rng.randint(0, 40))) for _ in range(n)]
+
+
+@pytest.mark.parametrize('text', edge_cases)
+def test_edge_case_matches_reference(text):
+    assert clean_text(text) == reference_clean_text_funcs(text)[0]
+
+
+def test_batch_matches_reference():
+    assert clean_texts(edge_cases) == reference_clean_text_funcs(edge_cases)
+
+
+def test_random_corpus_matches_reference():
+    assert compare_with_reference(random_corpus(5000)) == []
+
+
+def test_duplicate_texts_are_cleaned_like_unique_texts():
+    texts = edge_cases + edge_cases[::-1]
+    assert clean_texts(texts) == reference_clean_text_funcs(texts)
+
+
+def test_string_input():
+    assert clean_texts('a a  b!!') == reference_clean_text_funcs('a a  b!!')
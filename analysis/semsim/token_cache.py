@@ -0,0 +1,98 @@
+import fcntl
+import hashlib
+import json
+import os
+import numpy as np
+
+
+class TokenCache():
+    # Persistent cache of tokenized (regret, recommendation) text pairs for one tokenizer, max_length and clean_text setting.
+    # Each tokenizer output (e.g. input_ids and attention_mask) is stored padded to max_length in its own
+    # fixed-width file that is read with np.memmap, and <path>/keys holds the text pair hashes, one per row.
+    # Like EmbeddingStore, rows are written before keys so interrupted appends are ignored. Appends are locked
+    # so datasets.map worker processes can share the cache.
+    _dtypes = {'attention_mask': np.uint8,
+               'token_type_ids': np.uint8, 'special_tokens_mask': np.uint8}
+
+    def __init__(self, path, tokenizer, max_length, clean_text):
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        namespace = {'tokenizer': tokenizer.name_or_path,
+                     'max_length': max_length, 'clean_text': clean_text}
+        self.path = os.path.join(path, hashlib.sha256(json.dumps(
+            namespace, sort_keys=True).encode('utf-8')).hexdigest()[:16])
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, 'namespace.json'), 'w') as handle:
+            json.dump(namespace, handle)
+        self.output_names = list(tokenizer.model_input_names)
+        self._rows = {}
+        self._keys_offset = 0
+        self._refresh()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _dtype(self, output_name):
+        return self._dtypes.get(output_name, np.int32)
+
+    def _refresh(self):
+        # read keys appended by other processes since the last refresh, only complete lines so a key that another
+        # process is still writing is read on a later refresh
+        if not os.path.exists(self._file('keys')):
+            return
+        with open(self._file('keys'), 'rb') as handle:
+            handle.seek(self._keys_offset)
+            data = handle.read()
+        complete = data.rfind(b'\n') + 1
+        for key in data[:complete].decode('ascii').splitlines():
+            self._rows[key] = len(self._rows)
+        self._keys_offset += complete
+
+    @staticmethod
+    def key(regret_text, recommendation_text):
+        return hashlib.blake2b(f'{regret_text}\0{recommendation_text}'.encode('utf-8'), digest_size=16).hexdigest()
+
+    def _read(self, rows):
+        if not rows:
+            return {name: np.empty((0, self.max_length), dtype=self._dtype(name)) for name in self.output_names}
+        n_rows = len(self._rows)
+        return {name: np.asarray(np.memmap(self._file(name), dtype=self._dtype(name), mode='r', shape=(n_rows, self.max_length))[rows]) for name in self.output_names}
+
+    def _append(self, keys, encoded):
+        with open(self._file('lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._refresh()
+            new_rows = [i for i, key in enumerate(
+                keys) if key not in self._rows]
+            if new_rows:
+                n_rows = len(self._rows)
+                for name in self.output_names:
+                    with open(self._file(name), 'ab') as handle:
+                        row_bytes = self.max_length * \
+                            np.dtype(self._dtype(name)).itemsize
+                        handle.truncate(n_rows * row_bytes)
+                        handle.write(np.ascontiguousarray(
+                            encoded[name][new_rows], dtype=self._dtype(name)).tobytes())
+                with open(self._file('keys'), 'ab') as handle:
+                    # a partial line left by a crashed append is overwritten, it has no complete key
+                    handle.truncate(self._keys_offset)
+                    handle.write(''.join(
+                        f'{keys[i]}\n' for i in new_rows).encode('ascii'))
+                self._refresh()
+
+    def __call__(self, regret_texts, recommendation_texts):
+        # tokenize text pairs like tokenizer(..., padding='max_length', truncation=True) and return numpy arrays
+        keys = [self.key(regret, recommendation) for regret, recommendation in zip(
+            regret_texts, recommendation_texts)]
+        self._refresh()
+        missing = list(
+            dict.fromkeys(key for key in keys if key not in self._rows))
+        if missing:
+            first_index = {key: i for i, key in reversed(list(enumerate(keys)))}
+            encoded = self.tokenizer([regret_texts[first_index[key]] for key in missing], [recommendation_texts[first_index[key]] for key in missing],
+                                     padding='max_length', truncation=True, max_length=self.max_length, return_tensors='np')
+            self._append(missing, encoded)
+        return self._read([self._rows[key] for key in keys])
@@ -0,0 +1,214 @@
+import hashlib
+import os
+import numpy as np
+import torch
+from .embedding_store import EmbeddingStore
+from .similarity import list_column_to_matrix
+from .utils import arrow_processing
+from .utils.text_cleaning import clean_text_funcs
+from .utils.text_truncation import TokenBudgetTruncator
+from .transcript_chunks import TranscriptChunker
+
+
+def checkpoint_version(checkpoint_path):
+    # short content hash of a model checkpoint so embeddings of different model versions are stored separately
+    key = hashlib.sha256()
+    with open(checkpoint_path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(1 << 24), b''):
+            key.update(chunk)
+    return key.hexdigest()[:16]
+
+
+def tower_embedding_store(path, model, model_version):
+    # EmbeddingStore of single video embeddings of RRUMV2 model's text types under <path>/<model_version>,
+    # <text_type>_tokens types hold the amount of tokens each embedding was pooled over
+    return EmbeddingStore(os.path.join(path, model_version), model.text_types + [f'{t}_tokens' for t in model.text_types])
+
+
+class VideoTowerEncoder():
+    # Encodes single videos with the Transformer + mean Pooling towers of a trained RRUMV2, one embedding per text type.
+    # Texts are cut to the token budget of a single text (and optionally cleaned) like in RRUMDatasetV2 and batched in
+    # length order so batches contain little padding. Videos without text get an invalid (NaN) embedding.
+    # Transcripts of a model with transcript_chunking are encoded as windows pooled like in the model, so for them
+    # CachedTowerPredictor gives the same predictions as the full model.
+    def __init__(self, model, tokenizer, max_length=128, batch_size=128, clean_text=False, device=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.truncator = TokenBudgetTruncator(
+            tokenizer, max_length, pair=False)
+        self.batch_size = batch_size
+        self.clean_text = clean_text
+        self.device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+        self.transcript_chunker = TranscriptChunker(
+            tokenizer, **model.transcript_chunking) if getattr(model, 'transcript_chunking', None) else None
+        self.model.to(self.device)
+        self.model.eval()
+
+    @property
+    def dim(self):
+        return self.model.pooler.get_sentence_embedding_dimension()
+
+    def _prepare(self, texts, truncate=True):
+        texts = ['' if text is None else text for text in texts]
+        if self.clean_text:
+            texts = clean_text_funcs(texts)
+        return self.truncator(texts) if truncate else texts
+
+    def _encode_transcript_chunks(self, texts):
+        # videos are encoded in batches of about batch_size windows
+        windows = self.transcript_chunker(self._prepare(texts, truncate=False))
+        vectors = np.full((len(texts), self.dim), np.nan, dtype=np.float32)
+        token_counts = np.zeros(len(texts), dtype=np.float32)
+        valid = windows['attention_mask'].any(axis=(1, 2))
+        rows = np.flatnonzero(valid)
+        videos_per_batch = max(
+            self.batch_size // self.transcript_chunker.max_chunks, 1)
+        for start in range(0, len(rows), videos_per_batch):
+            batch_rows = rows[start:start + videos_per_batch]
+            embeddings, tokens = self.model.encode_transcript_chunks(*[torch.from_numpy(
+                windows[key][batch_rows]).to(self.device) for key in ['input_ids', 'attention_mask']])
+            vectors[batch_rows] = embeddings.float().cpu().numpy()
+            token_counts[batch_rows] = tokens.float().cpu().numpy()
+        return vectors, valid, token_counts
+
+    @torch.no_grad()
+    def encode(self, texts, text_type, return_token_counts=False):
+        # (vectors, valid) of texts with the tower of text_type, and the amount of tokens of each text with return_token_counts
+        if text_type == 'transcript' and self.transcript_chunker:
+            vectors, valid, token_counts = self._encode_transcript_chunks(texts)
+            return (vectors, valid, token_counts) if return_token_counts else (vectors, valid)
+        texts = self._prepare(texts)
+        vectors = np.full((len(texts), self.dim), np.nan, dtype=np.float32)
+        token_counts = np.zeros(len(texts), dtype=np.float32)
+        valid = np.array([bool(text) for text in texts], dtype=bool)
+        rows = sorted(np.flatnonzero(valid),
+                      key=lambda i: len(texts[i]), reverse=True)
+        for start in range(0, len(rows), self.batch_size):
+            batch_rows = rows[start:start + self.batch_size]
+            features = self.tokenizer([texts[i] for i in batch_rows], padding=True, truncation=True,
+                                      max_length=self.max_length, return_tensors='pt')
+            features = {key: value.to(self.device)
+                        for key, value in features.items()}
+            output = self.model.pooler(
+                self.model.transformer_models[text_type](features))
+            vectors[batch_rows] = output['sentence_embedding'].float().cpu().numpy()
+            token_counts[batch_rows] = features['attention_mask'].sum(
+                dim=1).cpu().numpy()
+        if return_token_counts:
+            return vectors, valid, token_counts
+        return vectors, valid
+
+
+def _append_encoded(store, encoder, video_ids, texts_by_type):
+    for text_type, texts in texts_by_type.items():
+        vectors, valid, token_counts = encoder.encode(
+            texts, text_type, return_token_counts=True)
+        store.append(text_type, video_ids, vectors, valid)
+        store.append(f'{text_type}_tokens', video_ids,
+                     token_counts[:, None], valid)
+
+
+def update_tower_embedding_store(store, encoder, record_batches, video_id_col='video_id'):
+    # Encode videos of record_batches (pyarrow RecordBatches with video_id and one column per text type, e.g. from
+    # data.get_video_texts) that aren't in store yet. Already stored videos are skipped so the update can be resumed.
+    text_types = [t for t in store.embedding_types if not t.endswith('_tokens')]
+    appended = 0
+    for batch in record_batches:
+        video_ids = batch.column(video_id_col).to_pylist()
+        missing = set(store.missing(video_ids))
+        rows = [i for i, video_id in enumerate(video_ids) if video_id in missing]
+        if not rows:
+            continue
+        _append_encoded(store, encoder, [video_ids[i] for i in rows], {t: [batch.column(
+            t)[i].as_py() for i in rows] for t in text_types})
+        appended += len(rows)
+        print(
+            f'Encoded {appended} new videos, {len(store)} videos in the embedding store')
+    return appended
+
+
+class CachedTowerPredictor():
+    # Predicts video pairs with RRUMV2 over cached single video embeddings, so N pairs of M unique videos cost M transformer
+    # passes instead of N. Videos of a batch that aren't in store yet are encoded from the pair's text columns first.
+    # The head of the model is run on the token weighted mean of the regret and recommendation embeddings of each text type,
+    # which approximates mean pooling over the tokens of the jointly encoded pair. It ignores attention between the two
+    # videos, so check the approximation against full RRUMV2 predictions (see max_abs_difference) before relying on it.
+    def __init__(self, model, store, encoder=None, batch_size=4096):
+        self.model = model
+        self.store = store
+        self.encoder = encoder
+        self.batch_size = batch_size
+        self.device = encoder.device if encoder is not None else 'cpu'
+        self.model.to(self.device)
+        self.model.eval()
+        self._load_embeddings()
+
+    def _load_embeddings(self):
+        self.embeddings = {t: self.store.get(t)
+                           for t in self.store.embedding_types}
+
+    def _encode_missing(self, table):
+        missing = {}  # video id -> (side, row) of a pair with texts of the video
+        for side in ['regret', 'recommendation']:
+            video_ids = table.column(f'{side}_id').to_pylist()
+            missing_ids = set(self.store.missing(video_ids))
+            for row, video_id in enumerate(video_ids):
+                if video_id in missing_ids and video_id not in missing:
+                    missing[video_id] = (side, row)
+        if not missing or self.encoder is None:
+            return
+        video_ids = list(missing)
+        _append_encoded(self.store, self.encoder, video_ids, {t: [table.column(f'{side}_{t}')[row].as_py(
+        ) for side, row in missing.values()] for t in self.model.text_types})
+        self._load_embeddings()
+
+    def _pair_embeddings(self, regret_ids, recommendation_ids, text_type):
+        # token weighted mean of regret and recommendation embeddings, NaN if either is missing
+        embeddings, tokens = self.embeddings[text_type], self.embeddings[f'{text_type}_tokens']
+        regret_rows, recommendation_rows = embeddings.rows(
+            regret_ids), embeddings.rows(recommendation_ids)
+        regret_token_rows, recommendation_token_rows = tokens.rows(
+            regret_ids), tokens.rows(recommendation_ids)
+        valid = (regret_rows >= 0) & (recommendation_rows >= 0) & (
+            regret_token_rows >= 0) & (recommendation_token_rows >= 0)
+        pair = np.full((len(regret_ids), embeddings.dim), np.nan, dtype=np.float32)
+        regret_tokens = np.asarray(tokens.vectors[regret_token_rows[valid]])
+        recommendation_tokens = np.asarray(
+            tokens.vectors[recommendation_token_rows[valid]])
+        pair[valid] = (np.asarray(embeddings.vectors[regret_rows[valid]]) * regret_tokens + np.asarray(
+            embeddings.vectors[recommendation_rows[valid]]) * recommendation_tokens) / (regret_tokens + recommendation_tokens)
+        return pair, valid
+
+    @torch.no_grad()
+    def predict(self, table):
+        # probabilities of pairs in pyarrow Table with regret_id, recommendation_id and the model's scalar and channel
+        # embedding columns (and text columns if videos may be missing from store), NaN for pairs without embeddings
+        self._encode_missing(table)
+        regret_ids = table.column('regret_id').to_pylist()
+        recommendation_ids = table.column('recommendation_id').to_pylist()
+        pair_embeddings = [self._pair_embeddings(
+            regret_ids, recommendation_ids, t) for t in self.model.text_types]
+        valid = np.logical_and.reduce(
+            [v for _, v in pair_embeddings] + [np.ones(table.num_rows, dtype=bool)])
+        features = {col: arrow_processing.to_numpy(table.column(col)).astype(
+            np.float32) for col in self.model.scalar_features}
+        features.update({col: list_column_to_matrix(table.column(col))[
+                        0] for col in self.model.channel_embeddings})
+        predictions = np.full(table.num_rows, np.nan)
+        rows = np.flatnonzero(valid)
+        for start in range(0, len(rows), self.batch_size):
+            batch_rows = rows[start:start + self.batch_size]
+            logits = self.model.head([torch.from_numpy(embeddings[batch_rows]).to(self.device) for embeddings, _ in pair_embeddings], {
+                col: torch.from_numpy(values[batch_rows]).to(self.device) for col, values in features.items()})
+            predictions[batch_rows] = torch.special.expit(
+                logits.float()).reshape(-1).cpu().numpy()
+        return predictions
+
+
+def max_abs_difference(cached_predictions, full_predictions):
+    # largest difference between CachedTowerPredictor and full RRUMV2 predictions of the same pairs, pairs missing from either are ignored
+    cached_predictions, full_predictions = np.asarray(
+        cached_predictions, dtype=np.float64), np.asarray(full_predictions, dtype=np.float64)
+    both = ~np.isnan(cached_predictions) & ~np.isnan(full_predictions)
+    return float(np.abs(cached_predictions[both] - full_predictions[both]).max()) if both.any() else float('nan')
@@ -1,7 +1,8 @@
 import pandas as pd
 from sklearn.model_selection import train_test_split
-from analysis.semsim import unifiedmodel
-from torch.utils.data import DataLoader
+from analysis.semsim import unifiedmodel, batching
+from torch.utils.data import DataLoader, Subset
+from torch.utils.data.dataloader import default_collate
 import pytorch_lightning as pl
 import torch
 from sklearn.metrics import roc_auc_score
@@ -9,7 +10,7 @@ import numpy as np
 from scipy.special import expit
 
 
-def run_training(data, label_map, balance_label_counts, with_transcript, epochs, batch_size, lr, freeze_policy, optimizer_config, cross_encoder_model_name_or_path):
+def run_training(data, label_map, balance_label_counts, with_transcript, epochs, batch_size, lr, freeze_policy, optimizer_config, cross_encoder_model_name_or_path, dynamic_padding=True, group_by_length=False):
     exp_data = data.copy(deep=True)
     if not with_transcript:
         exp_data = exp_data[exp_data.regret_transcript.isnull(
@@ -26,10 +27,17 @@ def run_training(data, label_map, balance_label_counts, with_transcript, epochs,
     train_dataset = unifiedmodel.RRUMDataset(
         train_data, label_map=label_map, balance_label_counts=balance_label_counts, with_transcript=with_transcript, do_train_test_split=True, cross_encoder_model_name_or_path=cross_encoder_model_name_or_path, processing_num_proc=1)
 
-    train_loader = DataLoader(train_dataset.train_dataset, shuffle=True,
-                              batch_size=batch_size, num_workers=0, pin_memory=False)
+    text_types = train_dataset.text_types
+    collate_fn = batching.DynamicPaddingCollator(text_types, pad_token_id=train_dataset.tokenizer.pad_token_id,
+                                                 padding_side=train_dataset.tokenizer.padding_side) if dynamic_padding else default_collate
+    if group_by_length:
+        train_loader = DataLoader(train_dataset.train_dataset, batch_sampler=batching.LengthGroupedBatchSampler(batching.dataset_example_lengths(
+            train_dataset.train_dataset, text_types), batch_size, shuffle=True), num_workers=0, pin_memory=False, collate_fn=collate_fn)
+    else:
+        train_loader = DataLoader(train_dataset.train_dataset, shuffle=True,
+                                  batch_size=batch_size, num_workers=0, pin_memory=False, collate_fn=collate_fn)
     val_loader = DataLoader(train_dataset.test_dataset, shuffle=False,
-                            batch_size=batch_size, num_workers=0, pin_memory=False)
+                            batch_size=batch_size, num_workers=0, pin_memory=False, collate_fn=collate_fn)
 
     model = unifiedmodel.RRUM(
         text_types=train_dataset.text_types,
@@ -57,10 +65,19 @@ def run_training(data, label_map, balance_label_counts, with_transcript, epochs,
 
     test_dataset = unifiedmodel.RRUMDataset(
         test_data, with_transcript=with_transcript, label_col=None, cross_encoder_model_name_or_path=cross_encoder_model_name_or_path, processing_num_proc=1)
-    test_loader = DataLoader(test_dataset.test_dataset, shuffle=False,
-                             batch_size=batch_size, num_workers=0, pin_memory=False)
+    if group_by_length:
+        test_order = batching.length_sorted_indices(batching.dataset_example_lengths(
+            test_dataset.test_dataset, text_types))
+        test_loader = DataLoader(Subset(test_dataset.test_dataset, test_order), shuffle=False,
+                                 batch_size=batch_size, num_workers=0, pin_memory=False, collate_fn=collate_fn)
+    else:
+        test_loader = DataLoader(test_dataset.test_dataset, shuffle=False,
+                                 batch_size=batch_size, num_workers=0, pin_memory=False, collate_fn=collate_fn)
     predictor = pl.Trainer(devices="auto", accelerator="auto", precision=16)
     predictions_all_batches = predictor.predict(model, dataloaders=test_loader)
+    if group_by_length:
+        predictions_all_batches = batching.restore_order(
+            predictions_all_batches, test_order, batch_size)
     predictions = [expit(x) for x in np.hstack(
         [l.squeeze().numpy() for l in predictions_all_batches])]
     return roc_auc_score(np.array(test_data.label), predictions)
@@ -0,0 +1,111 @@
+import collections
+import numpy as np
+import torch
+from .utils.text_truncation import TokenBudgetTruncator
+
+# Sliding-window transcript encoding for RRUMV2 with transcript_chunking. Instead of the first max_length tokens of
+# a pair, the first max_chunks windows of window_length tokens of each video's transcript are encoded separately
+# (consecutive windows share overlap tokens) and the window embeddings are pooled into one transcript embedding per
+# pair before the head. Transcripts are cut to the tokens of max_chunks windows before tokenization, so compute
+# stays bounded however long the transcripts are.
+
+
+class TranscriptChunker():
+    # Tokenizes texts into (len(texts), max_chunks, window_length) input_ids and attention_mask arrays of windows with
+    # the tokenizer's special tokens, unused windows of short texts are padding with an all zero attention mask.
+    # Token ids of the last cache_size unique texts are kept so repeated videos are tokenized once.
+    def __init__(self, tokenizer, window_length=128, overlap=32, max_chunks=8, cache_size=20000):
+        self.tokenizer = tokenizer
+        self.window_length = window_length
+        special_tokens = tokenizer.num_special_tokens_to_add(pair=False)
+        self.window_tokens = window_length - special_tokens
+        if not 0 <= overlap < self.window_tokens:
+            raise ValueError(
+                f'overlap must be at least 0 and less than the {self.window_tokens} text tokens of a window')
+        self.overlap = overlap
+        self.step = self.window_tokens - overlap
+        self.max_chunks = max_chunks
+        self.max_tokens = max_chunks * self.step + overlap
+        self.truncator = TokenBudgetTruncator(
+            tokenizer, self.max_tokens + special_tokens, pair=False)
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+
+    def _windows(self, token_ids):
+        input_ids = np.full((self.max_chunks, self.window_length),
+                            self.tokenizer.pad_token_id, dtype=np.int64)
+        attention_mask = np.zeros(
+            (self.max_chunks, self.window_length), dtype=np.int64)
+        starts = range(0, max(len(token_ids) - self.overlap, 1),
+                       self.step) if len(token_ids) else []
+        for chunk, start in enumerate(list(starts)[:self.max_chunks]):
+            window = self.tokenizer.build_inputs_with_special_tokens(
+                token_ids[start:start + self.window_tokens].tolist())
+            input_ids[chunk, :len(window)] = window
+            attention_mask[chunk, :len(window)] = 1
+        return input_ids, attention_mask
+
+    def token_ids(self, texts):
+        # token ids of each text without special tokens, cut to the tokens of max_chunks windows
+        texts = ['' if text is None else text for text in texts]
+        new_texts = [text for text in dict.fromkeys(
+            texts) if text not in self._cache]
+        if new_texts:
+            token_ids = self.tokenizer(self.truncator(new_texts), add_special_tokens=False, truncation=True,
+                                       max_length=self.max_tokens, return_attention_mask=False)['input_ids']
+            for text, ids in zip(new_texts, token_ids):
+                self._cache[text] = np.asarray(ids, dtype=np.int32)
+        for text in texts:
+            self._cache.move_to_end(text)
+        token_ids = [self._cache[text] for text in texts]
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return token_ids
+
+    def __call__(self, texts):
+        windows = [self._windows(ids) for ids in self.token_ids(texts)]
+        shape = (len(windows), self.max_chunks, self.window_length)
+        return {'input_ids': np.stack([input_ids for input_ids, _ in windows]) if windows else np.zeros(shape, dtype=np.int64),
+                'attention_mask': np.stack([attention_mask for _, attention_mask in windows]) if windows else np.zeros(shape, dtype=np.int64)}
+
+
+def pool_chunk_embeddings(chunk_embeddings, chunk_tokens):
+    # token weighted mean of (videos, max_chunks, dim) chunk embeddings with (videos, max_chunks) token counts and the
+    # amount of tokens of each video, videos without tokens get a zero embedding
+    weights = chunk_tokens.to(chunk_embeddings.dtype)
+    video_tokens = weights.sum(1)
+    embeddings = (chunk_embeddings * weights[..., None]).sum(1) / \
+        video_tokens.clamp(min=1)[:, None]
+    return embeddings, video_tokens
+
+
+def pool_pair_embeddings(regret_embeddings, regret_tokens, recommendation_embeddings, recommendation_tokens):
+    # token weighted mean of the regret and recommendation embeddings like CachedTowerPredictor
+    tokens = (regret_tokens + recommendation_tokens).clamp(min=1)[:, None]
+    return (regret_embeddings * regret_tokens[:, None] + recommendation_embeddings * recommendation_tokens[:, None]) / tokens
+
+
+def encode_chunks(tower, pooler, input_ids, attention_mask, batch_size=None):
+    # (videos, dim) pooled chunk embeddings and (videos,) token counts of (videos, max_chunks, window_length) windows
+    # with the transformer tower and pooler, identical windows (e.g. of a video in many pairs of a batch) are encoded
+    # once and empty windows not at all, in batches of at most batch_size windows
+    videos, max_chunks, window_length = input_ids.shape
+    input_ids = input_ids.reshape(-1, window_length)
+    attention_mask = attention_mask.reshape(-1, window_length)
+    chunk_tokens = attention_mask.sum(1)
+    used = chunk_tokens > 0
+    dim = pooler.get_sentence_embedding_dimension()
+    if used.any():
+        unique_ids, inverse = torch.unique(
+            input_ids[used], dim=0, return_inverse=True)
+        unique_mask = torch.zeros_like(unique_ids)
+        unique_mask[inverse] = attention_mask[used]
+        batch_size = batch_size or len(unique_ids)
+        unique_embeddings = torch.cat([pooler(tower({'input_ids': unique_ids[start:start + batch_size], 'attention_mask': unique_mask[start:start + batch_size]}))['sentence_embedding']
+                                       for start in range(0, len(unique_ids), batch_size)])
+        chunk_embeddings = unique_embeddings.new_zeros((len(input_ids), dim))
+        chunk_embeddings[used] = unique_embeddings[inverse]
+    else:
+        chunk_embeddings = torch.zeros(
+            (len(input_ids), dim), device=input_ids.device)
+    return pool_chunk_embeddings(chunk_embeddings.reshape(videos, max_chunks, dim), chunk_tokens.reshape(videos, max_chunks))
@@ -1,15 +1,21 @@
-from transformers import AutoTokenizer, AutoModelForSequenceClassification, get_linear_schedule_with_warmup
-from google.cloud.bigquery_storage_v1.reader import ReadRowsIterable
+from transformers import AutoConfig, AutoTokenizer, AutoModelForSequenceClassification, get_linear_schedule_with_warmup
 import datasets
 import pandas as pd
+import numpy as np
 import pyarrow
+import pyarrow.compute
 import pytorch_lightning as pl
 import torchmetrics
 import torch.nn as nn
 import torch
 import types
+import itertools
 import multiprocessing
-from .utils.text_cleaning import clean_text_funcs
+from .utils.text_cleaning import clean_text_funcs, cleaned_text_columns
+from .utils.text_truncation import TokenBudgetTruncator
+from .token_cache import TokenCache
+from .utils import arrow_processing
+from .streaming import RecordBatchStream, RecordBatchSources, is_read_rows_iterable
 
 
 class RRUMDataset():
@@ -17,7 +23,7 @@ class RRUMDataset():
     _image_features = ['regret_thumbnail',
                        'recommendation_thumbnail']  # not used atm
 
-    def __init__(self, data, with_transcript, cross_encoder_model_name_or_path, label_col="label", label_map=None, balance_label_counts=False, max_length=128, do_train_test_split=False, test_size=0.25, seed=42, keep_video_ids_for_predictions=False, encode_on_the_fly=False, clean_text=False, processing_batch_size=1000, processing_num_proc=1):
+    def __init__(self, data, with_transcript, cross_encoder_model_name_or_path, label_col="label", label_map=None, balance_label_counts=False, max_length=128, do_train_test_split=False, test_size=0.25, seed=42, keep_video_ids_for_predictions=False, encode_on_the_fly=False, clean_text=False, processing_batch_size=1000, processing_num_proc=1, token_cache_path=None):
         self._with_transcript = with_transcript
         self.tokenizer = AutoTokenizer.from_pretrained(
             cross_encoder_model_name_or_path)
@@ -25,12 +31,15 @@ class RRUMDataset():
         self.label_map = label_map
         self.balance_label_counts = balance_label_counts
         self.max_length = max_length
+        self.truncator = TokenBudgetTruncator(self.tokenizer, self.max_length)
         self.seed = seed
         self.keep_video_ids_for_predictions = keep_video_ids_for_predictions
         self.clean_text = clean_text
         self.processing_batch_size = processing_batch_size
         self.processing_num_proc = multiprocessing.cpu_count(
         ) if not processing_num_proc else processing_num_proc
+        self.token_cache = TokenCache(token_cache_path, self.tokenizer, self.max_length,
+                                      self.clean_text) if token_cache_path else None
 
         self.text_types = ['title', 'description'] + \
             (['transcript'] if self._with_transcript else [])
@@ -42,19 +51,37 @@ class RRUMDataset():
         self.streaming_dataset = False
         if isinstance(data, pd.DataFrame):
             self.dataset = datasets.Dataset.from_pandas(data)
-        elif isinstance(data, ReadRowsIterable) or isinstance(data, types.GeneratorType):
-            examples_iterable = datasets.iterable_dataset.ExamplesIterable(
-                self._streaming_generate_examples, {"iterable": data})
-            self.dataset = datasets.IterableDataset(examples_iterable)
-            self._stream_dataset_example = next(iter(self.dataset))
-            self._stream_dataset_column_names = list(
-                self._stream_dataset_example.keys())
+        elif is_read_rows_iterable(data) or isinstance(data, types.GeneratorType):
+            # RecordBatches stay the unit of work, the peeked first batch is put back so its rows aren't lost
+            record_batches = self._streaming_record_batches(data)
+            first_batch = next(record_batches, None)
+            self._stream_dataset_schema = first_batch.schema if first_batch is not None else pyarrow.schema([
+            ])
+            self._stream_dataset_column_names = self._stream_dataset_schema.names
+            self._stream_dataset_example = first_batch.slice(
+                0, 1).to_pylist()[0] if first_batch is not None and first_batch.num_rows else None
+            self.dataset = itertools.chain(
+                [first_batch] if first_batch is not None else [], record_batches)
+            self.streaming_dataset = True
+        elif isinstance(data, RecordBatchSources):
+            # sources are read in DataLoader worker processes, see streaming.RecordBatchStream
+            self._stream_dataset_schema = data.schema
+            self._stream_dataset_column_names = data.schema.names
+            self._stream_dataset_example = None
+            self.dataset = data
             self.streaming_dataset = True
         elif isinstance(data, pyarrow.Table):
             self.dataset = datasets.Dataset(data)
         else:
             raise ValueError(
-                f'Type of data is {type(data)} when pd.DataFrame, pyarrow.Table, google.cloud.bigquery_storage_v1.reader.ReadRowsIterable or generator of pyarrow.RecordBatch is allowed')
+                f'Type of data is {type(data)} when pd.DataFrame, pyarrow.Table, google.cloud.bigquery_storage_v1.reader.ReadRowsIterable, generator of pyarrow.RecordBatch or streaming.RecordBatchSources is allowed')
+
+        # texts cleaned ahead of time with clean_parquet.py are not cleaned again
+        schema = data.schema if isinstance(data, (pyarrow.Table, RecordBatchSources)) else getattr(
+            self, '_stream_dataset_schema', None)
+        if self.clean_text and schema is not None and set(self._text_features) <= cleaned_text_columns(schema):
+            print('Text columns of the data are already cleaned, skipping text cleaning')
+            self.clean_text = False
 
         # PREPROCESS DATASET
         self._preprocess()
@@ -109,80 +136,85 @@ class RRUMDataset():
 
     def __getitem__(self, index):
         if self.streaming_dataset:
-            return next(iter(self.dataset))
+            return self._stream_dataset_example
         return self.dataset[index]
 
-    def _streaming_generate_examples(self, iterable):
-        id_ = 0
+    def _streaming_record_batches(self, iterable):
         # TODO: make sure GeneratorType is pyarrow.RecordBatch
         if isinstance(iterable, types.GeneratorType):
-            for examples in iterable:
-                for ex in examples.to_pylist():
-                    yield id_, ex
-                    id_ += 1
-        elif isinstance(iterable, ReadRowsIterable):
-            for ex in iterable:
-                yield id_, {key: ex[key].as_py() for key in ex}
-                id_ += 1
+            yield from iterable
+        elif is_read_rows_iterable(iterable):
+            for page in iterable.pages:
+                yield page.to_arrow()
 
     def _preprocess(self):
-        if self._with_transcript:
-            self.dataset = self.dataset.filter(
-                lambda example: example['regret_transcript'] is not None and example['recommendation_transcript'] is not None)
+        if self.streaming_dataset:
+            # streamed RecordBatches are filtered, cleaned and encoded batch by batch in RecordBatchStream
+            if self.label_col and self.label_col in self._stream_dataset_column_names and pyarrow.types.is_string(self._stream_dataset_schema.field(self.label_col).type):
+                if not self.label_map:
+                    raise ValueError(
+                        f'"label_map" dict was not provided and is needed to encode string labels for streaming datasets')
         else:
-            self.dataset = self.dataset.filter(
-                lambda example: example['regret_transcript'] is None or example['recommendation_transcript'] is None)
-        if self.label_col:
-            if self.streaming_dataset:
-                if self.label_col in self._stream_dataset_column_names and isinstance(self._stream_dataset_example[self.label_col], str):
-                    if not self.label_map:
-                        raise ValueError(
-                            f'"label_map" dict was not provided and is needed to encode string labels for streaming datasets')
-                    # cast_column method had issues with streaming dataset
-                    self.dataset = self.dataset.map(
-                        self._streaming_rename_labels)
-            else:
-                if self.dataset.features[self.label_col].dtype == 'string':
-                    if not self.label_map:
-                        self.label_map = {k: v for v, k in enumerate(
-                            self.dataset.unique(self.label_col))}
-                    self.dataset = self.dataset.filter(
-                        lambda example: example[self.label_col] in self.label_map.keys())
-                    self.dataset = self.dataset.cast_column(self.label_col, datasets.ClassLabel(
-                        num_classes=len(self.label_map), names=list(self.label_map.keys())))
-
-        self.dataset = self.dataset.filter(lambda example: not any(x in [None, ""] for x in [
-                                           example[key] for key in self._text_features + self.scalar_features + ([self.label_col] if self.label_col else [])]))  # dropna
-
-        if self.balance_label_counts and self.label_col and not self.streaming_dataset:
-            label_datasets = {}
-            for label in list(self.label_map.values()):
-                label_dataset = self.dataset.filter(
-                    lambda example: example[self.label_col] == label)
-                label_datasets[len(label_dataset)] = label_dataset
-            min_label_count = min(label_datasets)
-            sampled_datasets = [dataset.train_test_split(train_size=min_label_count, shuffle=True, seed=self.seed)[
-                'train'] if len(dataset) != min_label_count else dataset for dataset in label_datasets.values()]
-            self.dataset = datasets.concatenate_datasets(sampled_datasets)
+            self._preprocess_table()
+            self.dataset = self.dataset.map(self._clean_and_truncate_text, batched=True,
+                                            batch_size=self.processing_batch_size, num_proc=self.processing_num_proc if self.processing_num_proc > 1 else None)
 
-        if self.clean_text:
-            self.dataset = self.dataset.map(self._clean_text, batched=not self.streaming_dataset,
-                                            batch_size=self.processing_batch_size)
-        self.dataset = self.dataset.map(self._truncate_and_strip_text, batched=not self.streaming_dataset,
-                                        batch_size=self.processing_batch_size)
-
-    def _streaming_rename_labels(self, example):
-        # rename labels according to label_map if not already correct labels
-        if isinstance(example[self.label_col], list):
-            example[self.label_col] = [self.label_map.get(
-                ex, None) for ex in example[self.label_col] if ex not in self.label_map.values()]
-        elif isinstance(example[self.label_col], str) and example[self.label_col] not in self.label_map.values():
-            example[self.label_col] = self.label_map.get(
-                example[self.label_col], None)
+    def _filter_mask(self, table):
+        # transcript filter and dropna as one boolean mask of the rows to keep
+        transcripts = ['regret_transcript', 'recommendation_transcript']
+        if self._with_transcript:
+            mask = arrow_processing.valid_mask(
+                table, transcripts, allow_empty_strings=True)
+        elif all(col in table.column_names for col in transcripts):
+            # transcripts may be left out of the data when they are not used, e.g. when only selected columns are streamed
+            mask = ~arrow_processing.valid_mask(
+                table, transcripts, allow_empty_strings=True)
         else:
-            raise ValueError(
-                f'Type of example label is {type(example[self.label_col])} when list or string is allowed')
-        return example
+            mask = np.ones(table.num_rows, dtype=bool)
+        return mask & arrow_processing.valid_mask(
+            table, self._text_features + self.scalar_features + ([self.label_col] if self.label_col else []))  # dropna
+
+    def _with_encoded_labels(self, table, label_values=None):
+        # labels outside label_map become null and are dropped with dropna
+        return table.set_column(table.column_names.index(self.label_col), self.label_col, arrow_processing.encode_labels(
+            table.column(self.label_col), list(self.label_map.keys()), label_values))
+
+    def _preprocess_table(self):
+        # transcript filter, label encoding, dropna and label balancing as vectorized operations on the Arrow table
+        # of the dataset, rows are selected with one boolean mask and taken once instead of a filter pass per step
+        if self.dataset._indices is not None:
+            self.dataset = self.dataset.flatten_indices()
+        table = self.dataset.data.table
+        features = self.dataset.features.copy()
+        if self.label_col and features[self.label_col].dtype == 'string':
+            if not self.label_map:
+                self.label_map = {k: v for v, k in enumerate(
+                    pyarrow.compute.unique(table.column(self.label_col)).drop_null().to_pylist())}
+            table = self._with_encoded_labels(table)
+            features[self.label_col] = datasets.ClassLabel(
+                num_classes=len(self.label_map), names=list(self.label_map.keys()))
+        indices = np.flatnonzero(self._filter_mask(table))
+
+        if self.balance_label_counts and self.label_col:
+            labels = arrow_processing.to_numpy(
+                table.column(self.label_col).take(pyarrow.array(indices)))
+            indices = indices[arrow_processing.balanced_positions(
+                labels, list(self.label_map.values()), self.seed)]
+        self.dataset = datasets.Dataset(table.take(pyarrow.array(
+            indices)), info=datasets.DatasetInfo(features=features))
+
+    def _filter_record_batch(self, record_batch):
+        table = pyarrow.Table.from_batches([record_batch])
+        if self.label_col and self.label_col in table.column_names and pyarrow.types.is_string(table.schema.field(self.label_col).type):
+            # string labels are encoded to label_map values
+            table = self._with_encoded_labels(
+                table, list(self.label_map.values()))
+        return table.filter(pyarrow.array(self._filter_mask(table)))
+
+    def _clean_and_truncate_text(self, example):
+        if self.clean_text:
+            example = self._clean_text(example)
+        return self._truncate_and_strip_text(example)
 
     def _clean_text(self, example):
         for feat in self._text_features:
@@ -191,15 +223,15 @@ class RRUMDataset():
         return example
 
     def _truncate_and_strip_text(self, example):
-        # tokenizer will truncate to max_length tokens anyway so to save RAM let's truncate to max_length words already beforehand
-        # one word is usually one or more tokens so should be safe to truncate this way without losing information
+        # tokenizer will truncate to max_length tokens anyway so to save RAM and tokenizing time let's cut the texts to the
+        # part that fits in the token budget already beforehand, see utils/text_truncation.py
         for feat in self._text_features:
             if isinstance(example[feat], list):
-                example[feat] = [
-                    ' '.join(text.split()[:self.max_length]).strip() for text in example[feat] if text]
+                # empty texts keep their positions so the regret and recommendation lists of a batch stay aligned
+                example[feat] = self.truncator(
+                    [text or '' for text in example[feat]])
             elif isinstance(example[feat], str):
-                example[feat] = ' '.join(example[feat].split()[
-                                         :self.max_length]).strip()
+                example[feat] = self.truncator([example[feat]])[0]
             elif example[feat] is None:
                 return None
             else:
@@ -207,10 +239,18 @@ class RRUMDataset():
                     f'Type of example is {type(example[feat])} when list or string is allowed')
         return example
 
+    def _tokenize(self, regret, recommendation, return_tensors=None):
+        if self.token_cache:
+            encoded = self.token_cache(regret, recommendation)
+            if return_tensors == "pt":
+                encoded = {key: torch.from_numpy(value.astype("int64")) for key, value in encoded.items()}
+            return encoded
+        return dict(self.tokenizer(regret, recommendation, padding="max_length", truncation=True, max_length=self.max_length, return_tensors=return_tensors))
+
     def _encode(self, dataset):
         encoded_dataset = None
         for text_type in self.text_types:
-            encoded_text_type = dataset.map(lambda regret, recommendation: self.tokenizer(regret, recommendation, padding="max_length", truncation=True, max_length=self.max_length), batched=True,
+            encoded_text_type = dataset.map(self._tokenize, batched=True,
                                             batch_size=self.processing_batch_size, num_proc=self.processing_num_proc, input_columns=[f'regret_{text_type}', f'recommendation_{text_type}'], remove_columns=dataset.column_names)
             encoded_text_type = encoded_text_type.rename_columns(
                 {col: f'{text_type}_{col}' for col in encoded_text_type.column_names})  # e.g. input_ids -> title_input_ids so we have separate input_ids for each text_type
@@ -237,33 +277,41 @@ class RRUMDataset():
         return encoded_dataset
 
     def _encode_streaming(self, dataset):
-        encoded_dataset = dataset.map(self._encode_on_the_fly, batched=True,
-                                      batch_size=self.processing_batch_size, remove_columns=list(set(self._stream_dataset_column_names)-set(self.scalar_features + (
-                                          [self.label_col] if self.label_col else []) + (['regret_id', "recommendation_id"] if self.keep_video_ids_for_predictions else []))))  # IterableDataset doesn't have column_names attribute as normal Dataset
-        encoded_dataset = encoded_dataset.with_format("torch")
-        return encoded_dataset
+        return RecordBatchStream(dataset, self._filter_record_batch, self._encode_table, batch_size=self.processing_batch_size, text_types=self.text_types)
+
+    def _encode_table(self, table):
+        # encode a filtered table of streamed rows into a batch of tensors
+        batch = {col: table.column(col).to_pylist()
+                 for col in self._text_features + (['regret_id', 'recommendation_id'] if self.keep_video_ids_for_predictions else [])}
+        for col in self.scalar_features:
+            batch[col] = arrow_processing.to_numpy(
+                table.column(col)).astype(np.float32)
+        if self.label_col:
+            batch[self.label_col] = arrow_processing.to_numpy(
+                table.column(self.label_col)).astype(np.int64)
+        return self._encode_on_the_fly(self._clean_and_truncate_text(batch))
 
     def _encode_on_the_fly(self, batch):
         for text_type in self.text_types:
-            encoded_text_type = dict(self.tokenizer(
-                batch[f'regret_{text_type}'], batch[f'recommendation_{text_type}'], padding="max_length", truncation=True, max_length=self.max_length, return_tensors="pt"))
+            encoded_text_type = self._tokenize(
+                batch[f'regret_{text_type}'], batch[f'recommendation_{text_type}'], return_tensors="pt")
             for encoded_key in encoded_text_type.copy():
-                encoded_text_type[f"{text_type}_{encoded_key}"] = encoded_text_type.pop(encoded_key) if not self.streaming_dataset else encoded_text_type.pop(
-                    encoded_key).squeeze(0)  # e.g. input_ids -> title_input_ids so we have separate input_ids for each text_type
+                encoded_text_type[f"{text_type}_{encoded_key}"] = encoded_text_type.pop(
+                    encoded_key)  # e.g. input_ids -> title_input_ids so we have separate input_ids for each text_type
             del batch[f'regret_{text_type}']
             del batch[f'recommendation_{text_type}']
             batch.update(encoded_text_type)
         for scalar_feat in self.scalar_features:
             batch[scalar_feat] = torch.as_tensor(
-                batch[scalar_feat]) if not self.streaming_dataset else torch.as_tensor(batch[scalar_feat]).squeeze(0)
+                batch[scalar_feat])
         if self.label_col:
             batch[self.label_col] = torch.as_tensor(
-                batch[self.label_col]) if not self.streaming_dataset else torch.as_tensor(batch[self.label_col]).squeeze(0)
+                batch[self.label_col])
         return batch
 
 
 class RRUM(pl.LightningModule):
-    def __init__(self, text_types, scalar_features, label_col, cross_encoder_model_name_or_path, optimizer_config=None, freeze_policy=None, pos_weight=None):
+    def __init__(self, text_types, scalar_features, label_col, cross_encoder_model_name_or_path, optimizer_config=None, freeze_policy=None, pos_weight=None, pretrained=True):
         super().__init__()
         self.save_hyperparameters()
         self.text_types = text_types
@@ -272,16 +320,19 @@ class RRUM(pl.LightningModule):
         self.optimizer_config = optimizer_config
         self.cross_encoder_model_name_or_path = cross_encoder_model_name_or_path
         self.cross_encoders = nn.ModuleDict({})
+        # without pretrained, cross-encoders are only constructed from their config, e.g. when trained weights are loaded right after
+        config = AutoConfig.from_pretrained(
+            self.cross_encoder_model_name_or_path) if not pretrained else None
         for t in self.text_types:
             self.cross_encoders[t] = AutoModelForSequenceClassification.from_pretrained(
-                self.cross_encoder_model_name_or_path)
+                self.cross_encoder_model_name_or_path) if pretrained else AutoModelForSequenceClassification.from_config(config)
         if freeze_policy is not None:
             for xe in self.cross_encoders.values():
                 for name, param in xe.named_parameters():
                     if freeze_policy(name):
                         param.requires_grad = False
-        cross_encoder_out_features = list(self.cross_encoders.values())[0](
-            torch.randint(1, 2, (1, 2))).logits.size(dim=1)
+        cross_encoder_out_features = list(
+            self.cross_encoders.values())[0].config.num_labels
         self.lin1 = nn.Linear(len(self.cross_encoders) * cross_encoder_out_features +
                               len(self.scalar_features), 1)
         self.ac_metric = torchmetrics.Accuracy()
@@ -295,6 +346,10 @@ class RRUM(pl.LightningModule):
         else:
             self.loss = nn.BCEWithLogitsLoss()
 
+    def input_columns(self, keep_video_ids=True):
+        # data columns the model consumes, e.g. to avoid reading unused columns from BigQuery
+        return (['regret_id', 'recommendation_id'] if keep_video_ids else []) + [f'{side}_{text_type}' for text_type in self.text_types for side in ['regret', 'recommendation']] + self.scalar_features
+
     def forward(self, x):
         cross_logits = {}
         for f in self.text_types:
@@ -0,0 +1,40 @@
+import numpy as np
+import pyarrow
+import pyarrow.compute as pc
+
+
+def to_numpy(array):
+    if isinstance(array, pyarrow.ChunkedArray):
+        array = array.combine_chunks() if array.num_chunks else pyarrow.array(
+            [], type=array.type)
+    return array.to_numpy(zero_copy_only=False)
+
+
+# True for rows where none of the columns is null (or an empty string unless allow_empty_strings).
+def valid_mask(table, columns, allow_empty_strings=False):
+    mask = np.ones(table.num_rows, dtype=bool)
+    for col in columns:
+        column = table.column(col)
+        mask &= to_numpy(pc.is_valid(column))
+        if not allow_empty_strings and (pyarrow.types.is_string(column.type) or pyarrow.types.is_large_string(column.type)):
+            mask &= to_numpy(pc.fill_null(
+                pc.not_equal(column, ''), False))
+    return mask
+
+
+# Position of each string label in names (or the matching item of values), null for labels that are not in names.
+def encode_labels(column, names, values=None):
+    positions = pc.index_in(
+        column, value_set=pyarrow.array(names).cast(column.type))
+    if values is not None:
+        return pc.take(pyarrow.array(values, type=pyarrow.int64()), positions)
+    return pc.cast(positions, pyarrow.int64())
+
+
+# Positions of a random sample of labels that has equally many rows of each label in label_values.
+def balanced_positions(labels, label_values, seed):
+    rng = np.random.default_rng(seed)
+    label_positions = [np.flatnonzero(labels == label)
+                       for label in label_values]
+    min_label_count = min(len(positions) for positions in label_positions)
+    return np.sort(np.concatenate([positions if len(positions) == min_label_count else rng.choice(positions, min_label_count, replace=False) for positions in label_positions]))
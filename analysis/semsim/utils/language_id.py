@@ -0,0 +1,111 @@
+import hashlib
+import multiprocessing
+import sqlite3
+import numpy as np
+import pandas as pd
+
+# Language identification of video texts with gcld3 for filtering video pairs by language. Languages are detected once
+# per video and text type instead of once per pair side, results are cached locally by video id and text hash, and
+# texts without a cached language are detected in a process pool. Texts of a video are assumed to be the same in all
+# of its pairs.
+
+_detector = None
+
+
+def _init_detector(max_num_bytes):
+    global _detector
+    import gcld3
+    _detector = gcld3.NNetLanguageIdentifier(
+        min_num_bytes=0, max_num_bytes=max_num_bytes)
+
+
+def _detect(texts):
+    return [_detector.FindLanguage(text=text).language for text in texts]
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class LanguageCache():
+    # SQLite store of detected languages keyed by text type and video id, a language is valid while the hash of the text matches
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS languages (text_type TEXT, video_id TEXT, text_hash TEXT, language TEXT, PRIMARY KEY (text_type, video_id))')
+
+    def get(self, text_type, video_ids, text_hashes, chunk_size=900):
+        # cached language of each video, None if it's not cached or its text has changed
+        cached = {}
+        for start in range(0, len(video_ids), chunk_size):
+            chunk = video_ids[start:start + chunk_size]
+            cached.update({(video_id, hash): language for video_id, hash, language in self.connection.execute(
+                f'SELECT video_id, text_hash, language FROM languages WHERE text_type = ? AND video_id IN ({",".join("?" * len(chunk))})', [text_type, *chunk])})
+        return [cached.get(key) for key in zip(video_ids, text_hashes)]
+
+    def put(self, text_type, video_ids, text_hashes, languages):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO languages VALUES (?, ?, ?, ?)', [
+                (text_type, video_id, hash, language) for video_id, hash, language in zip(video_ids, text_hashes, languages)])
+
+    def close(self):
+        self.connection.close()
+
+
+class LanguageIdentifier():
+    # Detects languages with gcld3 in num_proc processes, optionally cached in a LanguageCache at cache_path.
+    # gcld3 only looks at the first max_num_bytes bytes of a text, so only that many characters are sent to the
+    # workers and hashed, which also keeps the cache valid when only the end of a long transcript changes.
+    def __init__(self, cache_path=None, num_proc=1, max_num_bytes=1000, chunk_size=1000):
+        self.cache = LanguageCache(cache_path) if cache_path else None
+        self.num_proc = num_proc or multiprocessing.cpu_count()
+        self.max_num_bytes = max_num_bytes
+        self.chunk_size = chunk_size
+
+    def detect(self, texts):
+        chunks = [texts[start:start + self.chunk_size]
+                  for start in range(0, len(texts), self.chunk_size)]
+        if self.num_proc <= 1 or len(chunks) <= 1:
+            if _detector is None:
+                _init_detector(self.max_num_bytes)
+            return [language for chunk in chunks for language in _detect(chunk)]
+        with multiprocessing.Pool(self.num_proc, initializer=_init_detector, initargs=(self.max_num_bytes,)) as pool:
+            return [language for languages in pool.imap(_detect, chunks) for language in languages]
+
+    def video_languages(self, text_type, video_ids, texts):
+        # language of each video's text, None for missing texts
+        prefixes = [text[:self.max_num_bytes] if isinstance(
+            text, str) else None for text in texts]
+        rows = [i for i, text in enumerate(prefixes) if text is not None]
+        languages = [None] * len(texts)
+        hashes = [text_hash(prefixes[i]) for i in rows]
+        cached = self.cache.get(text_type, [video_ids[i] for i in rows], hashes) if self.cache else [
+            None] * len(rows)
+        missing = [j for j, language in enumerate(cached) if language is None]
+        detected = self.detect([prefixes[rows[j]] for j in missing])
+        for j, language in zip(missing, detected):
+            cached[j] = language
+        if self.cache and missing:
+            self.cache.put(text_type, [video_ids[rows[j]] for j in missing], [
+                           hashes[j] for j in missing], detected)
+        for i, language in zip(rows, cached):
+            languages[i] = language
+        return languages
+
+    def pair_mask(self, data, text_types, lang, min_length=10):
+        # Boolean mask of pairs in Pandas DataFrame data whose regret and recommendation texts of all text_types are in
+        # language lang or shorter than min_length characters, languages are detected once per unique video
+        mask = np.ones(len(data), dtype=bool)
+        for text_type in text_types:
+            video_ids = np.concatenate(
+                [data['regret_id'].to_numpy(), data['recommendation_id'].to_numpy()])
+            codes, unique_ids = pd.factorize(video_ids)
+            _, first_rows = np.unique(codes, return_index=True)
+            texts = np.concatenate([data[f'regret_{text_type}'].to_numpy(
+            ), data[f'recommendation_{text_type}'].to_numpy()])[first_rows]
+            languages = self.video_languages(text_type, list(unique_ids), list(texts))
+            video_ok = np.array([isinstance(text, str) and (len(text) < min_length or language == lang)
+                                 for text, language in zip(texts, languages)], dtype=bool)
+            side_ok = video_ok[codes]
+            mask &= side_ok[:len(data)] & side_ok[len(data):]
+        return mask
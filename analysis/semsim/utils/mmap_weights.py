@@ -0,0 +1,112 @@
+import contextlib
+import json
+import struct
+import numpy as np
+import torch
+from torch import nn
+
+# Zero-copy model loading: safetensors files are memory-mapped copy-on-write so the loaded tensors share the file's
+# page cache pages, also between processes loading the same file, and modules are constructed with parameters on the
+# meta device so no memory is spent on weights that the checkpoint overwrites anyway. Files are read and written
+# without the safetensors library, which is not a requirement of the project.
+
+_safetensors_dtypes = {
+    'F64': np.float64, 'F32': np.float32, 'F16': np.float16, 'BF16': np.int16,
+    'I64': np.int64, 'I32': np.int32, 'I16': np.int16, 'I8': np.int8, 'U8': np.uint8, 'BOOL': np.bool_,
+}
+
+
+def load_safetensors_mmap(path):
+    # (state dict of tensors memory-mapped from safetensors file at path, metadata dict of the file)
+    with open(path, 'rb') as handle:
+        header_size, = struct.unpack('<Q', handle.read(8))
+        header = json.loads(handle.read(header_size))
+    metadata = header.pop('__metadata__', {})
+    data_offset = 8 + header_size
+    state_dict = {}
+    for key, info in header.items():
+        start, end = info['data_offsets']
+        count = (end - start) // np.dtype(_safetensors_dtypes[info['dtype']]).itemsize
+        array = np.memmap(path, dtype=_safetensors_dtypes[info['dtype']], mode='c',
+                          offset=data_offset + start, shape=(count,)) if count else np.empty(0, dtype=_safetensors_dtypes[info['dtype']])
+        tensor = torch.from_numpy(array)
+        if info['dtype'] == 'BF16':
+            tensor = tensor.view(torch.bfloat16)
+        state_dict[key] = tensor.reshape(info['shape'])
+    return state_dict, metadata
+
+
+_torch_safetensors_dtypes = {
+    torch.float64: 'F64', torch.float32: 'F32', torch.float16: 'F16', torch.bfloat16: 'BF16',
+    torch.int64: 'I64', torch.int32: 'I32', torch.int16: 'I16', torch.int8: 'I8', torch.uint8: 'U8', torch.bool: 'BOOL',
+}
+
+
+def _tensor_bytes(tensor):
+    tensor = tensor.detach().cpu().contiguous()
+    if tensor.dtype == torch.bfloat16:
+        tensor = tensor.view(torch.int16)
+    return tensor.numpy().tobytes()
+
+
+def save_safetensors(state_dict, path, metadata=None):
+    # Write state_dict as a safetensors file that load_safetensors_mmap and the safetensors library can read: an 8 byte
+    # little-endian header size, a JSON header padded with spaces to 8 bytes and the raw little-endian tensor bytes
+    header, offset = {}, 0
+    for key, value in state_dict.items():
+        size = value.numel() * value.element_size()
+        header[key] = {'dtype': _torch_safetensors_dtypes[value.dtype], 'shape': list(value.shape),
+                       'data_offsets': [offset, offset + size]}
+        offset += size
+    if metadata:
+        header['__metadata__'] = {str(key): str(value) for key, value in metadata.items()}
+    header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    header += b' ' * (-len(header) % 8)
+    with open(path, 'wb') as handle:
+        handle.write(struct.pack('<Q', len(header)))
+        handle.write(header)
+        for value in state_dict.values():
+            handle.write(_tensor_bytes(value))
+
+
+@contextlib.contextmanager
+def meta_device_parameters():
+    # Parameters of modules constructed in the context are moved to the meta device as soon as they are registered,
+    # like accelerate's init_empty_weights. Buffers stay on CPU. Fill the parameters with assign_state_dict.
+    register_parameter = nn.Module.register_parameter
+
+    def register_meta_parameter(module, name, param):
+        register_parameter(module, name, param)
+        if param is not None and param.device.type != 'meta':
+            module._parameters[name] = nn.Parameter(
+                param.to('meta'), requires_grad=param.requires_grad)
+    nn.Module.register_parameter = register_meta_parameter
+    try:
+        yield
+    finally:
+        nn.Module.register_parameter = register_parameter
+
+
+def assign_state_dict(module, state_dict, ignore_prefixes=()):
+    # Set tensors of state_dict as the parameters and buffers of module without copying them, unlike load_state_dict
+    # which copies into existing tensors. Raises ValueError if keys don't match or parameters are left on meta device.
+    expected = set(module.state_dict().keys())
+    state_dict = {key: value for key, value in state_dict.items()
+                  if not key.startswith(tuple(ignore_prefixes))}
+    missing, unexpected = expected - set(state_dict), set(state_dict) - expected
+    if missing or unexpected:
+        raise ValueError(
+            f'State dict does not match the model, missing keys {sorted(missing)} and unexpected keys {sorted(unexpected)}')
+    for key, value in state_dict.items():
+        owner_name, _, name = key.rpartition('.')
+        owner = module.get_submodule(owner_name)
+        if name in owner._parameters:
+            owner._parameters[name] = nn.Parameter(
+                value, requires_grad=owner._parameters[name].requires_grad)
+        else:
+            owner._buffers[name] = value
+    on_meta = [name for name, param in module.named_parameters()
+               if param.device.type == 'meta']
+    if on_meta:
+        raise ValueError(f'Parameters {on_meta} were not in the state dict')
+    return module
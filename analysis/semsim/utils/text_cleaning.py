@@ -3,8 +3,11 @@ from fastcore.utils import compose
 import unicodedata
 from string import punctuation
 import html
+import json
 from itertools import groupby
+from functools import lru_cache
 import re
+import pyarrow
 
 control_char_regex = re.compile(r'[\r\n\t]+')
 url_regex = re.compile(
@@ -127,5 +130,124 @@ def remove_multi_space(text):
     return text
 
 
-clean_text_funcs = compose(*[fix_html, remove_control_char, remove_remaining_control_chars, remove_unicode_symbols,
-                            standardise_punc, remove_news_tags, replace_urls, replace_usernames, remove_duplicate_punctuation, remove_multi_space])
+# The original composition of the functions above, kept as the reference output of clean_text
+reference_clean_text_funcs = compose(*[fix_html, remove_control_char, remove_remaining_control_chars, remove_unicode_symbols,
+                                      standardise_punc, remove_news_tags, replace_urls, replace_usernames, remove_duplicate_punctuation, remove_multi_space])
+
+
+# clean_text does the same transformations as the composition with each step run at most once over a string with
+# precompiled regexes and C string methods, steps that can't change a string are skipped after a quick check.
+# remove_unicode_symbols is left out since a one character category prefix never equals 'So' so it changes nothing.
+_fix_html_replacements = [('#39;', "'"), ('amp;', '&'), ('#146;', "'"), ('nbsp;', ' '), ('#36;', '$'), ('\\n', "\n"), ('quot;', "'"), (
+    '<br />', "\n"), ('\\"', '"'), ('<unk>', ' '), (' @.@ ', '.'), (' @-@ ', '-'), ('...', ' …')]
+_standard_punctuation = list(zip(u"‘’´“”–", u"'''\"\"-"))
+# same matches as the patterns of remove_news_tags and replace_urls, but starting with a literal '<' that is searched fast
+_news_tag_regex = re.compile(r"</?[A-Z].+?>")
+_anchor_regex = re.compile(r"<(?:a.+?>|/a>|ref.+?>)")
+# url_regex only matches inside runs of these characters, so it's run only on the runs that have a '.' and two letters
+_url_chars = r'a-zA-Z0-9\.\&\/\?\:@\-_=#'
+_url_candidate_regex = re.compile(
+    rf'[{_url_chars}]*\.[a-zA-Z]{{2}}[{_url_chars}]*')
+_username_handle_regex = re.compile(r'@\w{1,15}\b')
+_duplicate_word_regex = re.compile(r'\b(\w+)( \1\b)+')
+_duplicate_punctuation_regex = re.compile(
+    '([' + ''.join(re.escape(ch) for ch in punctuation) + r'])\1+')
+
+
+@lru_cache(maxsize=None)
+def _is_other_char(ch):
+    return unicodedata.category(ch)[0] == 'C'
+
+
+def _remove_other_chars(text):
+    # isprintable() is False for every category C character (and separators other than space), so most texts are skipped
+    if text.isprintable():
+        return text
+    for ch in [ch for ch in set(text) if _is_other_char(ch)]:
+        text = text.replace(ch, '')
+    return text
+
+
+def _remove_username_handles(text):
+    # re.sub(username_regex, '', text): handles are found by their '@' and removed with the character before them
+    # unless that is '@' or a word character, which also can't be the last character of the previous removed handle
+    parts, last = [], 0
+    for match in _username_handle_regex.finditer(text):
+        start = match.start()
+        if start and (text[start - 1] == '@' or text[start - 1] == '_' or text[start - 1].isalnum()):
+            continue
+        parts.append(text[last:max(start - 1, 0)])
+        last = match.end()
+    if not parts:
+        return text
+    parts.append(text[last:])
+    return ''.join(parts)
+
+
+def _replace_usernames(text):
+    # replace_usernames repeats its replacements once per '@', repeating only until nothing changes gives the same result
+    for _ in range(text.count('@')):
+        replaced = _remove_username_handles(text.replace('@<user>', ''))
+        if replaced == text:
+            break
+        text = replaced
+    return text
+
+
+def clean_text(text):
+    for old, new in _fix_html_replacements:
+        if old in text:
+            text = text.replace(old, new)
+    text = _remove_other_chars(control_char_regex.sub('.', html.unescape(text)))
+    for old, new in _standard_punctuation:
+        if old in text:
+            text = text.replace(old, new)
+    if '<' in text:
+        text = _anchor_regex.sub('', _news_tag_regex.sub('', text))
+    if '.' in text:
+        text = _url_candidate_regex.sub(
+            lambda match: url_regex.sub('', match.group()), text)
+    if '@' in text:
+        text = _replace_usernames(text)
+    text = _duplicate_punctuation_regex.sub(
+        r'\1', _duplicate_word_regex.sub(r'\1', text))
+    return ' '.join(text.split())
+
+
+def clean_texts(text):
+    # list of cleaned texts of a string or an iterable of strings like the composition, duplicate texts are cleaned once
+    if text is None:
+        return []
+    if isinstance(text, str):
+        return [clean_text(text)]
+    cleaned = {}
+    return [cleaned[t] if t in cleaned else cleaned.setdefault(t, clean_text(t)) for t in text]
+
+
+def clean_text_array(array):
+    # cleaned pyarrow string Array of a pyarrow string Array or ChunkedArray, nulls stay null
+    texts = array.to_pylist()
+    cleaned = iter(clean_texts([t for t in texts if t is not None]))
+    return pyarrow.array([None if t is None else next(cleaned) for t in texts], type=pyarrow.string())
+
+
+def compare_with_reference(texts):
+    # (text, reference output, clean_text output) of texts that clean_text cleans differently than the composition
+    texts = list(texts)
+    return [(t, expected, got) for t, expected, got in zip(texts, reference_clean_text_funcs(texts), clean_texts(texts)) if expected != got]
+
+
+clean_text_funcs = clean_texts
+
+
+# Columns cleaned ahead of time (see clean_parquet.py) are listed in Arrow schema metadata so they are not cleaned again
+cleaned_text_columns_key = b'semsim_cleaned_text_columns'
+
+
+def cleaned_text_columns(schema):
+    metadata = schema.metadata or {}
+    return set(json.loads(metadata[cleaned_text_columns_key])) if cleaned_text_columns_key in metadata else set()
+
+
+def with_cleaned_text_columns(schema, columns):
+    return schema.with_metadata({**(schema.metadata or {}), cleaned_text_columns_key: json.dumps(sorted(set(columns))).encode('utf-8')})
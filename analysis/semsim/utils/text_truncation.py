@@ -0,0 +1,103 @@
+import re
+import time
+import numpy as np
+
+# Truncation of texts to the token budget of the model window before tokenization. Cutting every text to max_length
+# whitespace words keeps whole texts of scripts without spaces (e.g. a Chinese transcript is one "word") for the
+# tokenizer to tokenize and throw away, while a character budget alone can't know where the window ends. Here a
+# character prefix sized by the script of the text is tokenized in one batched call of a fast tokenizer, and each
+# text is cut after the word that holds its last token within the budget. Texts whose prefix was too short are
+# retried with a doubled prefix, so the cut texts encode to exactly the same (truncated) input ids as the full texts.
+
+# scripts written without spaces between words, where a token usually covers one or two characters
+_dense_script_regex = re.compile(
+    '[\u0e00-\u0eff\u1000-\u109f\u1780-\u17ff\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]')
+_whitespace_regex = re.compile(r'\s')
+
+
+def script_char_budgets(texts, max_tokens, chars_per_token=8, dense_chars_per_token=2, sample_chars=256):
+    # character budget of each text, texts with dense script characters in their first sample_chars characters get
+    # dense_chars_per_token characters per token and others chars_per_token
+    return np.array([max_tokens * (dense_chars_per_token if _dense_script_regex.search(text, 0, sample_chars) else chars_per_token)
+                     for text in texts], dtype=np.int64)
+
+
+def truncate_words(texts, max_words):
+    # the original truncation of RRUMDataset, max_words whitespace separated words of each text
+    return [' '.join(text.split()[:max_words]).strip() for text in texts]
+
+
+class TokenBudgetTruncator():
+    # Cuts texts to the part that fits in max_length tokens of tokenizer when encoded as a text pair (pair=True, like
+    # RRUMDataset) or alone, minus the special tokens. Tokenizing the cut texts with truncation=True and max_length
+    # gives the same input ids as tokenizing the full texts. Without a fast tokenizer (no offset mappings) texts are
+    # cut to their script's character budget and max_length words.
+    def __init__(self, tokenizer, max_length, pair=True, chars_per_token=8, dense_chars_per_token=2, max_word_chars=100):
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.max_tokens = max_length - \
+            tokenizer.num_special_tokens_to_add(pair=pair)
+        self.chars_per_token = chars_per_token
+        self.dense_chars_per_token = dense_chars_per_token
+        self.max_word_chars = max_word_chars
+
+    def _cut(self, text, end):
+        # text cut at the end of the word of the character at end - 1, or at end in long runs without spaces
+        space = _whitespace_regex.search(text, end, end + self.max_word_chars)
+        if space:
+            end = space.start()
+        elif end + self.max_word_chars >= len(text):
+            end = len(text)
+        return text[:end].strip()
+
+    def __call__(self, texts):
+        texts = list(texts)
+        budgets = script_char_budgets(texts, self.max_tokens, self.chars_per_token,
+                                      self.dense_chars_per_token)
+        if not getattr(self.tokenizer, 'is_fast', False):
+            return truncate_words([text[:budget] for text, budget in zip(texts, budgets)], self.max_length)
+        truncated = [None] * len(texts)
+        rows = list(range(len(texts)))
+        while rows:
+            # one extra token tells whether the prefix holds more than the budget
+            encoded = self.tokenizer([texts[i][:budgets[i]] for i in rows], add_special_tokens=False, truncation=True,
+                                     max_length=self.max_tokens + 1, return_offsets_mapping=True, return_attention_mask=False)
+            retry = []
+            for i, offsets in zip(rows, encoded['offset_mapping']):
+                if len(offsets) > self.max_tokens:
+                    truncated[i] = self._cut(texts[i], max(
+                        end for _, end in offsets[:self.max_tokens]) if self.max_tokens else 0)
+                elif budgets[i] >= len(texts[i]):
+                    truncated[i] = texts[i].strip()
+                else:
+                    retry.append(i)
+                    budgets[i] *= 2
+            rows = retry
+        return truncated
+
+
+def benchmark_truncation(texts, tokenizer, max_length=128, pair=True, repeat=3):
+    # Seconds of truncating and tokenizing texts with truncate_words and TokenBudgetTruncator, the amount of characters
+    # given to the tokenizer and the amount of texts whose input ids differ from tokenizing the full texts.
+    # E.g. benchmark_truncation(data['regret_transcript'].dropna().tolist(), tokenizer) on the multilingual corpus.
+    texts = list(texts)
+    truncator = TokenBudgetTruncator(tokenizer, max_length, pair=pair)
+    max_tokens = truncator.max_tokens
+
+    def tokenize(texts):
+        return tokenizer(texts, add_special_tokens=False, truncation=True, max_length=max_tokens)['input_ids']
+
+    reference = tokenize(texts)
+    results = {}
+    for name, truncate in [('word_split', lambda texts: truncate_words(texts, max_length)), ('token_budget', truncator)]:
+        seconds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            truncated = truncate(texts)
+            input_ids = tokenize(truncated)
+            seconds.append(time.perf_counter() - start)
+        results[name] = {'seconds': min(seconds), 'tokenized_chars': sum(len(text) for text in truncated),
+                         'mismatches': sum(ids != expected for ids, expected in zip(input_ids, reference))}
+    results['speedup'] = results['word_split']['seconds'] / \
+        results['token_budget']['seconds']
+    return results
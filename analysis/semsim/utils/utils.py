@@ -1,15 +1,18 @@
-import gcld3
+from .language_id import LanguageIdentifier
 
 
 # Remove all pairs from data that have languages other than that specified.
-def filter_lang(data, with_transcript, lang):
-    detector = gcld3.NNetLanguageIdentifier(
-        min_num_bytes=0, max_num_bytes=1000)
-    processed_data = data.copy(deep=True)
-    for part in ['regret_title', 'recommendation_title', 'regret_description', 'recommendation_description'] + (['regret_transcript', 'recommendation_transcript'] if with_transcript else []):
-        processed_data = processed_data[
-            (processed_data[part].str.len() < 10) |
-            [detector.FindLanguage(text=x).language ==
-             lang for x in processed_data[part]]
-        ]
-    return processed_data
+# Languages are detected once per video in num_proc processes and cached at cache_path, see language_id.py.
+def filter_lang(data, with_transcript, lang, cache_path=None, num_proc=1):
+    return data[filter_lang_mask(data, with_transcript, lang, cache_path=cache_path, num_proc=num_proc)]
+
+
+# Boolean mask of the pairs of data that filter_lang keeps
+def filter_lang_mask(data, with_transcript, lang, cache_path=None, num_proc=1):
+    language_identifier = LanguageIdentifier(
+        cache_path=cache_path, num_proc=num_proc, max_num_bytes=1000)
+    try:
+        return language_identifier.pair_mask(data, ['title', 'description'] + (['transcript'] if with_transcript else []), lang)
+    finally:
+        if language_identifier.cache is not None:
+            language_identifier.cache.close()